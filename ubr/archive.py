@@ -0,0 +1,545 @@
+import os, io, tarfile, hashlib, gzip, time, threading, json, bisect, fnmatch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ubr.conf import logging
+from ubr.utils import ensure
+
+LOG = logging.getLogger(__name__)
+
+# number of threads compressing an archive
+THREADS = os.cpu_count() or 1
+
+# amount of uncompressed data compressed as a single gzip member
+FRAME_SIZE = 2**20  # 1MiB
+
+# amount of a file read at a time when adding it to an archive
+READ_SIZE = 2**20  # 1MiB
+
+# files up to this size are read into memory during extraction and written by a pool of threads.
+# larger files are written as they are read.
+SMALL_FILE_SIZE = 4 * 2**20  # 4MiB
+
+# maximum amount of file data waiting to be written during extraction
+MAX_PENDING_BYTES = 64 * 2**20  # 64MiB
+
+# maximum amount of compressed archive read at once when extracting selected members
+MAX_READ_SIZE = 16 * 2**20  # 16MiB
+
+#
+# compression
+#
+
+
+class ParallelGzipWriter:
+    """a write-only file-like object that gzips what is written to it using a pool of threads.
+
+    data is split into frames that are compressed independently of each other as separate gzip members.
+    concatenated gzip members are a valid gzip stream, readable by `gunzip`, `tar` and `tarfile`.
+
+    the position of each frame is recorded in `frames` as `[uncompressed offset, compressed offset, compressed size]`
+    so any part of the stream can be decompressed without decompressing everything before it.
+    """
+
+    def __init__(self, fileobj, threads=THREADS, frame_size=FRAME_SIZE, level=6):
+        self.fileobj = fileobj
+        self.frame_size = frame_size
+        self.level = level
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        # frames being compressed, in the order they must be written
+        self.pending = deque()
+        self.max_pending = threads * 2
+        self.buf = []
+        self.buf_size = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames = []
+        # uncompressed offset of the frame currently being buffered
+        self.frame_offset = 0
+
+    def _compress(self, data):
+        # zlib releases the GIL while compressing
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def _drain(self, limit):
+        "writes compressed frames until there are at most `limit` still pending"
+        while len(self.pending) > limit:
+            offset, future = self.pending.popleft()
+            frame = future.result()
+            self.fileobj.write(frame)
+            self.frames.append([offset, self.bytes_out, len(frame)])
+            self.bytes_out += len(frame)
+
+    def _flush_frame(self):
+        if not self.buf_size:
+            return
+        data = b"".join(self.buf)
+        self.buf, self.buf_size = [], 0
+        self.pending.append((self.frame_offset, self.pool.submit(self._compress, data)))
+        self.frame_offset += len(data)
+        self._drain(self.max_pending)
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_size += len(data)
+        self.bytes_in += len(data)
+        if self.buf_size >= self.frame_size:
+            self._flush_frame()
+        return len(data)
+
+    def close(self):
+        try:
+            self._flush_frame()
+            self._drain(0)
+        finally:
+            self.pool.shutdown(wait=True)
+
+
+#
+# archive creation
+#
+
+
+class _HashingReader:
+    "wraps a file object, updating a digest of the data read from it"
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+
+def add_file(tar, path):
+    """adds the file at `path` to the given `tar` with it's absolute path as it's name.
+    returns a map of metadata about the file added."""
+    with open(path, "rb") as fh:
+        tarinfo = tar.gettarinfo(arcname=path, fileobj=fh)
+        # `gettarinfo` strips the leading slash, archives have always used absolute paths.
+        tarinfo.name = path
+        reader = _HashingReader(fh)
+        tar.addfile(tarinfo, reader)
+    return {
+        "path": path,
+        "size": tarinfo.size,
+        "mtime": tarinfo.mtime,
+        "digest": reader.digest.hexdigest(),
+    }
+
+
+def write_archive(path_iter, output_path, threads=THREADS, headers=None):
+    """streams each file in `path_iter` into a new gzipped tar file at `output_path`.
+    files that disappear before they can be archived are skipped.
+    `headers` is an optional map of strings stored in the archive's pax global header.
+    returns an index of the archive's compressed frames and it's members, see `extract_members`.
+    """
+    start = time.time()
+    file_list = []
+    with open(output_path, "wb") as fh:
+        gz = ParallelGzipWriter(fh, threads=threads, frame_size=FRAME_SIZE)
+        try:
+            kwargs = {
+                "fileobj": gz,
+                "mode": "w|",
+                "format": tarfile.PAX_FORMAT,
+                "pax_headers": headers,
+                "copybufsize": READ_SIZE,
+            }
+            with tarfile.open(**kwargs) as tar:
+                for path in path_iter:
+                    try:
+                        # a member starts with it's header(s) and ends with it's padded data
+                        offset = tar.offset
+                        member = add_file(tar, path)
+                        member.update({"offset": offset, "end": tar.offset})
+                        file_list.append(member)
+                    except FileNotFoundError:
+                        LOG.warning(
+                            "file disappeared before it could be archived: %s", path
+                        )
+        finally:
+            gz.close()
+
+    elapsed = max(time.time() - start, 0.001)
+    LOG.info(
+        "archived %s files (%s bytes, %s compressed) into %r in %.1fs (%.1f MB/s)",
+        len(file_list),
+        gz.bytes_in,
+        gz.bytes_out,
+        output_path,
+        elapsed,
+        gz.bytes_in / elapsed / 2**20,
+    )
+    return {"frames": gz.frames, "members": file_list}
+
+
+#
+# archive index
+# the frames and members of an archive, written alongside it as `archive-<hash>.idx.gz`.
+# members can be extracted by decompressing just the frames they occupy.
+#
+
+
+def index_path(archive_path):
+    "/path/to/archive-1a2b3c4d.tar.gz => /path/to/archive-1a2b3c4d.idx.gz"
+    if archive_path.endswith(".tar.gz"):
+        archive_path = archive_path[: -len(".tar.gz")]
+    return archive_path + ".idx.gz"
+
+
+def archive_path(index_path):
+    "/path/to/archive-1a2b3c4d.idx.gz => /path/to/archive-1a2b3c4d.tar.gz"
+    if index_path.endswith(".idx.gz"):
+        index_path = index_path[: -len(".idx.gz")]
+    return index_path + ".tar.gz"
+
+
+def write_index(index, path):
+    with gzip.open(path, "wt") as fh:
+        json.dump(index, fh, separators=(",", ":"))
+    return path
+
+
+def read_index(path):
+    with gzip.open(path, "rt") as fh:
+        return json.load(fh)
+
+
+def read_headers(archive_path):
+    """returns the map of strings stored in the pax global header of the gzipped tar file at `archive_path`,
+    a path or a file object. only the start of the archive is read.
+
+    `tarfile` can't read an archive made up of just a global header (an increment without changes),
+    so the header is parsed here instead."""
+    with gzip.open(archive_path, "rb") as fh:
+        block = fh.read(tarfile.BLOCKSIZE)
+        if len(block) < tarfile.BLOCKSIZE or block[156:157] != tarfile.XGLTYPE:
+            return {}
+        size = tarfile.nti(block[124:136])
+        payload = fh.read(size)
+    # records look like: b"23 ubr.chain=1a2b3c4d\n"
+    headers = {}
+    pos = 0
+    while pos < len(payload):
+        length, _, rest = payload[pos:].partition(b" ")
+        record = payload[pos + len(length) + 1 : pos + int(length)]
+        key, _, value = record.rstrip(b"\n").partition(b"=")
+        headers[key.decode("utf-8")] = value.decode("utf-8")
+        pos += int(length)
+    return headers
+
+
+def list_members(archive_path):
+    "returns the names of the members of the gzipped tar file at `archive_path`"
+    try:
+        with tarfile.open(archive_path, "r:gz") as tar:
+            return tar.getnames()
+    except tarfile.ReadError:
+        if read_headers(archive_path):
+            # just a global header and no members
+            return []
+        raise
+
+
+#
+# archive extraction
+#
+
+
+def _member_path(member, root, links=()):
+    """members are always extracted relative to `root`, whether their names are absolute or not.
+    a member whose name escapes `root` ('../') or lies beneath one of the symlinks in `links`
+    extracted before it is an error."""
+    root = os.path.abspath(root)
+    path = os.path.normpath(os.path.join(root, member.name.lstrip("/")))
+    msg = "archive member %r is outside of %r"
+    ensure(os.path.commonpath([root, path]) == root, msg % (member.name, root))
+    parent = os.path.dirname(path)
+    while links and len(parent) > len(root):
+        msg = "archive member %r is beneath the symlink %r"
+        ensure(parent not in links, msg % (member.name, parent))
+        parent = os.path.dirname(parent)
+    return path
+
+
+def _set_attrs(path, member):
+    "sets the ownership (if we can), permissions and modification time of `path` from `member`"
+    if os.geteuid() == 0:
+        try:
+            os.chown(path, member.uid, member.gid)
+        except OSError as err:
+            LOG.warning("failed to set owner of %s: %s", path, err)
+    os.chmod(path, member.mode)
+    os.utime(path, (member.mtime, member.mtime))
+
+
+def _symlink(path, member):
+    "replaces `path` with the symlink `member`, setting it's ownership (if we can) and modification time"
+    tmp_path = path + ".ubr-link"
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+    os.symlink(member.linkname, tmp_path)
+    os.replace(tmp_path, path)
+    if os.geteuid() == 0:
+        try:
+            os.lchown(path, member.uid, member.gid)
+        except OSError as err:
+            LOG.warning("failed to set owner of %s: %s", path, err)
+    os.utime(path, (member.mtime, member.mtime), follow_symlinks=False)
+
+
+class _Writer:
+    """writes small files using a pool of threads.
+    the amount of data waiting to be written is bounded by `max_pending_bytes`."""
+
+    def __init__(self, threads, max_pending_bytes):
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.futures = []
+        self.capacity = threading.Condition()
+        self.pending_bytes = 0
+        self.max_pending_bytes = max_pending_bytes
+
+    def _write(self, path, member, data):
+        try:
+            with open(path, "wb") as fh:
+                fh.write(data)
+            _set_attrs(path, member)
+        finally:
+            with self.capacity:
+                self.pending_bytes -= len(data)
+                self.capacity.notify_all()
+
+    def submit(self, path, member, data):
+        with self.capacity:
+            # a single file larger than the limit is allowed through when nothing else is pending
+            self.capacity.wait_for(
+                lambda: self.pending_bytes == 0
+                or self.pending_bytes + len(data) <= self.max_pending_bytes
+            )
+            self.pending_bytes += len(data)
+        self.futures.append(self.pool.submit(self._write, path, member, data))
+
+    def close(self):
+        "waits for all writes to finish, raising the first error encountered"
+        self.pool.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+
+def matches(path, patterns):
+    """returns `True` if `path` matches any of the glob `patterns` or is within a directory in `patterns`.
+    everything matches when no patterns are given."""
+    if not patterns:
+        return True
+    return any(
+        fnmatch.fnmatch(path, pattern) or path.startswith(pattern.rstrip("/") + "/")
+        for pattern in patterns
+    )
+
+
+def extract(archive_path, root="/", threads=THREADS, patterns=None):
+    """extracts the regular files and symlinks in the gzipped tar file at `archive_path` to `root` in a single pass.
+    `archive_path` may also be a readable binary stream of a gzipped tar file, see `s3.open_stream`.
+    the archive's integrity is checked as it is read, a corrupt or truncated archive raises an error.
+    if given, only members matching `patterns` are extracted, see `matches`.
+    returns a list of the paths of the files extracted."""
+    start = time.time()
+    extracted = []
+    created_dirs = set()
+    # nothing is extracted through a symlink extracted from the archive
+    links = set()
+
+    def mkdirs(path):
+        parent = os.path.dirname(path)
+        if parent not in created_dirs:
+            os.makedirs(parent, exist_ok=True)
+            created_dirs.add(parent)
+
+    writer = _Writer(threads, MAX_PENDING_BYTES)
+    try:
+        # `tarfile`'s own gzip stream ('r|gz') stops at the end of the first frame,
+        # `gzip` reads every frame and checks each one's crc as it goes.
+        with gzip.open(archive_path, "rb") as gz:
+            try:
+                tar = tarfile.open(fileobj=gz, mode="r|")
+            except tarfile.ReadError:
+                if isinstance(archive_path, str) and read_headers(archive_path):
+                    # just a global header and no members
+                    return []
+                raise
+            with tar:
+                for member in tar:
+                    path = _member_path(member, root, links)
+                    if member.isdir():
+                        os.makedirs(path, exist_ok=True)
+                        created_dirs.add(path)
+                        continue
+                    if not matches("/" + member.name.lstrip("/"), patterns):
+                        continue
+                    if member.issym():
+                        mkdirs(path)
+                        _symlink(path, member)
+                        links.add(path)
+                        extracted.append(path)
+                        continue
+                    if not member.isfile():
+                        # hardlinks, devices and fifos. `write_archive` only archives regular files.
+                        LOG.error(
+                            "archive member %s of an unsupported type was not extracted",
+                            member.name,
+                        )
+                        continue
+                    mkdirs(path)
+                    src = tar.extractfile(member)
+                    if member.size <= SMALL_FILE_SIZE:
+                        writer.submit(path, member, src.read())
+                    else:
+                        with open(path, "wb") as fh:
+                            while True:
+                                data = src.read(READ_SIZE)
+                                if not data:
+                                    break
+                                fh.write(data)
+                        _set_attrs(path, member)
+                    extracted.append(path)
+    finally:
+        writer.close()
+
+    LOG.info(
+        "extracted %s files from %r in %.1fs",
+        len(extracted),
+        archive_path,
+        time.time() - start,
+    )
+    return extracted
+
+
+def _frame_groups(frames, members):
+    """groups `members` by the run of consecutive `frames` they occupy.
+    members sharing or neighbouring frames are grouped together so their frames are only read once.
+    returns a list of `(first frame, last frame, member list)`"""
+    offsets = [frame[0] for frame in frames]
+    groups = []
+    for member in sorted(members, key=lambda m: m["offset"]):
+        first = bisect.bisect_right(offsets, member["offset"]) - 1
+        last = bisect.bisect_right(offsets, member["end"] - 1) - 1
+        if groups and first <= groups[-1][1] + 1:
+            groups[-1][1] = max(groups[-1][1], last)
+            groups[-1][2].append(member)
+        else:
+            groups.append([first, last, [member]])
+    return groups
+
+
+class _FrameStream(io.RawIOBase):
+    """a readable stream of the decompressed `frames` from `first` to `last` of an archive.
+    the frames are read using `read_range` in runs of no more than `max_read_size` bytes
+    and decompressed a frame at a time as they are read."""
+
+    def __init__(self, frames, first, last, read_range, max_read_size=None):
+        self.frames = frames
+        self.next_frame = first
+        self.last = last
+        self.read_range = read_range
+        self.max_read_size = max_read_size or MAX_READ_SIZE
+        # frames read but not yet decompressed
+        self.compressed = deque()
+        self.buf = memoryview(b"")
+        # uncompressed offset in the archive of the next byte read
+        self.pos = frames[first][0]
+        # nothing is read beyond this uncompressed offset
+        self.limit = None
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def _fetch(self):
+        "reads the next run of frames"
+        frames, first = self.frames, self.next_frame
+        start = frames[first][1]
+        end = start + frames[first][2]
+        i = first + 1
+        while (
+            i <= self.last and frames[i][1] + frames[i][2] - start <= self.max_read_size
+        ):
+            end = frames[i][1] + frames[i][2]
+            i += 1
+        data = memoryview(self.read_range(start, end))
+        self.bytes_read += end - start
+        for frame in frames[first:i]:
+            offset = frame[1] - start
+            self.compressed.append(data[offset : offset + frame[2]])
+        self.next_frame = i
+
+    def readinto(self, b):
+        if not self.buf:
+            if not self.compressed:
+                if self.next_frame > self.last:
+                    return 0
+                self._fetch()
+            self.buf = memoryview(gzip.decompress(self.compressed.popleft()))
+        size = min(len(b), len(self.buf))
+        if self.limit is not None:
+            size = min(size, self.limit - self.pos)
+        b[:size] = self.buf[:size]
+        self.buf = self.buf[size:]
+        self.pos += size
+        return size
+
+    def skip(self, offset):
+        "discards what comes before the uncompressed `offset`"
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, READ_SIZE)):
+                raise EOFError("archive ended before offset %s" % offset)
+
+
+def extract_members(index, read_range, patterns, root="/"):
+    """extracts the members of an archive matching `patterns` to `root` using it's `index`.
+    `read_range` is a function that accepts a start and end offset and returns those bytes
+    of the compressed archive. only the frames the matching members occupy are read,
+    no more than `MAX_READ_SIZE` bytes at a time, and each member is written as it's decompressed.
+    returns a list of the paths of the files extracted."""
+    frames = index["frames"]
+    members = [m for m in index["members"] if matches(m["path"], patterns)]
+    extracted = []
+    bytes_read = 0
+    for first, last, member_list in _frame_groups(frames, members):
+        stream = _FrameStream(frames, first, last, read_range)
+        for member in member_list:
+            stream.limit = member["end"]
+            stream.skip(member["offset"])
+            # the member's header(s) and data, `limit` stops `tarfile` reading into the next member
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                tarinfo = tar.next()
+                path = _member_path(tarinfo, root)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                src = tar.extractfile(tarinfo)
+                with open(path, "wb") as fh:
+                    while True:
+                        data = src.read(READ_SIZE)
+                        if not data:
+                            break
+                        fh.write(data)
+                _set_attrs(path, tarinfo)
+            extracted.append(path)
+        bytes_read += stream.bytes_read
+    LOG.info(
+        "extracted %s files reading %s bytes of compressed archive",
+        len(extracted),
+        bytes_read,
+    )
+    return extracted
+
+
+def file_range_reader(archive_path):
+    "returns a function that reads a range of bytes from the local file at `archive_path`"
+
+    def read_range(start, end):
+        with open(archive_path, "rb") as fh:
+            fh.seek(start)
+            return fh.read(end - start)
+
+    return read_range
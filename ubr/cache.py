@@ -0,0 +1,140 @@
+import os, hashlib, json, threading
+from ubr import conf, copier, utils
+from ubr.conf import logging
+
+LOG = logging.getLogger(__name__)
+
+#
+# local backup cache
+# files downloaded from s3 are kept in `conf.CACHE_DIR`, keyed by their s3 key and ETag.
+# downloading the same object again, to restore it somewhere else or to retry a failed restore,
+# copies the cached file into place instead of transferring it again.
+# a changed object has a new ETag and is never served from the cache.
+#
+# the least recently used files are removed once the cache is larger than `conf.CACHE_SIZE` bytes.
+# a `conf.CACHE_SIZE` of 0 disables the cache.
+#
+# cached files are copies, or reflinks where the filesystem supports them, never hardlinks.
+# the md5 of each cached file is recorded alongside it and checked each time it's used,
+# a cached file that has changed is removed rather than used.
+#
+
+_lock = threading.Lock()
+
+META_SUFFIX = ".json"
+
+
+def enabled():
+    return conf.CACHE_SIZE > 0
+
+
+def cache_path(key, etag):
+    "returns the path to the cached copy of the s3 object at `key` with the given `etag`"
+    digest = hashlib.sha256(("%s\0%s" % (key.lstrip("/"), etag)).encode()).hexdigest()
+    return os.path.join(conf.CACHE_DIR, digest)
+
+
+def meta_path(path):
+    return path + META_SUFFIX
+
+
+def _read_meta(path):
+    try:
+        with open(meta_path(path), "r") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove(path):
+    for p in (path, meta_path(path)):
+        if os.path.exists(p):
+            os.unlink(p)
+
+
+def get(key, etag, dest):
+    "puts a copy of the cached `key` at `dest`, returning `True` if there was one"
+    if not enabled():
+        return False
+    path = cache_path(key, etag)
+    meta = _read_meta(path)
+    expected = {"key": key.lstrip("/"), "etag": etag}
+    if not meta or any(meta.get(k) != v for k, v in expected.items()):
+        return False
+    try:
+        if os.path.getsize(path) != meta["size"]:
+            raise ValueError("size")
+        utils.mkdir_p(os.path.dirname(dest))
+        copier.copy(path, dest)
+        if utils.generate_file_md5(dest) != meta["md5"]:
+            os.unlink(dest)
+            raise ValueError("md5")
+    except FileNotFoundError:
+        return False
+    except ValueError as err:
+        LOG.warning("cached copy of %r has changed (%s), removing it", key, err)
+        _remove(path)
+        return False
+    # the file was used, it's the last to be evicted
+    os.utime(path)
+    LOG.info("using cached copy of %r", key)
+    return True
+
+
+def put(key, etag, src, move=False):
+    "adds a copy of the file `src` to the cache as `key`. the file is moved into the cache if `move` is set."
+    if not enabled():
+        return
+    path = cache_path(key, etag)
+    utils.mkdir_p(conf.CACHE_DIR)
+    try:
+        if move:
+            os.replace(src, path)
+        else:
+            copier.copy(src, path)
+        meta = {
+            "key": key.lstrip("/"),
+            "etag": etag,
+            "size": os.path.getsize(path),
+            "md5": utils.generate_file_md5(path),
+        }
+        tmp_path = meta_path(path) + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(meta, fh)
+        os.replace(tmp_path, meta_path(path))
+    except OSError as err:
+        # moving between filesystems, or the cache is full
+        LOG.warning("failed to cache %r: %s", key, err)
+        _remove(path)
+        return
+    evict()
+
+
+def evict(limit=None):
+    "removes the least recently used files from the cache until it's no larger than `limit` bytes"
+    limit = conf.CACHE_SIZE if limit is None else limit
+    with _lock:
+        entry_list = []
+        try:
+            with os.scandir(conf.CACHE_DIR) as it:
+                for entry in it:
+                    if entry.name.endswith(META_SUFFIX):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entry_list.append((st.st_mtime, st.st_size, entry.path))
+        except FileNotFoundError:
+            return []
+        total = sum(size for _, size, _ in entry_list)
+        removed = []
+        for _, size, path in sorted(entry_list):
+            if total <= limit:
+                break
+            _remove(path)
+            total -= size
+            removed.append(path)
+        if removed:
+            LOG.info("removed %s files from the cache", len(removed))
+        return removed
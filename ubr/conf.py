@@ -2,7 +2,6 @@ import pathlib
 import tempfile
 import os, configparser
 import logging
-from pythonjsonlogger import jsonlogger
 
 # from ubr import utils # DONT!
 
@@ -35,27 +34,35 @@ _supported_keys = [
     # 'thread',
     # 'threadName'
 ]
-# optional json logging if you need it
-_log_format = ["%({0:s})".format(i) for i in _supported_keys]
-_log_format = " ".join(_log_format)
-_formatter = jsonlogger.JsonFormatter(_log_format)
 
-# output to stderr
-_handler = logging.StreamHandler()
-_handler.setLevel(logging.INFO)
-_handler.setFormatter(logging.Formatter("%(levelname)s - %(asctime)s - %(message)s"))
 
-_filehandler = logging.FileHandler("ubr.log")
-_filehandler.setFormatter(_formatter)
-_filehandler.setLevel(logging.INFO)
+def _setup_logging():
+    # optional json logging if you need it
+    from pythonjsonlogger import jsonlogger
 
-ROOTLOG.addHandler(_handler)
-ROOTLOG.addHandler(_filehandler)
-ROOTLOG.setLevel(logging.DEBUG)
+    _log_format = ["%({0:s})".format(i) for i in _supported_keys]
+    _log_format = " ".join(_log_format)
+    _formatter = jsonlogger.JsonFormatter(_log_format)
+
+    # output to stderr
+    _handler = logging.StreamHandler()
+    _handler.setLevel(logging.INFO)
+    _handler.setFormatter(
+        logging.Formatter("%(levelname)s - %(asctime)s - %(message)s")
+    )
+
+    _filehandler = logging.FileHandler("ubr.log")
+    _filehandler.setFormatter(_formatter)
+    _filehandler.setLevel(logging.INFO)
+
+    ROOTLOG.addHandler(_handler)
+    ROOTLOG.addHandler(_filehandler)
+    ROOTLOG.setLevel(logging.DEBUG)
+
+    # tell boto to pipe down
+    _loggers = ["boto3", "botocore", "s3transfer"]
+    [logging.getLogger(nom).setLevel(logging.ERROR) for nom in _loggers]
 
-# tell boto to pipe down
-_loggers = ["boto3", "botocore", "s3transfer"]
-[logging.getLogger(nom).setLevel(logging.ERROR) for nom in _loggers]
 
 #
 # utils
@@ -120,7 +127,36 @@ def _var(envname, cfgpath, default):
 # CLI argument parsing uses the values in this map as defaults
 # tests and other non-standard entry points should use the values in
 # this map if parsed CLI arguments are not available
-DEFAULT_CLI_OPTS = {}
+DEFAULT_CLI_OPTS = {
+    # load PostgreSQL dumps in a single transaction with session settings tuned for bulk loading
+    "fast_restore": False,
+    # 'drop' replaces a database by dropping it before loading the backup.
+    # 'swap' loads the backup into a shadow database and swaps it with the live database once loaded.
+    "restore_mode": "drop",
+    # only backup the files that have changed since the previous backup of 'files' and 'tar-gzipped' targets
+    "incremental": False,
+    # with `incremental`, every Nth backup is a full backup
+    "full_every": 7,
+    # write an index of the files in 'tar-gzipped' archives alongside them.
+    # the index is used to find files in backups and to restore files individually.
+    "index": True,
+    # only restore files in 'tar-gzipped' targets matching these patterns
+    "restore_only": [],
+    # split 'tar-gzipped' targets into this many archives written concurrently
+    "shards": 1,
+    # pack the small files of 'files' targets into bundles
+    "bundle": False,
+    # restore 'files' targets as hardlinks to their backups where they share a filesystem
+    "hardlink": False,
+    # restore from s3 as backups are downloaded rather than downloading them first
+    "stream": False,
+    # when pruning RDS snapshots, always keep this many of the most recent snapshots of each instance
+    "keep": 7,
+    # when pruning RDS snapshots, always keep snapshots younger than this many days
+    "keep_days": 30,
+    # when pruning RDS snapshots, just report what would be deleted
+    "dry_run": False,
+}
 
 # which S3 bucket should ubr upload backups to/restore backups from?
 BUCKET = "elife-app-backups"
@@ -128,12 +164,24 @@ BUCKET = "elife-app-backups"
 # where should ubr look for backup descriptions?
 DESCRIPTOR_DIR = _var("UBR_DESCRIPTOR_DIR", "general.descriptor_dir", "/etc/ubr")
 
-# where should ubr do it's work? /tmp/ubr/ by default
+# where should ubr do it's work? /tmp/ubr/ by default. created by `setup`.
 # "/tmp/ubr", "/ext/tmp/ubr"
 WORKING_DIR = os.path.join(
     _var("UBR_WORKING_DIR", "general.working_dir", tempfile.gettempdir()), "ubr"
 )
-_mkdir_p(WORKING_DIR)
+
+# where should ubr keep the files it has downloaded from and uploaded to s3, to avoid transferring them again?
+CACHE_DIR = os.path.join(WORKING_DIR, "cache")
+
+# the most space the cache may use, in MiB. the least recently used files are removed first. 0 disables the cache.
+CACHE_SIZE = int(_cfg("general.cache_size", 0)) * 2**20
+
+# keep the files uploaded to s3 in the cache rather than deleting them
+CACHE_UPLOADS = bool(_cfg("general.cache_uploads", False))
+
+# where should ubr keep state between runs? for example, the snapshot indices of incremental backups.
+# this should survive a reboot, a missing snapshot index means a full backup is taken.
+STATE_DIR = _var("UBR_STATE_DIR", "general.state_dir", "/var/lib/ubr")
 
 # always be explicit about which AWS credentials to use,
 # otherwise boto will go looking for them on the fs, in envvars, etc,
@@ -145,6 +193,18 @@ AWS = {
     "region_name": "us-east-1",
 }
 
+# how many connections to s3 transfer data at once, shared by all uploads and downloads. see `transfer`
+S3_CONNECTIONS = int(_cfg("aws.connections", 8))
+
+# the most bytes per second transferred to and from s3, shared by all uploads and downloads. 0 is unlimited
+S3_BANDWIDTH = int(_cfg("aws.bandwidth", 0))
+
+# how many ranges of a single file are downloaded at once, within the budget of `S3_CONNECTIONS`
+S3_DOWNLOAD_CONNECTIONS = int(_cfg("aws.download_connections", 4))
+
+# the size of each range of a file downloaded at once, in MiB
+S3_DOWNLOAD_PART_SIZE = int(_cfg("aws.download_part_size", 32)) * 2**20
+
 MYSQL = {
     "user": _cfg("mysql.user"),
     "pass": _cfg("mysql.pass"),
@@ -163,6 +223,15 @@ POSTGRESQL = {
     "port": int(_cfg("postgresql.port", 5432)),
 }
 
+# 'plain' dumps are SQL scripts that are replayed with `psql`.
+# 'custom' dumps are `pg_dump` archives restored with `pg_restore` that support restoring individual tables.
+POSTGRESQL_DUMP_FORMAT = _cfg("postgresql.dump_format", "plain")
+
+# memory available to index and constraint creation during a 'fast' restore
+POSTGRESQL_RESTORE_MAINTENANCE_WORK_MEM = _cfg(
+    "postgresql.restore_maintenance_work_mem", "512MB"
+)
+
 # ignore these specific projects when reporting
 # (projects with an "_" prefix are automatically ignored
 REPORT_PROJECT_BLACKLIST = ["civicrm"]
@@ -187,3 +256,41 @@ KNOWN_TARGETS = [
     "postgresql-database",
     "rds-snapshot",
 ]
+
+# how many backups of targets can run at once, see `executor`
+JOB_THREADS = int(_cfg("general.job_threads", 4))
+
+# how many backups of a kind of target can run against the same server at once
+JOB_LIMITS = {
+    "mysql": 1,
+    "postgresql": 1,
+    "archive": 2,  # 'files' and 'tar-gzipped' targets
+    "rds": 1,
+}
+
+# how many restores of a kind of target can run against the same server at once
+RESTORE_JOB_LIMITS = {
+    "mysql": int(_cfg("mysql.restore_jobs", 2)),
+    "postgresql": int(_cfg("postgresql.restore_jobs", 2)),
+    "archive": 2,
+    "s3": 4,  # downloads
+}
+
+
+#
+# setup
+# importing `conf` only reads the config file.
+# logging and the working directory are set up by the entry point, once, before anything is done.
+#
+
+_setup_done = False
+
+
+def setup():
+    "sets up logging and creates the working directory. safe to call more than once."
+    global _setup_done
+    if _setup_done:
+        return
+    _setup_done = True
+    _setup_logging()
+    _mkdir_p(WORKING_DIR)
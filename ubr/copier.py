@@ -0,0 +1,206 @@
+import os, errno, fcntl, stat, time, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ubr import utils
+from ubr.conf import logging
+
+LOG = logging.getLogger(__name__)
+
+#
+# file copying
+# each file is copied in the cheapest way the filesystems support:
+# 1. a reflink, sharing the blocks of the original file (btrfs, xfs)
+# 2. `copy_file_range`, copying within the kernel without reading the file into memory
+# 3. reading and writing the file in blocks
+# holes in sparse files are kept as holes rather than written out as zeroes.
+#
+
+THREADS = min(16, (os.cpu_count() or 1) * 4)
+BLOCK_SIZE = 2**20  # 1MiB
+CHUNK_SIZE = 2**30  # 1GiB, the most `copy_file_range` is asked to copy at once
+
+# linux ioctl to clone a file, see `ioctl_ficlone(2)`
+FICLONE = 0x40049409
+
+# errors that mean a method of copying isn't supported between two files
+UNSUPPORTED = (
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+)
+
+# pairs of `(src device, dest device)` that a method of copying failed between
+_no_reflink = set()
+_no_copy_range = set()
+
+
+def _reflink(src_fd, dest_fd, devices):
+    "returns `True` if `dest_fd` now shares the blocks of `src_fd`"
+    if devices in _no_reflink:
+        return False
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, src_fd)
+        return True
+    except OSError as err:
+        if err.errno not in UNSUPPORTED:
+            raise
+        _no_reflink.add(devices)
+        return False
+
+
+def _data_segments(fd, size):
+    "yields each `(start, end)` of data in the file `fd`, skipping holes"
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # nothing but a hole until the end of the file
+                return
+            if err.errno not in UNSUPPORTED:
+                raise
+            # holes can't be found, the whole file is data
+            yield offset, size
+            return
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end
+        offset = end
+
+
+def _copy_range(src_fd, dest_fd, start, end, devices):
+    "copies the bytes between `start` and `end` of `src_fd` to the same place in `dest_fd`"
+    offset = start
+    if devices not in _no_copy_range:
+        try:
+            while offset < end:
+                copied = os.copy_file_range(
+                    src_fd, dest_fd, min(end - offset, CHUNK_SIZE), offset, offset
+                )
+                if not copied:
+                    break
+                offset += copied
+            if offset >= end:
+                return
+        except OSError as err:
+            if err.errno not in UNSUPPORTED:
+                raise
+            _no_copy_range.add(devices)
+    while offset < end:
+        data = os.pread(src_fd, min(end - offset, BLOCK_SIZE), offset)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(dest_fd, view, offset)
+            view = view[written:]
+            offset += written
+
+
+def copy(src, dest):
+    """copies the contents, permissions and modification time of the file `src` to `dest`,
+    replacing `dest` if it exists. the directory `dest` is in must already exist.
+    returns the number of bytes copied.
+
+    the copy is written alongside `dest` and moved over it, `dest` is never written to in place.
+    it may be a hardlink sharing it's contents with another file, a backup or a restored file.
+    """
+    tmp_path = dest + ".ubr-copy"
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        st = os.fstat(src_fd)
+        dest_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            devices = (st.st_dev, os.fstat(dest_fd).st_dev)
+            if not (st.st_size and _reflink(src_fd, dest_fd, devices)):
+                for start, end in _data_segments(src_fd, st.st_size):
+                    _copy_range(src_fd, dest_fd, start, end, devices)
+                # a hole at the end of the file isn't copied, the file is extended over it
+                os.ftruncate(dest_fd, st.st_size)
+            os.fchmod(dest_fd, stat.S_IMODE(st.st_mode))
+            os.utime(dest_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(dest_fd)
+        os.replace(tmp_path, dest)
+        return st.st_size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    finally:
+        os.close(src_fd)
+
+
+def link(src, dest):
+    """replaces `dest` with a hardlink to `src`.
+    returns the size of the file or `None` if `src` and `dest` can't be linked."""
+    tmp_path = dest + ".ubr-link"
+    try:
+        os.link(src, tmp_path)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        return None
+    os.replace(tmp_path, dest)
+    return os.stat(dest).st_size
+
+
+def copy_files(pair_iter, threads=THREADS, digest=False, hardlink=False):
+    """copies each `(src, dest)` in `pair_iter` on a pool of `threads`, creating directories as needed.
+    files that disappear before they can be copied are skipped.
+    if `digest` is set, the md5 of each file copied is calculated as well.
+    if `hardlink` is set, files are linked rather than copied where they share a filesystem.
+    a linked file shares it's contents with the original, changing one changes the other.
+    returns a list of `{"src": ..., "dest": ..., "size": ..., "digest": ...}`, in order.
+    """
+    start = time.time()
+    created_dirs = set()
+    lock = threading.Lock()
+    totals = {"files": 0, "bytes": 0}
+
+    def _copy(src, dest):
+        try:
+            size = link(src, dest) if hardlink else None
+            if size is None:
+                size = copy(src, dest)
+        except FileNotFoundError:
+            LOG.warning("skipping file that has disappeared: %s", src)
+            return None
+        with lock:
+            totals["files"] += 1
+            totals["bytes"] += size
+        return {
+            "src": src,
+            "dest": dest,
+            "size": size,
+            "digest": utils.generate_file_md5(dest) if digest else None,
+        }
+
+    results = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for src, dest in pair_iter:
+            parent = os.path.dirname(dest)
+            if parent not in created_dirs:
+                os.makedirs(parent, exist_ok=True)
+                created_dirs.add(parent)
+            pending.append(executor.submit(_copy, src, dest))
+            # bound the number of copies waiting for a thread
+            while len(pending) > threads * 4:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+
+    elapsed = max(time.time() - start, 0.001)
+    LOG.info(
+        "copied %s files (%s bytes) in %.1fs, %.1f files/s, %.1f MiB/s",
+        totals["files"],
+        totals["bytes"],
+        elapsed,
+        totals["files"] / elapsed,
+        totals["bytes"] / elapsed / 2**20,
+    )
+    return [result for result in results if result]
@@ -2,8 +2,6 @@ import os
 from ubr import utils
 from .utils import ensure, unique
 from functools import partial
-import yaml
-from schema import Schema, SchemaError
 from . import conf
 from functools import reduce
 
@@ -39,6 +37,25 @@ LOG = conf.logging.getLogger(__name__)
 # tar-gzipped:
 #   - /var/log/myapp/*
 
+#
+# selectors
+# some targets support narrowing a path down further with a selector after a colon.
+# for example, `postgresql-database.mydb:public.articles` is the database `mydb`
+# with a selector of `public.articles` (just the 'articles' table in the 'public' schema).
+#
+
+SELECTOR_TARGETS = ["postgresql-database"]
+
+
+def split_selector(target, path):
+    """returns a pair of `(path, selector)` for the given `target` and `path`.
+    `selector` is `None` if one wasn't given or the target doesn't support selectors."""
+    if target in SELECTOR_TARGETS and ":" in path:
+        path, selector = path.split(":", 1)
+        return path, selector or None
+    return path, None
+
+
 #
 # description pruning
 #
@@ -59,7 +76,8 @@ def _subdesc(desc, path):
     if not toplevel in desc:
         LOG.warning("no %r in descriptor: %s" % (toplevel, desc))
         return {}
-    if not target in desc[toplevel]:
+    name, _ = split_selector(toplevel, target)
+    if not name in desc[toplevel]:
         LOG.warning("given descriptor has no path %r" % path)
         return {}
     return {toplevel: [target]}
@@ -117,6 +135,8 @@ def find_descriptors(descriptor_dir):
 
 def validate_descriptor(descriptor):
     "returns `True` if the given `descriptor` is correctly structured."
+    from schema import Schema, SchemaError
+
     try:
         fn = lambda v: v in conf.KNOWN_TARGETS
         descr_schema = Schema({fn: [str]})
@@ -126,6 +146,8 @@ def validate_descriptor(descriptor):
 
 
 def load_descriptor(descriptor_path, path_list=[]):
+    import yaml
+
     data = yaml.safe_load(open(descriptor_path, "r"))
     if not data:
         return {}
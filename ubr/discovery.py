@@ -0,0 +1,234 @@
+import os, re, time, fnmatch
+from ubr.utils import ensure
+from ubr.conf import logging
+
+LOG = logging.getLogger(__name__)
+
+#
+# file discovery
+# finds the files described by the paths of 'files' and 'tar-gzipped' targets.
+#
+# a path is either a literal path to a file or a pattern:
+# - '*' matches anything in a file or directory name, '?' matches a single character
+# - '**' matches any number of directories, including none
+# names beginning with a '.' are only matched by patterns that begin with a '.'
+#
+# options for the whole target can be given alongside the paths:
+# - 'exclude=<pattern>', skips matching files and directories. for example: 'exclude=*.tmp', 'exclude=/opt/app/cache'
+# - 'max-size=<size>', skips files larger than this. for example: 'max-size=100M'
+# - 'max-age=<age>', skips files modified longer ago than this. for example: 'max-age=30d'
+#
+# all patterns are matched in a single walk of the filesystem.
+# directories are only entered if a pattern could match something within them.
+#
+
+OPTIONS = ["exclude", "max-size", "max-age"]
+OPTION_REGEX = re.compile(r"^(?P<key>%s)=(?P<val>.+)$" % "|".join(OPTIONS))
+
+SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+AGE_UNITS = {
+    "": 1,
+    "s": 1,
+    "m": 60,
+    "h": 60 * 60,
+    "d": 60 * 60 * 24,
+    "w": 60 * 60 * 24 * 7,
+}
+
+
+def is_option(path):
+    return bool(OPTION_REGEX.match(path))
+
+
+def parse_quantity(string, units):
+    "'100M', SIZE_UNITS => 104857600"
+    match = re.match(r"^(\d+)(%s)?$" % "|".join(filter(None, units)), string.strip())
+    ensure(
+        match,
+        "can't parse %r, expecting a number and one of %s"
+        % (string, list(filter(None, units))),
+        ValueError,
+    )
+    return int(match.group(1)) * units[match.group(2) or ""]
+
+
+def split_options(path_list):
+    """returns a pair of `(path_list, options)` with any options removed from `path_list`.
+    `options` has an 'exclude' list and a 'max-size' and 'max-age' that are `None` if not given.
+    """
+    options = {"exclude": [], "max-size": None, "max-age": None}
+    paths = []
+    for path in path_list:
+        match = OPTION_REGEX.match(path)
+        if not match:
+            paths.append(path)
+            continue
+        key, val = match.group("key"), match.group("val")
+        if key == "exclude":
+            options["exclude"].append(val)
+        elif key == "max-size":
+            options["max-size"] = parse_quantity(val, SIZE_UNITS)
+        else:
+            options["max-age"] = parse_quantity(val, AGE_UNITS)
+    return paths, options
+
+
+def is_pattern(path):
+    return any(char in path for char in "*?[")
+
+
+def split_pattern(pattern):
+    "'/opt/app/*/uploads/**' => ('/opt/app', ['*', 'uploads', '**'])"
+    segments = pattern.rstrip("/").split("/")
+    for i, segment in enumerate(segments):
+        if is_pattern(segment):
+            root = "/".join(segments[:i])
+            if not root and pattern.startswith("/"):
+                root = "/"
+            return root, segments[i:]
+    return pattern, []
+
+
+def match_segment(name, segment):
+    "returns `True` if the file or directory `name` is matched by the pattern `segment`"
+    if name.startswith(".") and not segment.startswith("."):
+        return False
+    return fnmatch.fnmatchcase(name, segment)
+
+
+def match_states(states, name):
+    """advances each of the pattern `states` past the file or directory `name`.
+    a state is a list of the pattern segments still to be matched.
+    returns the states that can continue below `name`."""
+    next_states = []
+    for segments in states:
+        if not segments:
+            continue
+        segment = segments[0]
+        if segment == "**":
+            if not name.startswith("."):
+                # '**' matches this name and maybe more beneath it
+                next_states.append(segments)
+                if len(segments) == 1:
+                    next_states.append([])
+            # or '**' matched nothing
+            next_states.extend(match_states([segments[1:]], name))
+        elif match_segment(name, segment):
+            next_states.append(segments[1:])
+    return next_states
+
+
+def matched(states):
+    "returns `True` if any of the pattern `states` has been completely matched"
+    return any(not segments for segments in states)
+
+
+def recursive(states):
+    "returns `True` if any of the pattern `states` is matching with a '**'"
+    return any(segments and segments[0] == "**" for segments in states)
+
+
+def excluded(path, exclude_list):
+    return any(
+        fnmatch.fnmatchcase(path, pattern) or path.startswith(pattern.rstrip("/") + "/")
+        for pattern in exclude_list
+    )
+
+
+def _walk(root, states, options, seen):
+    "yields the files matched by the pattern `states` beneath the directory `root`"
+    try:
+        # an empty root is the current directory, paths found within it are relative
+        with os.scandir(root or ".") as it:
+            entry_list = sorted(it, key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    except PermissionError as err:
+        LOG.warning("skipping unreadable directory: %s", err)
+        return
+
+    dir_list = []
+    now = time.time()
+    for entry in entry_list:
+        entry_states = match_states(states, entry.name)
+        if not entry_states:
+            continue
+        path = os.path.join(root, entry.name)
+        if options["exclude"] and excluded(path, options["exclude"]):
+            continue
+        try:
+            if entry.is_dir():
+                # symlinked directories aren't followed by '**', like `os.walk`
+                within = any(entry_states) and not (
+                    entry.is_symlink() and recursive(states)
+                )
+                if within:
+                    dir_list.append((path, entry_states))
+                continue
+            if not matched(entry_states) or not entry.is_file():
+                continue
+            if options["max-size"] is not None or options["max-age"] is not None:
+                st = entry.stat()
+                if options["max-size"] is not None and st.st_size > options["max-size"]:
+                    continue
+                if (
+                    options["max-age"] is not None
+                    and now - st.st_mtime > options["max-age"]
+                ):
+                    continue
+        except OSError:
+            # disappeared or otherwise unavailable since the directory was read
+            continue
+        if path in seen or not os.access(path, os.R_OK):
+            continue
+        seen.add(path)
+        yield path
+
+    # files first, then the contents of each directory
+    for path, dir_states in dir_list:
+        yield from _walk(path, dir_states, options, seen)
+
+
+def find_files(path_list, report_missing=True):
+    """lazily finds the readable files described by `path_list`.
+    literal paths are yielded first, in order, followed by the files matching any patterns.
+    a file is only yielded once, no matter how many paths match it.
+    literal paths that aren't valid files are logged as removed from the backup unless `report_missing` is false.
+    """
+    path_list, options = split_options(path_list)
+    seen = set()
+    missing = []
+    root_idx = {}
+    for path in path_list:
+        if not is_pattern(path):
+            valid = (
+                os.path.isfile(path)
+                and os.access(path, os.R_OK)
+                and not excluded(path, options["exclude"])
+            )
+            if not valid:
+                missing.append(path)
+            elif path not in seen:
+                seen.add(path)
+                yield path
+            continue
+        root, segments = split_pattern(path)
+        root_idx.setdefault(root, []).append(segments)
+
+    if missing and report_missing:
+        msg = "the following files failed validation and were removed from this backup: %s"
+        LOG.error(msg, ", ".join(missing))
+
+    for root in sorted(root_idx):
+        # patterns beneath another pattern's root are matched while walking that root
+        parent_list = [
+            r for r in root_idx if r != root and root.startswith(r.rstrip("/") + "/")
+        ]
+        if parent_list:
+            continue
+        states = list(root_idx[root])
+        for other_root in root_idx:
+            if other_root != root and other_root.startswith(root.rstrip("/") + "/"):
+                relative = other_root[len(root.rstrip("/")) + 1 :].split("/")
+                states.extend(relative + segments for segments in root_idx[other_root])
+        yield from _walk(root, states, options, seen)
@@ -0,0 +1,204 @@
+import os, json, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ubr import conf, utils
+from ubr.utils import ensure
+from ubr.conf import logging
+
+LOG = logging.getLogger(__name__)
+
+#
+# job execution
+# backups of independent targets are run concurrently, within limits:
+# - no more than `conf.JOB_THREADS` jobs run at once
+# - no more than `conf.JOB_LIMITS[kind]` jobs of a kind run against the same server at once,
+#   for example, a single database dump per database server.
+# the jobs that took longest the last time they ran are started first.
+# a job that fails doesn't stop the others.
+#
+# jobs can be chained, a job is started as soon as the job before it in the chain has succeeded.
+# for example, a database is restored as soon as it's backup has been downloaded while other
+# backups are still downloading.
+#
+
+
+def resource(target):
+    "returns the `(kind, server)` a job for the given `target` uses"
+    if target == "mysql-database":
+        return ("mysql", "%s:%s" % (conf.MYSQL["host"], conf.MYSQL["port"]))
+    if target == "postgresql-database":
+        return (
+            "postgresql",
+            "%s:%s" % (conf.POSTGRESQL["host"], conf.POSTGRESQL["port"]),
+        )
+    if target == "rds-snapshot":
+        return ("rds", conf.AWS["region_name"])
+    if target == "s3":
+        # downloads and uploads
+        return ("s3", conf.BUCKET)
+    # 'files' and 'tar-gzipped' targets read and write the local disk
+    return ("archive", "localhost")
+
+
+def job(name, target, fn, *args):
+    """returns a job that calls `fn` with `args`.
+    `name` identifies the job between runs and should be stable, for example: '/tmp/ubr/lax/prod--lax:files'
+    """
+    return {
+        "name": name,
+        "resource": resource(target),
+        "fn": fn,
+        "args": args,
+        "then": None,
+    }
+
+
+def chain(*job_list):
+    "chains the jobs in `job_list` together, returning the first"
+    for first, then in zip(job_list, job_list[1:]):
+        first["then"] = then
+    return job_list[0]
+
+
+def estimate(job, durations):
+    "returns how long the chain of jobs starting with `job` took the last time, or infinity if it hasn't run before"
+    total = 0
+    while job:
+        if job["name"] not in durations:
+            return float("inf")
+        total += durations[job["name"]]
+        job = job["then"]
+    return total
+
+
+# jobs that haven't succeeded for this long are forgotten, in seconds.
+# job names include paths that change between runs, like download directories.
+DURATIONS_MAX_AGE = 60 * 60 * 24 * 30
+
+
+def durations_path():
+    return os.path.join(conf.STATE_DIR, "durations.json")
+
+
+def _read_records():
+    """returns a map of `{job name: {"duration": seconds, "finished": timestamp}}`"""
+    try:
+        with open(durations_path(), "r") as fh:
+            records = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    # durations recorded without a timestamp are kept until they are next written
+    return {
+        name: (
+            record if isinstance(record, dict) else {"duration": record, "finished": 0}
+        )
+        for name, record in records.items()
+    }
+
+
+def read_durations():
+    "returns a map of `{job name: seconds}` the jobs took the last time they ran"
+    return {name: record["duration"] for name, record in _read_records().items()}
+
+
+def write_durations(result_list):
+    """records how long each of the successful jobs in `result_list` took.
+    jobs that haven't succeeded within `DURATIONS_MAX_AGE` are forgotten."""
+    now = time.time()
+    records = _read_records()
+    records.update(
+        {
+            step["name"]: {"duration": step["duration"], "finished": now}
+            for result in result_list
+            for step in result["steps"]
+            if not step["error"]
+        }
+    )
+    records = {
+        name: record
+        for name, record in records.items()
+        if now - record["finished"] <= DURATIONS_MAX_AGE
+    }
+    path = durations_path()
+    try:
+        utils.mkdir_p(os.path.dirname(path))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(records, fh)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        LOG.warning("failed to record job durations: %s", err)
+
+
+def _run(job):
+    start = time.time()
+    result = {"name": job["name"], "result": None, "error": None}
+    try:
+        result["result"] = job["fn"](*job["args"])
+    except Exception as exc:
+        LOG.exception("job %r failed", job["name"])
+        result["error"] = exc
+    result["duration"] = time.time() - start
+    LOG.info("job %r finished in %.1fs", job["name"], result["duration"])
+    return result
+
+
+def run(job_list, threads=None, limits=None):
+    """runs each job in `job_list`, longest first, as concurrently as `threads` and `limits` allow.
+    returns a list of `{"name": ..., "result": ..., "error": ..., "duration": ..., "steps": [...]}` for each job, in order.
+    the result of a chain of jobs is the result of the last job in the chain to run.
+    'steps' is a list of the results of each job in the chain.
+    """
+    threads = threads or conf.JOB_THREADS
+    limits = limits or conf.JOB_LIMITS
+    # a job of a kind limited to no jobs at once could never be started
+    ensure(
+        threads >= 1, "at least one job must run at a time: %r" % threads, ValueError
+    )
+    bad_limits = {kind: limit for kind, limit in limits.items() if limit < 1}
+    ensure(
+        not bad_limits,
+        "at least one job of each kind must run at a time: %r" % bad_limits,
+        ValueError,
+    )
+    durations = read_durations()
+    # jobs that haven't run before are assumed to be the longest
+    pending = sorted(
+        [(i, job) for i, job in enumerate(job_list)],
+        key=lambda pair: -estimate(pair[1], durations),
+    )
+    steps = [[] for _ in job_list]
+    running = {}  # {future: (index, job)}
+    running_count = {}  # {resource: count}
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while pending or running:
+            for i, job in list(pending):
+                if len(running) >= threads:
+                    break
+                res = job["resource"]
+                if running_count.get(res, 0) >= limits.get(res[0], threads):
+                    continue
+                running_count[res] = running_count.get(res, 0) + 1
+                pending = [pair for pair in pending if pair[1] is not job]
+                running[executor.submit(_run, job)] = (i, job)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, job = running.pop(future)
+                running_count[job["resource"]] -= 1
+                result = future.result()
+                steps[i].append(result)
+                if job["then"] and not result["error"]:
+                    # the next job in the chain goes ahead of jobs that haven't started
+                    pending.insert(0, (i, job["then"]))
+
+    results = [dict(step_list[-1], steps=step_list) for step_list in steps]
+    write_durations(results)
+    return results
+
+
+def first_error(result_list):
+    "returns the error of the first job in `result_list` that failed, if any"
+    for result in result_list:
+        if result["error"]:
+            return result["error"]
+    return None
@@ -1,51 +1,177 @@
-import os, shutil, glob2
-from ubr import utils
-from ubr.utils import ensure
+import os, json, hashlib, time
+from ubr import utils, discovery, snapshot, copier, archive
 from .conf import logging
 
 LOG = logging.getLogger(__name__)
 
 
 def copy_file(src, dest):
-    "a wrapper around shutil.copyfile that will create the dest dirs if necessary"
-    dirs = os.path.dirname(dest)
-    if not os.path.exists(dirs):
-        os.makedirs(dirs)
-    shutil.copyfile(src, dest)
+    "copies a single file, creating the dest dirs if necessary. see `copier`"
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    copier.copy(src, dest)
     return dest
 
 
-def file_is_valid(src):
-    return all(
-        [
-            os.path.exists(src),  # exists?
-            os.path.isfile(src),  # is a file?
-            os.access(src, os.R_OK),  # is a *readable* file?
-        ]
+def iter_files(path_list):
+    "lazily expands any patterns in `path_list`, yielding just the valid files. see `discovery`"
+    return discovery.find_files(path_list)
+
+
+#
+# incremental backups
+# only files that are new or have changed since the previous backup are copied.
+# each backup also writes a manifest of the state of every file at the time of the backup,
+# which files changed and which were deleted:
+#
+# {"created": 1700000000.0, "seq": 3, "files": {"/path/to/file": {"size": 123, "mtime": 1.0, "digest": "..."}},
+#  "changed": ["/path/to/file"], "deleted": ["/path/to/another/file"]}
+#
+# the state of the files at the previous backup is kept in a snapshot index, see `snapshot`.
+#
+
+
+def filename_for_paths(path_list):
+    "given a list of paths, return a predictable string that can be used as a filename"
+    psv = "|".join(path_list).encode()
+    return "files-" + hashlib.sha1(psv).hexdigest()[:8]
+
+
+def manifest_filename(path_list):
+    "given a list of paths, returns a predictable filename for their manifest"
+    return filename_for_paths(path_list) + ".manifest.json"
+
+
+def snapshot_name(path_list, destination):
+    "the name of the snapshot index for the `path_list` backed up to `destination`"
+    name = filename_for_paths(path_list)
+    return "%s-%s" % (name, hashlib.sha1(destination.encode()).hexdigest()[:8])
+
+
+def _incremental_backup(path_list, destination, opts):
+    name = snapshot_name(path_list, destination)
+    previous = snapshot.read(name) or {"seq": -1, "files": {}}
+    current_files, changed_paths, deleted_paths = snapshot.diff(
+        previous["files"], iter_files(path_list)
+    )
+    seq = previous["seq"] + 1
+    LOG.info(
+        "incremental backup %s: %s changed files, %s deleted files",
+        seq,
+        len(changed_paths),
+        len(deleted_paths),
     )
 
+    utils.mkdir_p(destination)
+    copy_list = copier.copy_files(
+        ((src, os.path.join(destination, src.lstrip("/"))) for src in changed_paths),
+        digest=True,
+    )
+    copied = [result["src"] for result in copy_list]
+    results = [result["dest"] for result in copy_list]
+    for result in copy_list:
+        current_files[result["src"]]["digest"] = result["digest"]
+    # files that disappeared before they could be copied are recorded as deleted next time
+    for src in set(changed_paths) - set(copied):
+        del current_files[src]
 
-def expand_path(src):
-    "files can be described using an extended glob syntax with support for recursive dirs"
-    return glob2.glob(src)
+    # copies of deleted files left by previous backups no longer apply to anything
+    for path in deleted_paths:
+        stale_copy = os.path.join(destination, path.lstrip("/"))
+        if os.path.isfile(stale_copy):
+            os.unlink(stale_copy)
 
+    manifest_path = os.path.join(destination, manifest_filename(path_list))
+    manifest = {
+        "created": time.time(),
+        "seq": seq,
+        "files": {
+            path: {key: state[key] for key in ["size", "mtime", "digest"]}
+            for path, state in current_files.items()
+        },
+        "changed": copied,
+        "deleted": deleted_paths,
+    }
+    with open(manifest_path, "w") as fh:
+        json.dump(manifest, fh)
+    results.append(manifest_path)
 
-def wrangle_files(path_list):
-    # expand any globs and then flatten the resulting nested structure
-    new_path_list = utils.flatten(list(map(expand_path, path_list)))
-    new_path_list = list(filter(file_is_valid, new_path_list))
+    # the new state is recorded once the copies have been kept, see `snapshot.commit`
+    snapshot.write(name, {"seq": seq, "files": current_files}, pending=True)
+    return {"output_dir": destination, "output": results, "snapshot": name}
 
-    # some adhoc error reporting
-    try:
-        msg = "invalid files have been removed from the backup!"
-        ensure(len(path_list) == len(new_path_list), msg)
-    except AssertionError:
-        # find the difference and then strip out anything that looks like a glob expr
-        missing = [p for p in set(path_list) - set(new_path_list) if "*" not in p]
-        if missing:
-            msg = "the following files failed validation and were removed from this backup: %s"
-            LOG.error(msg, ", ".join(missing))
-    return new_path_list
+
+#
+# bundled backups
+# small files are packed together into bundles, 'files-<hash>.bundle-NNNN.tar.gz', of about `BUNDLE_SIZE`.
+# large files are copied as they are. a bundle index records which files are where:
+#
+# {"bundles": {"files-<hash>.bundle-0001.tar.gz": ["/path/to/file", ...]}, "files": ["/path/to/large/file"]}
+#
+
+BUNDLE_SIZE = 256 * 2**20  # 256MiB
+BUNDLE_FILE_SIZE = 2**20  # files smaller than 1MiB are bundled
+
+
+def bundle_index_filename(path_list):
+    "given a list of paths, returns a predictable filename for their bundle index"
+    return filename_for_paths(path_list) + ".bundles.json"
+
+
+def bundle_filename(path_list, n):
+    "given a list of paths, returns a predictable filename for their `n`th bundle"
+    return "%s.bundle-%04d.tar.gz" % (filename_for_paths(path_list), n)
+
+
+def _bundled_backup(path_list, destination, opts):
+    utils.mkdir_p(destination)
+    bundle_idx = {}
+    large_list = []
+    pending, pending_size = [], 0
+
+    def write_bundle():
+        name = bundle_filename(path_list, len(bundle_idx) + 1)
+        index = archive.write_archive(iter(pending), os.path.join(destination, name))
+        bundle_idx[name] = [member["path"] for member in index["members"]]
+
+    for path in iter_files(path_list):
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            continue
+        if size >= BUNDLE_FILE_SIZE:
+            large_list.append(path)
+            continue
+        pending.append(path)
+        pending_size += size
+        if pending_size >= BUNDLE_SIZE:
+            write_bundle()
+            pending, pending_size = [], 0
+    if pending:
+        write_bundle()
+
+    # bundles of a previous backup no longer apply to anything
+    bundle_prefix = filename_for_paths(path_list) + ".bundle-"
+    for name in os.listdir(destination):
+        if name.startswith(bundle_prefix) and name not in bundle_idx:
+            os.unlink(os.path.join(destination, name))
+
+    copy_list = copier.copy_files(
+        (src, os.path.join(destination, src.lstrip("/"))) for src in large_list
+    )
+    index_path = os.path.join(destination, bundle_index_filename(path_list))
+    with open(index_path, "w") as fh:
+        json.dump({"bundles": bundle_idx, "files": [r["src"] for r in copy_list]}, fh)
+
+    LOG.info(
+        "bundled %s small files into %s bundles, %s large files copied",
+        sum(map(len, bundle_idx.values())),
+        len(bundle_idx),
+        len(copy_list),
+    )
+    results = [os.path.join(destination, name) for name in sorted(bundle_idx)]
+    results.extend(r["dest"] for r in copy_list)
+    results.append(index_path)
+    return {"output_dir": destination, "output": results}
 
 
 def backup(path_list, destination, opts):
@@ -53,36 +179,143 @@ def backup(path_list, destination, opts):
     to new destination, ignoring the common parents'"""
     LOG.info("backing up given paths at %r" % (path_list,))
 
-    new_path_list = wrangle_files(path_list)
+    if opts.get("incremental"):
+        if opts.get("bundle"):
+            LOG.warning("incremental backups are not bundled, ignoring 'bundle'")
+        return _incremental_backup(path_list, destination, opts)
+
+    # the indices of other kinds of backup no longer describe the backup
+    for stale_index in [manifest_filename(path_list), bundle_index_filename(path_list)]:
+        stale_index = os.path.join(destination, stale_index)
+        if os.path.exists(stale_index):
+            os.unlink(stale_index)
+
+    if opts.get("bundle"):
+        return _bundled_backup(path_list, destination, opts)
+
+    # files are copied as they are found
+    new_path_list = iter_files(path_list)
     utils.mkdir_p(destination)
 
-    # assumes all paths exist and are file and valid etc etc
-    results = []
-    for src in new_path_list:
-        dest = os.path.join(destination, src.lstrip("/"))
-        results.append(copy_file(src, dest))
+    copy_list = copier.copy_files(
+        (src, os.path.join(destination, src.lstrip("/"))) for src in new_path_list
+    )
+    results = [result["dest"] for result in copy_list]
     return {"output_dir": destination, "output": results}
 
 
-def _restore(path, backup_dir):
-    LOG.debug("received path %s and input dir %s", path, backup_dir)
-    data = {
-        "backup_src": os.path.join(backup_dir, path.lstrip("/")),
-        "broken_dest": path,
-    }
-    LOG.info("restoring files at %r" % path)
-    cmd = "rsync %(backup_src)s %(broken_dest)s" % data
-    retcode = utils.system(cmd)
-    return (path, retcode == 0)
+def _restore(path_list, backup_dir, hardlink=False):
+    """copies the files matching each path in `path_list` from the `backup_dir` back to where they came from.
+    the files are copied together in a single batch.
+    returns a list of `(path, success)` for each file, or for each path that matched nothing.
+    """
+    path_list, options = discovery.split_options(path_list)
+    # excluded paths are relative to the backup dir, size and age have no meaning for copies
+    exclude_list = [
+        "exclude=" + os.path.join(backup_dir, path.lstrip("/"))
+        for path in options["exclude"]
+    ]
+    results = []
+    pairs = []
+    for path in path_list:
+        LOG.info("restoring files at %r" % path)
+        backup_path = os.path.join(backup_dir, path.lstrip("/"))
+        found = False
+        # paths missing from the backup are reported below as having nothing to restore
+        for src in discovery.find_files(
+            [backup_path] + exclude_list, report_missing=False
+        ):
+            found = True
+            pairs.append((src, "/" + os.path.relpath(src, backup_dir)))
+        if not found:
+            LOG.error("nothing to restore for %r in %r", path, backup_dir)
+            results.append((path, False))
+
+    copied = set(
+        result["dest"] for result in copier.copy_files(pairs, hardlink=hardlink)
+    )
+    results.extend((dest, dest in copied) for _, dest in pairs)
+    return results
+
+
+def _restore_manifest(manifest, backup_dir, hardlink=False):
+    """copies every file in the `manifest` from the `backup_dir` back to where it came from.
+    files that haven't changed since the backup are left alone."""
+    results = {}
+    pairs = []
+    for path, state in sorted(manifest["files"].items()):
+        src = os.path.join(backup_dir, path.lstrip("/"))
+        if not os.path.isfile(src):
+            LOG.error("file %r is missing from backup %r", path, backup_dir)
+            results[path] = False
+            continue
+        current = snapshot.file_state(path) if os.path.isfile(path) else None
+        unchanged = current and all(
+            current[key] == state[key] for key in ["size", "mtime"]
+        )
+        results[path] = True
+        if not unchanged:
+            pairs.append((src, path))
+
+    copied = set(
+        result["dest"] for result in copier.copy_files(pairs, hardlink=hardlink)
+    )
+    for _, path in pairs:
+        if path in copied:
+            mtime = manifest["files"][path]["mtime"]
+            os.utime(path, (mtime, mtime))
+        else:
+            results[path] = False
+    return sorted(results.items())
+
+
+def _restore_bundles(bundle_index, backup_dir, hardlink=False):
+    "extracts every bundle in the `bundle_index` and copies the large files back to where they came from"
+    results = []
+    for name, member_list in sorted(bundle_index["bundles"].items()):
+        bundle_path = os.path.join(backup_dir, name)
+        if not os.path.exists(bundle_path):
+            LOG.error("bundle %r is missing from backup %r", name, backup_dir)
+            results.extend((path, False) for path in member_list)
+            continue
+        extracted = set(archive.extract(bundle_path))
+        results.extend((path, path in extracted) for path in member_list)
+
+    pairs = [
+        (os.path.join(backup_dir, path.lstrip("/")), path)
+        for path in bundle_index["files"]
+    ]
+    copied = set(
+        result["dest"] for result in copier.copy_files(pairs, hardlink=hardlink)
+    )
+    results.extend((path, path in copied) for _, path in pairs)
+    return results
 
 
 def restore(path_list, backup_dir, opts):
-    """how do we restore files? we rsync the target from the input dir.
+    """how do we restore files? we copy the files matching the target from the input dir.
 
     the 'backup_dir' is the dir we read backups from with the given path_list providing further path information
 
-    if the path is "/opt/program/uploaded-files/" and the backup_dir is "/tmp/foo/" than the command looks like:
-    rsync <src> <target>
-    rsync /tmp/foo/opt/program/uploaded-files/ /opt/program/uploaded-files/
+    if the path is "/opt/program/uploaded-files/*.pdf" and the backup_dir is "/tmp/foo/" then the files matching
+    "/tmp/foo/opt/program/uploaded-files/*.pdf" are copied to "/opt/program/uploaded-files/".
+
+    if the backup was incremental, the files in it's manifest are copied from the input dir instead.
+    if the backup was bundled, the bundles in it's bundle index are extracted instead.
+    if the 'hardlink' option is set, files are linked to their backups rather than copied where possible.
     """
-    return {"output": [_restore(p, backup_dir) for p in path_list]}
+    hardlink = opts.get("hardlink")
+    manifest_path = os.path.join(backup_dir, manifest_filename(path_list))
+    if os.path.exists(manifest_path):
+        # an incremental backup, the manifest describes the full set of files
+        LOG.info("restoring files in manifest %r", manifest_path)
+        with open(manifest_path, "r") as fh:
+            return {"output": _restore_manifest(json.load(fh), backup_dir, hardlink)}
+
+    bundle_index_path = os.path.join(backup_dir, bundle_index_filename(path_list))
+    if os.path.exists(bundle_index_path):
+        LOG.info("restoring files in bundle index %r", bundle_index_path)
+        with open(bundle_index_path, "r") as fh:
+            return {"output": _restore_bundles(json.load(fh), backup_dir, hardlink)}
+
+    return {"output": _restore(path_list, backup_dir, hardlink)}
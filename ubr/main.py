@@ -1,21 +1,17 @@
 from pprint import pprint
 import argparse
+import importlib
 import os, sys
 from os.path import join
 import logging
 from ubr.utils import ensure
-from ubr import (
-    conf,
-    utils,
-    s3,
-    rds_target,
-    mysql_target,
-    file_target,
-    tgz_target,
-    psql_target,
-    report,
+from ubr import conf, utils, executor, snapshot
+from ubr.descriptions import (
+    load_descriptor,
+    find_descriptors,
+    project_name,
+    split_selector,
 )
-from ubr.descriptions import load_descriptor, find_descriptors, project_name
 
 LOG = logging.getLogger(__name__)
 
@@ -24,20 +20,27 @@ LOG = logging.getLogger(__name__)
 #
 
 
+# target modules are only imported when a target is dispatched to,
+# a host without databases never imports the database drivers and `s3` isn't imported until it's used.
 KNOWN_TARGET_FNS = [
-    file_target,
-    tgz_target,
-    mysql_target,
-    psql_target,
-    rds_target,
+    "ubr.file_target",
+    "ubr.tgz_target",
+    "ubr.mysql_target",
+    "ubr.psql_target",
+    "ubr.rds_target",
 ]
 TARGET_MAP = dict(zip(conf.KNOWN_TARGETS, KNOWN_TARGET_FNS))
 
 
+def target_module(target):
+    "returns the module for the given target, like 'mysql-database', importing it if necessary"
+    return importlib.import_module(TARGET_MAP[target])
+
+
 def module_dispatch(target, func_name, *args, **kwargs):
     """given a target like 'mysql-database' and a function name like 'restore',
     finds the function in the target module and calls with remaining arguments"""
-    mod = TARGET_MAP[target]
+    mod = target_module(target)
     ensure(
         hasattr(mod, func_name),
         "module %r (%s) has no function %r" % (mod, target, func_name),
@@ -91,12 +94,47 @@ def backup_name(target, path):
     return module_dispatch(target, "backup_name", path)
 
 
+def _backup_all(descriptor_list, opts):
+    """creates backups of the targets of each `(descriptor, output_dir)` in `descriptor_list` concurrently.
+    returns a list of `{target: results}` for each descriptor and the first error encountered, if any.
+    targets that failed have no results."""
+    job_list = [
+        executor.job(
+            "%s:%s" % (output_dir, target),
+            target,
+            module_dispatch,
+            target,
+            "backup",
+            args,
+            output_dir,
+            opts,
+        )
+        for descriptor, output_dir in descriptor_list
+        for target, args in descriptor.items()
+    ]
+    job_results = executor.run(job_list)
+    result_iter = iter(job_results)
+    results = [
+        {target: next(result_iter)["result"] for target in descriptor}
+        for descriptor, _ in descriptor_list
+    ]
+    return results, executor.first_error(job_results)
+
+
+def commit_snapshots(backup_results):
+    "records the state of the incremental backups in `backup_results` now they have been kept, see `snapshot`"
+    for target_results in backup_results.values():
+        if target_results and target_results.get("snapshot"):
+            snapshot.commit(target_results["snapshot"])
+
+
 def backup(descriptor, output_dir, opts):
     "consumes a descriptor and creates backups of each of the target's paths"
-    return {
-        target: module_dispatch(target, "backup", args, output_dir, opts)
-        for target, args in descriptor.items()
-    }
+    results, error = _backup_all([(descriptor, output_dir)], opts)
+    commit_snapshots(results[0])
+    if error:
+        raise error
+    return results[0]
 
 
 def restore(descriptor, backup_dir, opts):
@@ -121,14 +159,34 @@ def backup_to_rds(hostname, path_list, opts):
     ]
 
 
-def backup_to_file(hostname, path_list, opts):
+@print_config
+def prune_rds(hostname, path_list, opts):
+    "deletes the RDS snapshots of this host's instances outside of the retention policy"
     results = []
-    for descriptor_path in find_descriptors(conf.DESCRIPTOR_DIR):
-        descriptor = load_descriptor(descriptor_path, path_list)
+    for path in find_descriptors(conf.DESCRIPTOR_DIR):
+        descriptor = load_descriptor(path, path_list)
+        if "rds-snapshot" in descriptor:
+            results.append(
+                target_module("rds-snapshot").prune(descriptor["rds-snapshot"], opts)
+            )
+    return results
+
+
+def backup_to_file(hostname, path_list, opts):
+    descriptor_list = [
         # ll: /tmp/project-name/hostname/somefile.tar.gz
         # ll: /tmp/civicrm/crm--prod/archive-5ea4f412.tar.gz
-        backupdir = machinedir(hostname, descriptor_path)
-        results.append(backup(descriptor, backupdir, opts))
+        (
+            load_descriptor(descriptor_path, path_list),
+            machinedir(hostname, descriptor_path),
+        )
+        for descriptor_path in find_descriptors(conf.DESCRIPTOR_DIR)
+    ]
+    results, error = _backup_all(descriptor_list, opts)
+    for backup_results in results:
+        commit_snapshots(backup_results)
+    if error:
+        raise error
     return results
 
 
@@ -152,28 +210,74 @@ def restore_from_file(hostname, path_list, opts):
 
 def backup_to_s3(hostname, path_list, opts):
     "creates backups using descriptors and then uploads to s3"
+    from ubr import s3
+
     LOG.info("backing up ...")
-    results = []
-    for descriptor_path in find_descriptors(conf.DESCRIPTOR_DIR):
-        project = project_name(descriptor_path)
-        backupdir = machinedir(hostname, descriptor_path)
-        backup_results = backup(
-            load_descriptor(descriptor_path, path_list), backupdir, opts
+    descriptor_path_list = list(find_descriptors(conf.DESCRIPTOR_DIR))
+    descriptor_list = [
+        (
+            load_descriptor(descriptor_path, path_list),
+            machinedir(hostname, descriptor_path),
         )
+        for descriptor_path in descriptor_path_list
+    ]
+    backup_results_list, error = _backup_all(descriptor_list, opts)
 
+    # the targets that were backed up successfully are uploaded, even if others failed
+    results = []
+    for descriptor_path, backup_results in zip(
+        descriptor_path_list, backup_results_list
+    ):
         remove_backup_after_upload = True
         results.append(
             s3.upload_backup(
                 conf.BUCKET,
                 backup_results,
-                project,
+                project_name(descriptor_path),
                 utils.hostname(),
                 remove_backup_after_upload,
             )
         )
+        # an incremental backup that failed to upload is taken again next time
+        commit_snapshots(backup_results)
+    if error:
+        raise error
     return results
 
 
+def download_target(
+    hostname, project, target, remote_path_list, download_dir, path_list
+):
+    "downloads the latest backup of a descriptor's `target` into `download_dir`"
+    from ubr import s3
+
+    utils.mkdir_p(download_dir)
+    if target == "files":
+        # the files of a 'files' backup are uploaded individually, see `s3.s3_files_key`
+        return s3.download_files_backup(download_dir, conf.BUCKET, project, hostname)
+
+    # explicit paths specified, download exactly what was requested
+    if path_list:
+        results = []
+        for path in remote_path_list:
+            # 'mydb:public.articles' => 'mydb'
+            path, _ = split_selector(target, path)
+            if target in ["mysql-database", "postgresql-database"]:
+                # databases are uploaded under their backup name: 'mydb' => 'mydb-psql.gz'
+                path = backup_name(target, path)
+            results.extend(
+                s3.download_latest_backup(
+                    download_dir, conf.BUCKET, project, hostname, target, path
+                )
+            )
+        return results
+
+    # no paths specified, download all paths for hostname+target
+    return s3.download_latest_backup(
+        download_dir, conf.BUCKET, project, hostname, target
+    )
+
+
 def download_from_s3(hostname, path_list, opts):
     """by specifying a different hostname, you can download a backup
     from a different machine. Of course you will need that other
@@ -185,7 +289,6 @@ def download_from_s3(hostname, path_list, opts):
         project = project_name(descriptor_path)
         descriptor = load_descriptor(descriptor_path, path_list)
         download_dir = machinedir(hostname, descriptor_path)
-        utils.mkdir_p(download_dir)
 
         # above path_list narrows descriptor down
         # BUT! if path_list is None, the current descriptor will be read in.
@@ -196,32 +299,213 @@ def download_from_s3(hostname, path_list, opts):
         # 'prod--lax.elifesciences.org' is specified without paths
 
         for target, remote_path_list in descriptor.items():
-            # explicit paths specified, download exactly what was requested
-            if path_list:
-                for path in remote_path_list:
-                    s3.download_latest_backup(
-                        download_dir, conf.BUCKET, project, hostname, target, path
-                    )
-            else:
-                # no paths specified, download all paths for hostname+target
-                s3.download_latest_backup(
-                    download_dir, conf.BUCKET, project, hostname, target
-                )
+            download_target(
+                hostname, project, target, remote_path_list, download_dir, path_list
+            )
 
         results.append((descriptor, download_dir))
 
     return results
 
 
+def restore_members_from_s3(hostname, path_list, opts):
+    """restores just the files matching the 'restore_only' patterns from the latest 'tar-gzipped' archives.
+    the archives are read in parts directly from s3 using their index, nothing else is downloaded.
+    the latest copy of each file is restored from the latest full archive or any of it's increments.
+    """
+    from ubr import s3
+
+    patterns = opts["restore_only"]
+    target = "tar-gzipped"
+    results = []
+    for descriptor_path in find_descriptors(conf.DESCRIPTOR_DIR):
+        project = project_name(descriptor_path)
+        descriptor = load_descriptor(descriptor_path, path_list)
+        result = {}
+        for other_target in set(descriptor) - set([target]):
+            LOG.warning(
+                "skipping %r, only %r targets can be partially restored",
+                other_target,
+                target,
+            )
+        if target in descriptor:
+            filename = target_module("tar-gzipped").filename_for_paths(
+                descriptor[target]
+            )
+            backup_list = s3.latest_archive_set(
+                conf.BUCKET, project, hostname, filename
+            )
+            if [name for name, _ in backup_list] == [filename + ".tar.gz"]:
+                [(_, key)] = backup_list
+                increment_list = s3.latest_increments(
+                    conf.BUCKET, project, hostname, filename, key
+                )
+                restored = s3.restore_chain_members(
+                    conf.BUCKET, key, increment_list, patterns
+                )
+            else:
+                # a set of archives has no increments
+                restored = [
+                    path
+                    for _, key in backup_list
+                    for path in s3.restore_archive_members(conf.BUCKET, key, patterns)
+                ]
+            result[target] = {"output": [(path, True) for path in restored]}
+        results.append(result)
+    return results
+
+
+def stream_keys(hostname, project, target, remote_path_list, opts):
+    """returns a list of `(path, key)` of the backups to stream to restore a descriptor's `target`.
+    returns `None` if the target can't be streamed:
+    'files' targets, incremental or sharded 'tar-gzipped' targets, MySQL databases and databases restored by table.
+    """
+    from ubr import s3
+
+    if target == "mysql-database":
+        # a MySQL dump is loaded a statement at a time and each is committed as it's loaded.
+        # a stream that fails it's ETag check at the end would leave a partially loaded database.
+        return None
+
+    if target == "postgresql-database":
+        # streamed databases are always loaded into a shadow database, see `psql_target.restore_stream`
+        results = []
+        for path in remote_path_list:
+            path, selector = split_selector(target, path)
+            if selector:
+                return None
+            backupname = backup_name(target, path)
+            backup_list = s3.latest_backups(
+                conf.BUCKET, project, hostname, target, backupname
+            )
+            ensure(backup_list, "no backup %r found to stream" % backupname)
+            results.append((path, backup_list[0][1]))
+        return results
+
+    if target == "tar-gzipped":
+        filename = target_module("tar-gzipped").filename_for_paths(remote_path_list)
+        archive_set = s3.latest_archive_set(conf.BUCKET, project, hostname, filename)
+        if [name for name, _ in archive_set] != [filename + ".tar.gz"]:
+            return None
+        _, key = archive_set[0]
+        if s3.latest_increments(conf.BUCKET, project, hostname, filename, key):
+            return None
+        return [(filename, key)]
+
+    return None
+
+
+def stream_target(
+    hostname, project, target, remote_path_list, download_dir, path_list, opts
+):
+    """restores the latest backup of a descriptor's `target` straight from s3 as it's downloaded.
+    nothing is written to the working directory.
+    targets that can't be streamed are downloaded and restored as usual, see `stream_keys`.
+    """
+    from ubr import s3
+
+    key_list = stream_keys(hostname, project, target, remote_path_list, opts)
+    if key_list is None:
+        LOG.info("%r can't be streamed, downloading it first", target)
+        download_target(
+            hostname, project, target, remote_path_list, download_dir, path_list
+        )
+        return module_dispatch(target, "restore", remote_path_list, download_dir, opts)
+
+    if target == "tar-gzipped":
+        [(_, key)] = key_list
+        with s3.open_stream(conf.BUCKET, key) as stream:
+            return target_module("tar-gzipped").restore_stream(
+                remote_path_list, stream, opts
+            )
+
+    output = []
+    for path, key in key_list:
+        with s3.open_stream(conf.BUCKET, key) as stream:
+            output.append(module_dispatch(target, "restore_stream", path, stream, opts))
+    return {"output": output}
+
+
+def report_restore_times(job_results):
+    "logs how long each target took to download and restore"
+    for result in job_results:
+        times = ", ".join(
+            "%s in %.1fs" % (step["name"].rsplit(":", 1)[-1], step["duration"])
+            for step in result["steps"]
+        )
+        status = "failed" if result["error"] else "succeeded"
+        LOG.info("%s %s: %s", result["name"].rsplit(":", 1)[0], status, times)
+
+
 def restore_from_s3(hostname, path_list, opts):
-    "same as the download action, but then restores the files/databases/whatever to where they came from"
-    # download everything first ...
-    results = download_from_s3(hostname, path_list, opts)
-    # ll: [({'postgresql-database': ['laxbackfilltest']}, u'/tmp/ubr/lax/prod--lax.elifesciences.org')]
-    # ... then restore
-    return [
-        restore(descriptor, download_dir, opts) for descriptor, download_dir in results
+    """same as the download action, but then restores the files/databases/whatever to where they came from.
+    each target is restored as soon as it has been downloaded, see `executor`."""
+    if opts.get("restore_only"):
+        return restore_members_from_s3(hostname, path_list, opts)
+    descriptor_list = []
+    job_list = []
+    for descriptor_path in find_descriptors(conf.DESCRIPTOR_DIR):
+        project = project_name(descriptor_path)
+        descriptor = load_descriptor(descriptor_path, path_list)
+        download_dir = machinedir(hostname, descriptor_path)
+        descriptor_list.append(descriptor)
+        for target, args in descriptor.items():
+            # ll: '/tmp/ubr/lax/prod--lax.elifesciences.org:postgresql-database:download'
+            name = "%s:%s" % (download_dir, target)
+            if opts.get("stream"):
+                job_list.append(
+                    executor.job(
+                        name + ":stream",
+                        target,
+                        stream_target,
+                        hostname,
+                        project,
+                        target,
+                        args,
+                        download_dir,
+                        path_list,
+                        opts,
+                    )
+                )
+                continue
+            job_list.append(
+                executor.chain(
+                    executor.job(
+                        name + ":download",
+                        "s3",
+                        download_target,
+                        hostname,
+                        project,
+                        target,
+                        args,
+                        download_dir,
+                        path_list,
+                    ),
+                    executor.job(
+                        name + ":restore",
+                        target,
+                        module_dispatch,
+                        target,
+                        "restore",
+                        args,
+                        download_dir,
+                        opts,
+                    ),
+                )
+            )
+    job_results = executor.run(job_list, limits=conf.RESTORE_JOB_LIMITS)
+    report_restore_times(job_results)
+
+    # ll: [{'postgresql-database': {'output': [('laxbackfilltest', True)]}}]
+    result_iter = iter(job_results)
+    results = [
+        {target: next(result_iter)["result"] for target in descriptor}
+        for descriptor in descriptor_list
     ]
+    error = executor.first_error(job_results)
+    if error:
+        raise error
+    return results
 
 
 #
@@ -231,6 +515,7 @@ def restore_from_s3(hostname, path_list, opts):
 
 def adhoc_s3_download(path_list, opts):
     "connect to s3 and download stuff :)"
+    from ubr import s3, transfer
 
     def download(remote_path):
         try:
@@ -240,39 +525,93 @@ def adhoc_s3_download(path_list, opts):
         except AssertionError as err:
             LOG.warning(err)
 
-    return list(map(download, path_list))
+    return transfer.manager().map(download, path_list)
+
+
+def adhoc_s3_restore(path_list, opts):
+    """restores files from an archive in s3 without downloading the whole archive.
+    the first path is the key of the archive, the rest are patterns of files within the archive to restore.
+    """
+    from ubr import s3
+
+    key, patterns = path_list[0], path_list[1:]
+    return s3.restore_archive_members(conf.BUCKET, key.lstrip("/"), patterns)
+
+
+def _adhoc_file_restore(source_file, target, path, opts):
+    # wish this worked, but the source file could have any sort of filename:
+    # descriptor = {target: [path]} # ll: {'mysql-database': ['somedb']}
+    # restore(descriptor, os.path.dirname(source_file))
+
+    swap = opts.get("restore_mode") == "swap"
+    if target == "mysql-database":
+        mysql_target = target_module(target)
+        if swap:
+            return mysql_target.swap_load(path, source_file)
+        return mysql_target.load(path, source_file, dropdb=True)
+    if target == "postgresql-database":
+        psql_target = target_module(target)
+        dbname, table_list = psql_target.parse_path(path)
+        if table_list:
+            return psql_target.load_tables(dbname, source_file, table_list)
+        fast = opts.get("fast_restore")
+        if swap:
+            return psql_target.swap_load(dbname, source_file, fast=fast)
+        return psql_target.load(dbname, source_file, dropdb=True, fast=fast)
 
 
 def adhoc_file_restore(path_list, opts):
+    """restores each database from the file paired with it in `path_list`.
+    independent databases are restored concurrently, see `executor`."""
+    job_list = []
     for source_file, descriptor_str in utils.pairwise(path_list):
         # descriptor_str looks like: 'mysql-database.somedb'
         # exactly like a single entry in a descriptor file
         target, path = descriptor_str.split(".", 1)  # ll: mysql-database, somedb
-
-        # wish this worked, but the source file could have any sort of filename:
-        # descriptor = {target: [path]} # ll: {'mysql-database': ['somedb']}
-        # restore(descriptor, os.path.dirname(source_file))
-
-        if target == "mysql-database":
-            mysql_target.load(path, source_file, dropdb=True)
-        elif target == "postgresql-database":
-            psql_target.load(path, source_file, dropdb=True)
-        else:
+        if target not in ["mysql-database", "postgresql-database"]:
             message = "only adhoc *database* restores (mysql and postgresql) are currently handled, not %r"
             LOG.error(message, target)
             raise RuntimeError(message % target)
+        job_list.append(
+            executor.job(
+                "adhoc:%s" % descriptor_str,
+                target,
+                _adhoc_file_restore,
+                source_file,
+                target,
+                path,
+                opts,
+            )
+        )
+    job_results = executor.run(job_list, limits=conf.RESTORE_JOB_LIMITS)
+    report_restore_times(job_results)
+    error = executor.first_error(job_results)
+    if error:
+        raise error
+    return [result["result"] for result in job_results]
 
 
 # checks
 
 
+def find(hostname, pattern_list):
+    "find the backups of files matching `pattern_list` on this host"
+    from ubr import report
+
+    return report.find(hostname, pattern_list)
+
+
 def check(hostname, path_list=None):
     "test this host's backup is happening"
+    from ubr import report
+
     return report.check(hostname, path_list)
 
 
 def check_all():
     "test *all* hosts backups are happening"
+    from ubr import report
+
     return report.check_all()
 
 
@@ -289,7 +628,16 @@ def _parseargs(args):
         "--action",
         nargs="?",
         default="backup",
-        choices=["config", "check", "check-all", "backup", "restore", "download"],
+        choices=[
+            "config",
+            "check",
+            "check-all",
+            "find",
+            "backup",
+            "restore",
+            "download",
+            "prune",
+        ],
     )
     parser.add_argument(
         "--location",
@@ -309,7 +657,91 @@ def _parseargs(args):
         "--paths",
         nargs="*",
         default=[],
-        help="partial backup/restore using specific targets. for example: 'mysql-database.mydb1'",
+        help="partial backup/restore using specific targets. for example: 'mysql-database.mydb1' or 'postgresql-database.mydb2:public.articles'",
+    )
+
+    parser.add_argument(
+        "--fast-restore",
+        action="store_true",
+        default=conf.DEFAULT_CLI_OPTS["fast_restore"],
+        help="restore PostgreSQL databases in a single transaction tuned for bulk loading",
+    )
+
+    parser.add_argument(
+        "--restore-mode",
+        default=conf.DEFAULT_CLI_OPTS["restore_mode"],
+        choices=["drop", "swap"],
+        help="'swap' restores databases into a shadow database and then swaps it with the live one",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=conf.DEFAULT_CLI_OPTS["incremental"],
+        help="only backup files in 'files' and 'tar-gzipped' targets that have changed since the previous backup",
+    )
+    parser.add_argument(
+        "--full-every",
+        type=int,
+        default=conf.DEFAULT_CLI_OPTS["full_every"],
+        help="with --incremental, every Nth backup is a full backup",
+    )
+
+    parser.add_argument(
+        "--no-index",
+        action="store_false",
+        dest="index",
+        default=conf.DEFAULT_CLI_OPTS["index"],
+        help="don't write an index of the files in 'tar-gzipped' archives. files in unindexed archives can't be found or restored individually",
+    )
+    parser.add_argument(
+        "--bundle",
+        action="store_true",
+        default=conf.DEFAULT_CLI_OPTS["bundle"],
+        help="pack the small files of 'files' targets into bundles, uploaded and restored as a whole",
+    )
+    parser.add_argument(
+        "--hardlink",
+        action="store_true",
+        default=conf.DEFAULT_CLI_OPTS["hardlink"],
+        help="restore 'files' targets as hardlinks to their backups where possible. the restored files share their contents with the backup",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=conf.DEFAULT_CLI_OPTS["shards"],
+        help="split 'tar-gzipped' targets into this many archives, written, uploaded and restored in parallel",
+    )
+    parser.add_argument(
+        "--restore-only",
+        nargs="*",
+        default=conf.DEFAULT_CLI_OPTS["restore_only"],
+        metavar="PATTERN",
+        help="only restore files in 'tar-gzipped' targets matching these patterns or within these directories. for example: '/opt/app/uploads/*.pdf'",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=conf.DEFAULT_CLI_OPTS["stream"],
+        help="restore databases and 'tar-gzipped' targets from s3 as they are downloaded, without writing them to disk first",
+    )
+    parser.add_argument(
+        "--keep",
+        type=int,
+        default=conf.DEFAULT_CLI_OPTS["keep"],
+        help="when pruning RDS snapshots, always keep this many of the most recent snapshots of each instance",
+    )
+    parser.add_argument(
+        "--keep-days",
+        type=int,
+        default=conf.DEFAULT_CLI_OPTS["keep_days"],
+        help="when pruning RDS snapshots, always keep snapshots younger than this many days",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        default=conf.DEFAULT_CLI_OPTS["dry_run"],
+        help="when pruning RDS snapshots, just report the snapshots that would be deleted",
     )
 
     # todo: remove once all instances of this are removed
@@ -337,6 +769,19 @@ def parseargs(args):
                     "an even number of paths is required: [source, target, source, target], etc"
                 )
 
+        if args.action == "restore" and args.location == "s3":
+            # adhoc partial restore of an archive
+            if len(args.paths) < 2:
+                parser.error(
+                    "an archive and at least one pattern is required: [archive, pattern, pattern], etc"
+                )
+
+    if args.action == "find" and not args.paths:
+        parser.error("'find' requires at least one path or pattern to search for")
+
+    if args.action == "prune" and args.location != "rds-snapshot":
+        parser.error("you can only 'prune' when location is 'rds-snapshot'")
+
     if args.action == "restore" and args.location == "rds-snapshot":
         parser.error("you cannot restore an RDS snapshot using UBR.")
 
@@ -344,7 +789,7 @@ def parseargs(args):
         getattr(args, key, None) for key in ["action", "location", "hostname", "paths"]
     ]
 
-    opts = {}
+    opts = {key: getattr(args, key) for key in conf.DEFAULT_CLI_OPTS}
 
     return cmd, opts
 
@@ -357,6 +802,7 @@ def config():
 
 
 def main(args):
+    conf.setup()
     cmd, opts = parseargs(args)
     action, fromloc, hostname, paths = cmd
 
@@ -370,12 +816,16 @@ def main(args):
     if action == "check-all":
         exit(len(check_all()))
 
+    if action == "find":
+        exit(0 if find(hostname, paths) else 1)
+
     if hostname == "adhoc":
         # only a subset of actions available for adhoc locations
         decisions = {
             # ("upload", "s3"): ... # todo: adhoc file uploads to s3 backups bucket would be handy
             ("download", "s3"): adhoc_s3_download,
             ("restore", "file"): adhoc_file_restore,
+            ("restore", "s3"): adhoc_s3_restore,
         }
         return decisions[(action, fromloc)](paths, opts)
 
@@ -387,6 +837,7 @@ def main(args):
         },
         "restore": {"s3": restore_from_s3, "file": restore_from_file},
         "download": {"s3": download_from_s3},
+        "prune": {"rds-snapshot": prune_rds},
     }
 
     return decisions[action][fromloc](hostname, paths, opts)
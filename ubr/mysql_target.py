@@ -1,5 +1,5 @@
 import os, copy
-from ubr import utils, conf
+from ubr import utils, conf, pipeline
 from ubr.utils import ensure
 import pymysql.cursors
 import logging
@@ -64,16 +64,24 @@ def dbexists(db):
     )
 
 
+def mysql_cmd(args, program="mysql"):
+    "returns the arguments common to the mysql commands for the given connection `args`"
+    return [
+        program,
+        "-u",
+        args["user"],
+        "-p%s" % args["pass"],
+        "-h",
+        args["host"],
+        "-P",
+        str(args["port"]),
+    ]
+
+
 def mysql_cli_cmd(mysqlcmd, **kwargs):
-    "runs very simple commands from the command line against mysql. doesn't handle quoting at all. totally insecure."
-    args = defaults(mysqlcmd=mysqlcmd, **kwargs)
-    cmd = """mysql \
-    -u %(user)s \
-    -p%(pass)s \
-    -h %(host)s \
-    -P %(port)s \
-    -e '%(mysqlcmd)s'""" % args
-    return utils.system(cmd)
+    "runs very simple commands from the command line against mysql, returning the return code"
+    args = defaults(**kwargs)
+    return pipeline.run([mysql_cmd(args) + ["-e", mysqlcmd]])["returncode"]
 
 
 def drop(db, **kwargs):
@@ -104,23 +112,87 @@ def load(db, dump_path, dropdb=False, **kwargs):
         )
         LOG.debug("passed assertion check!")
 
-    cmd = """mysql \
-    -u %(user)s \
-    -p%(pass)s \
-    -h %(host)s \
-    -P %(port)s \
-    %(dbname)s < %(path)s""" % args
-
+    cmd = mysql_cmd(args) + [args["dbname"]]
     if dump_path.endswith(".gz"):
         LOG.debug("dealing with a gzipped file")
-        cmd = """zcat %(path)s | mysql \
-        -u %(user)s \
-        -p%(pass)s \
-        -h %(host)s \
-        -P %(port)s \
-        %(dbname)s""" % args
+        return pipeline.run([["gunzip", "-c", dump_path], cmd])["ok"]
+    return pipeline.run([cmd], stdin=dump_path)["ok"]
+
+
+#
+# shadow restores
+# a backup is loaded into a shadow database and it's tables are swapped with the live database's
+# once loaded. the live database stays available for the duration of the load.
+#
+
+SHADOW_SUFFIX = "__ubr_restore"
+RETIRED_SUFFIX = "__ubr_old"
+
+
+def shadow_name(db):
+    return db + SHADOW_SUFFIX
+
+
+def table_list(db):
+    "returns a list of the names of the base tables in `db`"
+    sql = """SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES
+    WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE'"""
+    return [row["TABLE_NAME"] for row in fetchall(None, sql, [db])]
+
+
+def _ident(db, table):
+    "quotes the given database and table for use in a SQL statement"
+    return "`%s`.`%s`" % (db.replace("`", "``"), table.replace("`", "``"))
 
-    return utils.system(cmd) == 0
+
+def swap_sql(db, shadow, retired, live_tables, shadow_tables):
+    """returns a single `RENAME TABLE` statement that moves the `live_tables` in `db` into `retired`
+    and the `shadow_tables` in `shadow` into `db`. a `RENAME TABLE` statement is atomic,
+    other sessions see either all of the old tables or all of the new tables."""
+    pairs = [(_ident(db, t), _ident(retired, t)) for t in live_tables]
+    pairs += [(_ident(shadow, t), _ident(db, t)) for t in shadow_tables]
+    return "RENAME TABLE " + ", ".join("%s TO %s" % pair for pair in pairs)
+
+
+def swap_load(db, dump_path, **kwargs):
+    """loads `dump_path` into a shadow database and, if successful, swaps it's tables with those in `db`.
+    the live database is only unavailable for the duration of the swap.
+
+    only tables are swapped. views, triggers and routines are not supported by a
+    cross-database `RENAME TABLE` and the swap will fail, leaving the live database untouched.
+    """
+    shadow = shadow_name(db)
+    retired = db + RETIRED_SUFFIX
+    msg = "failed to drop+create the shadow database %r prior to loading fixture."
+    ensure(
+        all(
+            [
+                drop(shadow, **kwargs),
+                create(shadow, **kwargs),
+                drop(retired, **kwargs),
+                create(retired, **kwargs),
+                create(db, **kwargs),
+            ]
+        ),
+        msg % shadow,
+    )
+    try:
+        LOG.info("loading %r into shadow database %r", dump_path, shadow)
+        ensure(
+            load(shadow, dump_path, **kwargs),
+            "failed to load %r into shadow database %r" % (dump_path, shadow),
+        )
+        shadow_tables = table_list(shadow)
+        ensure(
+            shadow_tables,
+            "shadow database %r has no tables after loading %r" % (shadow, dump_path),
+        )
+        LOG.info("swapping shadow database %r with %r", shadow, db)
+        mysql_query(None, swap_sql(db, shadow, retired, table_list(db), shadow_tables))
+    finally:
+        drop(shadow, **kwargs)
+        drop(retired, **kwargs)
+    return True
 
 
 def backup_name(db):
@@ -169,18 +241,14 @@ def dump(db, output_path, **kwargs):
     # https://console.aws.amazon.com/rds/home?region=us-east-1#parameter-groups-detail:ids=default.mysql5.7;type=DbParameterGroup;editing=false
     # Moreover, when we are restoring we are not even interested in GTIDs as we are dropping the database first.
     # If GTIDs were enables, and we were to restore a slave node to bring it on par with master, we could use them. Unlikely use case as replication is always managed by RDS.
-    cmd = """set -o pipefail
-    mysqldump \
-    --column-statistics=0 \
-    -u %(user)s \
-    -h %(host)s \
-    -P %(port)s \
-    -p%(pass)s \
-    --single-transaction \
-    --skip-dump-date \
-    --set-gtid-purged=OFF \
-    %(dbname)s | gzip > %(path)s""" % args
-    retval = utils.system(cmd)
+    cmd = mysql_cmd(args, "mysqldump") + [
+        "--column-statistics=0",
+        "--single-transaction",
+        "--skip-dump-date",
+        "--set-gtid-purged=OFF",
+        args["dbname"],
+    ]
+    retval = pipeline.run([cmd, ["gzip"]], stdout=output_path)["returncode"]
     if not retval == 0:
         # not the best error to be throwing. perhaps a CommandError ?
         raise OSError("bad dump. got return value %s" % retval)
@@ -203,26 +271,23 @@ def _backup(path, destination):
 
 def backup(path_list, destination, opts):
     "dumps a list of databases and database tables"
-    retval = utils.system("mkdir -p %s" % destination)
-    if not retval == 0:
-        # check to see if our intention is there
-        ensure(
-            os.path.isdir(destination),
-            "given destination %r is not a directory or doesn't exist!" % destination,
-        )
+    utils.mkdir_p(destination)
     return {
         "output_dir": destination,
         "output": [_backup(p, destination) for p in path_list],
     }
 
 
-def _restore(db, backup_dir):
+def _restore(db, backup_dir, opts):
     try:
         dump_path = os.path.join(backup_dir, backup_name(db))
         ensure(
             os.path.isfile(dump_path),
             "expected path %r does not exist or is not a file." % dump_path,
         )
+        if opts.get("restore_mode") == "swap":
+            LOG.info("restoring MySQL database %r using a shadow database" % db)
+            return (db, swap_load(db, dump_path))
         LOG.info("restoring MySQL database %r" % db)
         return (db, load(db, dump_path, dropdb=True))
     except Exception:
@@ -232,4 +297,4 @@ def _restore(db, backup_dir):
 
 
 def restore(db_list, backup_dir, opts):
-    return {"output": [_restore(db, backup_dir) for db in db_list]}
+    return {"output": [_restore(db, backup_dir, opts) for db in db_list]}
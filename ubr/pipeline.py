@@ -0,0 +1,328 @@
+import os, errno, signal, threading, time, subprocess
+from collections import deque
+from ubr.utils import ensure
+from ubr.conf import logging
+
+LOG = logging.getLogger(__name__)
+
+#
+# command pipelines
+# external commands are run directly, without a shell, with the output of each piped into the next:
+#   run([["mysqldump", "mydb"], ["gzip"]], stdout="/tmp/ubr/mydb-mysql.gz")
+# is `mysqldump mydb | gzip > /tmp/ubr/mydb-mysql.gz` with `set -o pipefail`.
+#
+# - a pipeline fails if any of it's commands fail
+# - what each command writes to stderr is logged a line at a time as it's written.
+#   the output of the last command is logged too, if it isn't going anywhere else.
+# - a pipeline can be given a timeout and be cancelled, it's commands are killed.
+# - the bytes each command writes and the CPU time it uses are logged once finished,
+#   the command doing the most work is the bottleneck.
+#
+# the output of each command is moved into the next by a thread using `splice(2)` where possible,
+# without passing through python. no more than a line or a block of output is held in memory at once.
+#
+
+CHUNK_SIZE = 2**20  # 1MiB
+MAX_LINE_LENGTH = 4096  # longer lines are logged in pieces
+STDERR_TAIL = 10  # the number of lines of stderr kept to explain a failure
+POLL_INTERVAL = 0.1  # seconds, how often timeouts and cancellation are checked
+
+# the return code of a command that couldn't be started, like a shell
+NOT_FOUND = 127
+
+
+def _pump(src_fd, dest_fd, stage):
+    "moves everything read from `src_fd` to `dest_fd`, counting the bytes moved against `stage`"
+    use_splice = hasattr(os, "splice")
+    while True:
+        try:
+            if use_splice:
+                num_bytes = os.splice(src_fd, dest_fd, CHUNK_SIZE)
+            else:
+                data = os.read(src_fd, CHUNK_SIZE)
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(dest_fd, view) :]
+                num_bytes = len(data)
+        except BrokenPipeError:
+            # whatever was reading has gone away, the command writing will get a SIGPIPE
+            return
+        except OSError as err:
+            if use_splice and err.errno in (errno.EINVAL, errno.ENOSYS):
+                # neither end is a pipe or the filesystem doesn't support it
+                use_splice = False
+                continue
+            raise
+        if not num_bytes:
+            return
+        stage["bytes"] += num_bytes
+
+
+def _lines(fh, stage, fn):
+    "calls `fn` with each line read from `fh`, counting the bytes read against `stage`"
+    for line in iter(lambda: fh.readline(MAX_LINE_LENGTH), b""):
+        stage["bytes"] += len(line)
+        fn(line.decode(errors="replace").rstrip("\n"))
+
+
+def _feed(src, dest_fd):
+    "writes everything read from the file-like `src` to `dest_fd`"
+    try:
+        while True:
+            data = src.read(CHUNK_SIZE)
+            if not data:
+                return
+            view = memoryview(data)
+            while view:
+                view = view[os.write(dest_fd, view) :]
+    except BrokenPipeError:
+        # the command died early, it's return code tells us what happened
+        pass
+
+
+def _close(fh):
+    try:
+        fh.close()
+    except OSError:
+        pass
+
+
+class Pipeline:
+    "the commands of a single pipeline, see `run`"
+
+    def __init__(self, cmd_list, env=None):
+        self.cmd_list = cmd_list
+        self.env = dict(os.environ, **env) if env else None
+        self.stages = [
+            {
+                "name": os.path.basename(cmd[0]),
+                "returncode": None,
+                "bytes": 0,
+                "cpu": None,
+                "elapsed": None,
+                "stderr": deque(maxlen=STDERR_TAIL),
+            }
+            for cmd in cmd_list
+        ]
+        self.process_list = []
+        self.thread_list = []
+        # exceptions raised by threads, reading the input for example
+        self.errors = []
+        # held while a process is reaped, so a process isn't killed once it's pid may have been reused
+        self.lock = threading.Lock()
+
+    def thread(self, fn, *args):
+        "calls `fn` with `args` in a new thread. the commands are killed if it fails."
+
+        def _run():
+            try:
+                fn(*args)
+            except BaseException as exc:
+                self.errors.append(exc)
+                self.kill()
+
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        self.thread_list.append(thread)
+        return thread
+
+    def spawn(self, stdin):
+        "starts each command, returning `False` if one couldn't be started"
+        for i, cmd in enumerate(self.cmd_list):
+            start = time.time()
+            try:
+                process = subprocess.Popen(
+                    cmd,
+                    stdin=stdin if i == 0 else subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    env=self.env,
+                )
+            except OSError as err:
+                LOG.error("failed to start %r: %s", self.stages[i]["name"], err)
+                self.stages[i]["returncode"] = NOT_FOUND
+                self.kill()
+                return False
+            process.started = start
+            self.process_list.append(process)
+        return True
+
+    def connect(self, stdin, stdout, stdout_fd):
+        "starts the threads moving data between the commands and logging what they write"
+        process_list, stages = self.process_list, self.stages
+        for process, stage in zip(process_list, stages):
+
+            def log_stderr(line, name=stage["name"], tail=stage["stderr"]):
+                tail.append(line)
+                LOG.warning("%s: %s", name, line)
+
+            # stderr isn't counted as output
+            self.thread(_lines, process.stderr, {"bytes": 0}, log_stderr)
+
+        for process, nxt, stage in zip(process_list, process_list[1:], stages):
+
+            def pump(process=process, nxt=nxt, stage=stage):
+                try:
+                    _pump(process.stdout.fileno(), nxt.stdin.fileno(), stage)
+                finally:
+                    _close(nxt.stdin)
+                    _close(process.stdout)
+
+            self.thread(pump)
+
+        last, stage = process_list[-1], stages[-1]
+        if stdout_fd is not None:
+            self.thread(_pump, last.stdout.fileno(), stdout_fd, stage)
+        elif callable(stdout):
+            self.thread(_lines, last.stdout, stage, stdout)
+        else:
+            self.thread(
+                _lines,
+                last.stdout,
+                stage,
+                lambda line, name=stage["name"]: LOG.info("%s: %s", name, line),
+            )
+
+        if stdin is not None and not isinstance(stdin, str):
+            first = process_list[0]
+
+            def feed():
+                try:
+                    _feed(stdin, first.stdin.fileno())
+                except BaseException:
+                    # the input couldn't be read. the commands are killed before their input is closed,
+                    # so they never see the end of what they were given as the end of the input.
+                    self.kill()
+                    raise
+                finally:
+                    _close(first.stdin)
+
+            self.thread(feed)
+
+    def wait(self, i):
+        "waits for the command `i` to exit, recording it's return code and CPU time"
+        process, stage = self.process_list[i], self.stages[i]
+        # wait without reaping, the process can still be killed safely until it's reaped
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        with self.lock:
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+        stage["returncode"] = process.returncode
+        stage["cpu"] = rusage.ru_utime + rusage.ru_stime
+        stage["elapsed"] = time.time() - process.started
+
+    def kill(self):
+        # not `Popen.kill`, that may reap the process
+        with self.lock:
+            for process in self.process_list:
+                if process.returncode is None:
+                    os.kill(process.pid, signal.SIGKILL)
+
+
+def run(cmd_list, stdin=None, stdout=None, env=None, timeout=None, cancel=None):
+    """runs each command in `cmd_list` with the output of each piped into the next, without a shell.
+    a command is a list of arguments, for example `["gunzip", "--test", path]`.
+
+    `stdin` is the path to a file or a file-like object the first command reads from.
+    `stdout` is the path to a file the last command writes to or a function called with each line it writes.
+    if not given, the first command reads nothing and each line the last command writes is logged.
+    `env` is added to the environment of each command.
+    the commands are killed if they take longer than `timeout` seconds or the `cancel` event is set.
+
+    returns a map of the results, the pipeline succeeded if 'ok' is `True`:
+    `{"ok": ..., "returncode": ..., "error": ..., "elapsed": ..., "stages": [...]}`
+    'returncode' is the return code of the last command to fail, like `set -o pipefail`.
+    'stages' is a list of `{"name": ..., "returncode": ..., "bytes": ..., "cpu": ..., "elapsed": ...}`
+    for each command with the number of bytes it wrote and the CPU time it used.
+    an exception raised reading `stdin` is raised once the commands have been killed.
+    """
+    ensure(cmd_list, "a pipeline needs at least one command")
+    pipeline = Pipeline(cmd_list, env)
+    start = time.time()
+    error = None
+
+    stdin_fh = open(stdin, "rb") if isinstance(stdin, str) else None
+    stdout_fd = None
+    try:
+        if isinstance(stdout, str):
+            stdout_fd = os.open(stdout, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        if stdin_fh:
+            first_stdin = stdin_fh
+        elif stdin is not None:
+            first_stdin = subprocess.PIPE
+        else:
+            first_stdin = subprocess.DEVNULL
+
+        if pipeline.spawn(first_stdin):
+            pipeline.connect(stdin, stdout, stdout_fd)
+        else:
+            error = "failed to start"
+
+        waiter_list = [
+            pipeline.thread(pipeline.wait, i) for i in range(len(pipeline.process_list))
+        ]
+        deadline = start + timeout if timeout else None
+        for waiter in waiter_list:
+            while waiter.is_alive():
+                if cancel is not None and cancel.is_set() and not error:
+                    error = "cancelled"
+                    pipeline.kill()
+                if deadline and time.time() > deadline and not error:
+                    error = "timed out after %ss" % timeout
+                    pipeline.kill()
+                waiter.join(POLL_INTERVAL)
+        for thread in pipeline.thread_list:
+            thread.join()
+    finally:
+        pipeline.kill()
+        for process in pipeline.process_list:
+            for fh in (process.stdin, process.stdout, process.stderr):
+                fh and _close(fh)
+        stdin_fh and stdin_fh.close()
+        stdout_fd is not None and os.close(stdout_fd)
+
+    if pipeline.errors:
+        raise pipeline.errors[0]
+    return _result(pipeline, error, time.time() - start)
+
+
+def _result(pipeline, error, elapsed):
+    stages = pipeline.stages
+    failed = [stage for stage in stages if stage["returncode"]]
+    returncode = failed[-1]["returncode"] if failed else 0
+    if error and not returncode:
+        returncode = -1
+    for stage in failed:
+        LOG.error(
+            "%s failed with return code %s%s",
+            stage["name"],
+            stage["returncode"],
+            (": %s" % stage["stderr"][-1]) if stage["stderr"] else "",
+        )
+    if error:
+        LOG.error("%s %s", " | ".join(stage["name"] for stage in stages), error)
+
+    finished = [stage for stage in stages if stage["cpu"] is not None]
+    if len(finished) > 1:
+        busiest = max(finished, key=lambda stage: stage["cpu"])
+        LOG.info(
+            "%s finished in %.1fs: %s. %s did the most work",
+            " | ".join(stage["name"] for stage in stages),
+            elapsed,
+            ", ".join(
+                "%s wrote %s bytes using %.1fs of CPU"
+                % (stage["name"], stage["bytes"], stage["cpu"])
+                for stage in finished
+            ),
+            busiest["name"],
+        )
+    return {
+        "ok": not failed and not error,
+        "returncode": returncode,
+        "error": error,
+        "elapsed": elapsed,
+        "stages": [
+            {key: val for key, val in stage.items() if key != "stderr"}
+            for stage in stages
+        ],
+    }
@@ -1,6 +1,7 @@
-from ubr import conf, utils
+from ubr import conf, utils, pipeline
 from ubr.utils import ensure
-import os, copy
+from ubr.descriptions import split_selector
+import os, io, re, copy, gzip, time
 from os.path import join
 from ubr.conf import logging
 import pg8000
@@ -15,6 +16,21 @@ def defaults(db=None, **overrides):
     return args
 
 
+def parse_path(path):
+    """a path is a database name with an optional selector of comma-separated tables.
+    a table is either `schema.table`, `table` (in any schema) or `schema.*` (everything in a schema).
+    returns a pair of `(dbname, table_list)` where each table is a pair of `(schema, table)`.
+    `mydb:public.articles,authors` => `("mydb", [("public", "articles"), (None, "authors")])`
+    """
+    dbname, selector = split_selector("postgresql-database", path)
+    table_list = []
+    for table in filter(None, (selector or "").split(",")):
+        schema, _, name = table.strip().rpartition(".")
+        ensure(schema or name != "*", "a '*' selection requires a schema", ValueError)
+        table_list.append((schema or None, None if name == "*" else name))
+    return dbname, table_list
+
+
 def backup_name(dbname):
     "returns the expected name of the dump for the given database"
     if not dbname or type(dbname) not in [str, int]:
@@ -22,40 +38,151 @@ def backup_name(dbname):
     return "%s-psql.gz" % dbname
 
 
+def psql_cmd(program="psql"):
+    "returns the arguments common to the postgresql commands"
+    kwargs = defaults()
+    return [
+        program,
+        "--username",
+        kwargs["user"],
+        "--no-password",
+        "--host",
+        kwargs["host"],
+        "--port",
+        str(kwargs["port"]),
+    ]
+
+
 def dbexists(dbname):
-    cmd = """psql \
-    --username %(user)s \
-    --no-password \
-    --host %(host)s \
-    --port %(port)s \
-    --list --quiet --tuples-only --no-align | grep -q '^%(dbname)s|'"""
-    kwargs = defaults(dbname)
-    return os.system(cmd % kwargs) == 0
+    found = []
+
+    def match(line):
+        if line.startswith("%s|" % dbname):
+            found.append(line)
+
+    cmd = psql_cmd() + ["--list", "--quiet", "--tuples-only", "--no-align"]
+    return pipeline.run([cmd], stdout=match)["ok"] and bool(found)
 
 
 def create(dbname):
-    cmd = """createdb \
-    --username %(user)s \
-    --no-password \
-    --host %(host)s \
-    --port %(port)s \
-    %(dbname)s"""
-    kwargs = defaults(dbname)
-    return os.system(cmd % kwargs) == 0
+    return pipeline.run([psql_cmd("createdb") + [dbname]])["ok"]
 
 
 def drop(dbname):
-    cmd = """dropdb \
-    --username %(user)s \
-    --no-password \
-    --host %(host)s \
-    --port %(port)s \
-    %(dbname)s"""
-    kwargs = defaults(dbname)
-    return os.system(cmd % kwargs) == 0
+    return pipeline.run([psql_cmd("dropdb") + [dbname]])["ok"]
+
+
+def dump_format(path_to_dump):
+    "returns 'custom' if the gzipped dump at `path_to_dump` is a `pg_dump` archive, otherwise 'plain'"
+    with gzip.open(path_to_dump, "rb") as fh:
+        return "custom" if fh.read(5) == b"PGDMP" else "plain"
+
+
+class _DumpReader:
+    """reads the decompressed dump in `src` a line at a time, counting bytes and the rows within
+    `COPY ... FROM stdin` blocks as it's read. see `_load_process`."""
+
+    def __init__(self, src):
+        self.src = src
+        self.bytes = self.rows = 0
+        self.copying = False
+
+    def read(self, size=-1):
+        "returns whole lines totalling at least `size` bytes, or everything left if `size` is negative"
+        buf = []
+        buf_size = 0
+        for line in self.src:
+            if self.copying:
+                if line == b"\\.\n":
+                    self.copying = False
+                else:
+                    self.rows += 1
+            elif line.startswith(b"COPY "):
+                self.copying = True
+            buf.append(line)
+            buf_size += len(line)
+            if 0 <= size <= buf_size:
+                break
+        self.bytes += buf_size
+        return b"".join(buf)
+
+
+def _load_process(dbname, src, custom, fast=False, atomic=False):
+    """loads the decompressed dump in `src` using `psql` or, if `custom`, `pg_restore`.
+    if `atomic`, the dump is loaded in a single transaction that is rolled back on any error.
+    if `fast`, the dump is loaded atomically with session settings for bulk loading.
+    the dump is fed to the command by `pipeline.run`, which kills the command before it sees the end
+    of a dump that couldn't be read, so a truncated dump is never committed. the load rate is logged when finished.
+
+    indices and constraints are already created after the data has been loaded in dumps
+    created by `pg_dump`, a raised `maintenance_work_mem` makes building them quicker.
+    """
+    cmd = psql_cmd("pg_restore" if custom else "psql") + ["--dbname", dbname]
+    if custom:
+        cmd.append("--no-owner")
+    else:
+        cmd.append("--quiet")
+    env = {}
+    if fast or atomic:
+        cmd.append("--single-transaction")
+        if custom:
+            cmd.append("--exit-on-error")
+        else:
+            # psql ignores '--single-transaction' for statements read from stdin,
+            # they are only wrapped in a transaction when read as a file.
+            cmd.extend(["--set", "ON_ERROR_STOP=1", "--file", "-"])
+    if fast:
+        # a crash during the restore loses the whole transaction anyway,
+        # so there is no point waiting for each commit to be flushed to disk.
+        env["PGOPTIONS"] = "-c synchronous_commit=off -c maintenance_work_mem=%s" % (
+            conf.POSTGRESQL_RESTORE_MAINTENANCE_WORK_MEM
+        )
+
+    reader = _DumpReader(src)
+    result = pipeline.run([cmd], stdin=reader, env=env)
+    elapsed = max(result["elapsed"], 0.001)
+
+    rate = "%.1f MB/s" % (reader.bytes / elapsed / 2**20)
+    if not custom:
+        # rows can't be counted in 'custom' format dumps, only bytes.
+        rate += ", %d rows/s" % (reader.rows / elapsed)
+    LOG.info(
+        "loaded %s bytes and %s rows into %r in %.1fs (%s)",
+        reader.bytes,
+        reader.rows if not custom else "?",
+        dbname,
+        elapsed,
+        rate,
+    )
+    return result["ok"]
+
+
+def _fast_load(dbname, path_to_dump):
+    """loads the dump at `path_to_dump` in a single transaction with session settings for bulk loading.
+    the dump is decompressed in-process, see `_load_process`."""
+    custom = dump_format(path_to_dump) == "custom"
+    LOG.info("fast loading %r into PostgreSQL database %r", path_to_dump, dbname)
+    with gzip.open(path_to_dump, "rb") as src:
+        return _load_process(dbname, src, custom, fast=True)
+
+
+def load_stream(dbname, stream, dropdb=False, fast=False):
+    """loads the gzipped dump read from `stream` as it's read, see `s3.open_stream`.
+    nothing is written to disk. the dump is loaded in a single transaction so a stream that
+    fails before it's end, or fails it's ETag check, loads nothing into `dbname`.
+    `dbname` must already exist, see `restore_stream` to replace a live database."""
+    if dropdb:
+        msg = "failed to drop+create the database prior to loading fixture."
+        assert all(
+            [drop(dbname), not dbexists(dbname), create(dbname), dbexists(dbname)]
+        ), msg
+    src = io.BufferedReader(gzip.GzipFile(fileobj=stream, mode="rb"), 2**20)
+    custom = src.peek(5)[:5] == b"PGDMP"
+    LOG.info("streaming a dump into PostgreSQL database %r", dbname)
+    return _load_process(dbname, src, custom, fast=fast, atomic=True)
 
 
-def load(dbname, path_to_dump, dropdb=False):
+def load(dbname, path_to_dump, dropdb=False, fast=False):
     # https://www.postgresql.org/docs/8.1/static/backup.html#BACKUP-DUMP-RESTORE
     ensure(os.path.exists(path_to_dump), "no such path: %r" % path_to_dump)
 
@@ -65,15 +192,242 @@ def load(dbname, path_to_dump, dropdb=False):
             [drop(dbname), not dbexists(dbname), create(dbname), dbexists(dbname)]
         ), msg
 
-    cmd = """cat %(path_to_dump)s | gunzip | psql \
-    --username %(user)s \
-    --no-password \
-    --host %(host)s \
-    --port %(port)s \
-    --dbname %(dbname)s"""
-    kwargs = defaults(dbname)
-    kwargs.update({"path_to_dump": path_to_dump})
-    return utils.system(cmd % kwargs) == 0
+    if fast:
+        return _fast_load(dbname, path_to_dump)
+
+    cmd = psql_cmd() + ["--dbname", dbname]
+    if dump_format(path_to_dump) == "custom":
+        cmd = psql_cmd("pg_restore") + ["--no-owner", "--dbname", dbname]
+    return pipeline.run([["gunzip", "-c", path_to_dump], cmd])["ok"]
+
+
+#
+# selective restores
+# `pg_restore --table` restores a table and it's data but not it's indexes, constraints, defaults,
+# sequences or triggers. instead, the archive's table of contents (`pg_restore --list`) is filtered
+# down to the entries belonging to the selected tables and restored with `pg_restore --use-list`.
+#
+# most entries name the table they belong to. indexes and sequences don't, so the table they belong to
+# is found in their definitions in the archive's schema (`pg_restore --schema-only`).
+#
+
+# table of contents entries named after the table they belong to, 'TABLE DATA public articles'
+TABLE_ENTRIES = ["TABLE", "TABLE DATA", "ROW SECURITY"]
+# entries named after the table they belong to and themselves, 'CONSTRAINT public articles articles_pkey'
+TABLE_OBJECT_ENTRIES = [
+    "CONSTRAINT",
+    "FK CONSTRAINT",
+    "DEFAULT",
+    "TRIGGER",
+    "POLICY",
+    "RULE",
+]
+SEQUENCE_ENTRIES = ["SEQUENCE", "SEQUENCE OWNED BY", "SEQUENCE SET"]
+# entries named after the type and name of what they apply to, 'COMMENT public TABLE articles'
+ANNOTATION_ENTRIES = ["COMMENT", "ACL"]
+# the types of entry that may contain spaces, longest first
+_ENTRY_TYPES = sorted(
+    TABLE_ENTRIES
+    + TABLE_OBJECT_ENTRIES
+    + SEQUENCE_ENTRIES
+    + ["INDEX ATTACH", "MATERIALIZED VIEW", "MATERIALIZED VIEW DATA"],
+    key=len,
+    reverse=True,
+)
+
+
+def _parse_toc_line(line):
+    """parses an entry in the output of `pg_restore --list` into a triple of `(type, schema, name)`.
+    '3258; 2606 16396 CONSTRAINT public articles articles_pkey postgres'
+    => `("CONSTRAINT", "public", "articles articles_pkey")`
+    returns `None` for comments and blank lines."""
+    if not line.strip() or line.startswith(";"):
+        return None
+    # '<id>; <tableoid> <oid> ', the owner is last and may be empty
+    rest = line.split(" ", 3)[3]
+    rest = rest.rsplit(" ", 1)[0]
+    entry_type = next(
+        (t for t in _ENTRY_TYPES if rest.startswith(t + " ")), rest.split(" ")[0]
+    )
+    schema, _, name = rest[len(entry_type) + 1 :].partition(" ")
+    return entry_type, None if schema == "-" else schema, name
+
+
+def _split_ident(qualified):
+    """splits a qualified, possibly quoted, identifier into it's parts.
+    `public."My Table".id` => `["public", "My Table", "id"]`"""
+    return [
+        quoted.replace('""', '"') if quoted else bare
+        for quoted, bare in re.findall(r'"((?:[^"]|"")*)"|([^."]+)', qualified)
+    ]
+
+
+# -- Name: articles_title_idx; Type: INDEX; Schema: public; Owner: postgres
+_SCHEMA_HEADER = re.compile(r"^-- Name: (.*); Type: (.*); Schema: (.*); Owner: .*$")
+_OWNING_TABLE = {
+    # CREATE INDEX articles_title_idx ON public.articles USING btree (title);
+    "INDEX": re.compile(r"\bON (?:ONLY )?(.+?) USING\b"),
+    # ALTER SEQUENCE public.articles_id_seq OWNED BY public.articles.id;
+    "SEQUENCE OWNED BY": re.compile(r"\bOWNED BY (.+)\.[^.]+;$"),
+    # ALTER TABLE public.articles ALTER COLUMN id ADD GENERATED ALWAYS AS IDENTITY (
+    "SEQUENCE": re.compile(r"^ALTER TABLE (?:ONLY )?(.+?) ALTER COLUMN .* AS IDENTITY"),
+}
+
+
+# foreign keys are found by the table they reference
+_REFERENCED_TABLE = {
+    #     ADD CONSTRAINT articles_author_id_fkey FOREIGN KEY (author_id) REFERENCES public.authors(id);
+    "FK CONSTRAINT": re.compile(r"\bREFERENCES (.+?)\("),
+}
+
+
+def _schema_tables(schema_lines, patterns):
+    """returns a map of `(type, schema, name)` to the `(schema, table)` found in it's definition
+    by the pattern for it's type in `patterns`, for the entries in the output of `pg_restore --schema-only`.
+    """
+    tables = {}
+    entry = None
+    for line in schema_lines:
+        match = _SCHEMA_HEADER.match(line)
+        if match:
+            name, entry_type, schema = match.groups()
+            entry = (entry_type, None if schema == "-" else schema, name)
+            continue
+        pattern = entry and patterns.get(entry[0])
+        match = pattern and pattern.search(line)
+        if match:
+            qualified = _split_ident(match.group(1))
+            tables[entry] = (
+                qualified[-2] if len(qualified) > 1 else None,
+                qualified[-1],
+            )
+    return tables
+
+
+def _owning_tables(schema_lines):
+    """returns a map of `(type, schema, name)` to the `(schema, table)` it belongs to
+    for the indexes and sequences in the output of `pg_restore --schema-only`."""
+    return _schema_tables(schema_lines, _OWNING_TABLE)
+
+
+def _referenced_tables(schema_lines):
+    """returns a map of `(type, schema, name)` to the `(schema, table)` it references
+    for the foreign keys in the output of `pg_restore --schema-only`."""
+    return _schema_tables(schema_lines, _REFERENCED_TABLE)
+
+
+def _restore_list(toc_lines, schema_lines, table_list):
+    """returns the lines of the table of contents `toc_lines` belonging to the tables in `table_list`,
+    along with the foreign keys of other tables that reference them.
+    see `parse_path` for the structure of `table_list`."""
+
+    def selected(schema, table):
+        return any(
+            (s is None or s == schema) and (t is None or t == table)
+            for s, t in table_list
+        )
+
+    owners = _owning_tables(schema_lines)
+    # a table can't be dropped while another table's foreign key references it,
+    # so those foreign keys are dropped and recreated along with the table.
+    references = _referenced_tables(schema_lines)
+    # sequences are named by their 'SEQUENCE' or 'SEQUENCE OWNED BY' entries,
+    # their 'SEQUENCE SET' entry has no definition to find the table in.
+    sequences = {
+        (schema, name)
+        for (entry_type, schema, name), owner in owners.items()
+        if entry_type in SEQUENCE_ENTRIES and selected(*owner)
+    }
+    kept = []
+    for line in toc_lines:
+        entry = _parse_toc_line(line)
+        if not entry:
+            continue
+        entry_type, schema, name = entry
+        if entry_type in TABLE_ENTRIES:
+            keep = selected(schema, name)
+        elif entry_type in TABLE_OBJECT_ENTRIES:
+            keep = selected(schema, name.rsplit(" ", 1)[0]) or (
+                entry in references and selected(*references[entry])
+            )
+        elif entry_type == "INDEX":
+            keep = entry in owners and selected(*owners[entry])
+        elif entry_type in SEQUENCE_ENTRIES:
+            keep = (schema, name) in sequences
+        elif entry_type in ANNOTATION_ENTRIES:
+            kind, _, target = name.partition(" ")
+            keep = kind in ["TABLE", "COLUMN"] and selected(
+                schema, target.split(".")[0]
+            )
+        else:
+            keep = False
+        if keep:
+            kept.append(line)
+    return kept
+
+
+def _archive_lines(path_to_dump, args):
+    "returns the lines `pg_restore` with the given `args` writes for the gzipped pg_dump archive at `path_to_dump`"
+    lines = []
+    with gzip.open(path_to_dump, "rb") as fh:
+        # `pg_restore --list` stops reading once it has the table of contents
+        result = pipeline.run(
+            [psql_cmd("pg_restore") + args], stdin=fh, stdout=lines.append
+        )
+    ensure(result["ok"], "failed to read pg_dump archive %r" % path_to_dump)
+    return lines
+
+
+def load_tables(dbname, path_to_dump, table_list):
+    """restores just the given tables from the dump at `path_to_dump` into the existing `dbname`.
+    the rest of the database is left alone and any existing copies of the tables are replaced,
+    along with their indexes, constraints, defaults, sequences and triggers.
+    the foreign keys of other tables referencing the tables are dropped and recreated, the restore
+    fails if the rows of the other tables no longer match the restored tables.
+    see `parse_path` for the structure of `table_list`."""
+    ensure(os.path.exists(path_to_dump), "no such path: %r" % path_to_dump)
+    ensure(table_list, "no tables selected for restore")
+
+    # plain SQL dumps can't be picked apart reliably, `pg_restore` needs a pg_dump archive.
+    msg = "a selective restore requires a dump in the 'custom' format, see 'postgresql.dump_format': %r"
+    ensure(dump_format(path_to_dump) == "custom", msg % path_to_dump, ValueError)
+
+    ensure(
+        dbexists(dbname), "cannot restore tables, database %r does not exist" % dbname
+    )
+
+    restore_list = _restore_list(
+        _archive_lines(path_to_dump, ["--list"]),
+        _archive_lines(path_to_dump, ["--schema-only"]),
+        table_list,
+    )
+    ensure(
+        restore_list, "no tables matching %r found in %r" % (table_list, path_to_dump)
+    )
+    LOG.info(
+        "restoring %s entries for %s tables into PostgreSQL database %r",
+        len(restore_list),
+        len(table_list),
+        dbname,
+    )
+    list_path = path_to_dump + ".ubr-list"
+    with open(list_path, "w") as fh:
+        fh.write("\n".join(restore_list) + "\n")
+    try:
+        cmd = psql_cmd("pg_restore") + [
+            "--no-owner",
+            "--clean",
+            "--if-exists",
+            "--single-transaction",
+            "--exit-on-error",
+            "--use-list",
+            list_path,
+            "--dbname",
+            dbname,
+        ]
+        return pipeline.run([["gunzip", "-c", path_to_dump], cmd])["ok"]
+    finally:
+        os.unlink(list_path)
 
 
 def create_if_not_exists(dbname):
@@ -147,25 +501,127 @@ def runsql(dbname, sql, params=None):
         conn.close()
 
 
+def runsql_many(dbname, sql_list):
+    "runs each statement in `sql_list` against `dbname` within a single transaction"
+    conn = pg8k_conn(dbname)
+    try:
+        cursor = conn.cursor()
+        for sql in sql_list:
+            cursor.execute(sql)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _ident(name):
+    "quotes the given identifier for use in a SQL statement"
+    return '"%s"' % name.replace('"', '""')
+
+
+#
+# shadow restores
+# a backup is loaded into a shadow database that is swapped with the live database once loaded.
+# the live database stays available for the duration of the load.
+#
+
+SHADOW_SUFFIX = "__ubr_restore"
+RETIRED_SUFFIX = "__ubr_old"
+
+
+def shadow_name(dbname):
+    return dbname + SHADOW_SUFFIX
+
+
+def table_count(dbname):
+    "returns the number of tables in `dbname` outside of the system schemas"
+    sql = """SELECT count(*) AS n FROM information_schema.tables
+    WHERE table_schema NOT IN ('pg_catalog', 'information_schema')"""
+    return list(runsql(dbname, sql))[0]["n"]
+
+
+def swap(dbname, shadow, attempts=3):
+    """atomically replaces `dbname` with `shadow`, keeping the replaced database as `<dbname>__ubr_old`.
+    a database can't be renamed while there are connections to it, so they are terminated first.
+    returns the name of the replaced database or `None` if there was no database to replace.
+    """
+    retired = dbname + RETIRED_SUFFIX
+    ensure(drop_if_exists(retired), "failed to drop old retired database %r" % retired)
+    exists = dbexists(dbname)
+    terminate = """SELECT pg_terminate_backend(pid) FROM pg_stat_activity
+    WHERE datname = '%s' AND pid <> pg_backend_pid()""" % dbname.replace("'", "''")
+    sql_list = [
+        "ALTER DATABASE %s RENAME TO %s" % (_ident(shadow), _ident(dbname)),
+    ]
+    if exists:
+        sql_list = [
+            terminate,
+            "ALTER DATABASE %s RENAME TO %s" % (_ident(dbname), _ident(retired)),
+        ] + sql_list
+    for attempt in range(1, attempts + 1):
+        try:
+            # connected to the maintenance database, it's not possible to rename the database you're connected to
+            runsql_many("postgres", sql_list)
+            return retired if exists else None
+        except pg8000.DatabaseError:
+            # a new connection snuck in between terminating connections and renaming the database
+            if attempt == attempts:
+                raise
+            LOG.warning("failed to swap %r with %r, trying again", dbname, shadow)
+            time.sleep(attempt)
+
+
+def _swap_load(dbname, load_fn, source):
+    """calls `load_fn` with the name of a new shadow database and, if it loads successfully, swaps it with `dbname`.
+    `source` describes what is being loaded."""
+    shadow = shadow_name(dbname)
+    msg = "failed to drop+create the shadow database %r prior to loading fixture."
+    ensure(all([drop_if_exists(shadow), create(shadow)]), msg % shadow)
+    try:
+        LOG.info("loading %s into shadow database %r", source, shadow)
+        ensure(
+            load_fn(shadow),
+            "failed to load %s into shadow database %r" % (source, shadow),
+        )
+        ensure(
+            table_count(shadow) > 0,
+            "shadow database %r has no tables after loading %s" % (shadow, source),
+        )
+        LOG.info("swapping shadow database %r with %r", shadow, dbname)
+        retired = swap(dbname, shadow)
+    except BaseException:
+        drop_if_exists(shadow)
+        raise
+    if retired:
+        drop(retired)
+    return True
+
+
+def swap_load(dbname, path_to_dump, fast=False):
+    """loads `path_to_dump` into a shadow database and, if successful, swaps it with `dbname`.
+    the live database is only unavailable for the duration of the swap."""
+    ensure(os.path.exists(path_to_dump), "no such path: %r" % path_to_dump)
+    return _swap_load(
+        dbname, lambda shadow: load(shadow, path_to_dump, fast=fast), repr(path_to_dump)
+    )
+
+
 def dump(dbname, output_path):
-    kwargs = defaults(dbname)
-    kwargs.update({"output_path": output_path})
+    # 'custom' format dumps are pg_dump archives that can have individual tables restored from them.
+    # they are compressed with gzip like 'plain' dumps, so pg_dump's own compression is disabled.
+    format_args = ["--format", "plain"]
+    if conf.POSTGRESQL_DUMP_FORMAT == "custom":
+        format_args = ["--format", "custom", "--compress", "0"]
 
     # '--clean' and '--if-exists' and '--create' deliberately excluded
     # these are good for dev environments where the loss of data can be
     # tolerated (or even expected), but shouldn't lead to data loss (except owners)
     # when automated
 
-    cmd = """
-    set -o pipefail
-    pg_dump \
-    --username %(user)s \
-    --no-password \
-    --host %(host)s \
-    --port %(port)s \
-    --no-owner \
-    --dbname %(dbname)s | gzip > %(output_path)s""" % kwargs
-    return utils.system(cmd) == 0
+    cmd = psql_cmd("pg_dump") + ["--no-owner"] + format_args + ["--dbname", dbname]
+    return pipeline.run([cmd, ["gzip"]], stdout=output_path)["ok"]
 
 
 #
@@ -184,19 +640,22 @@ def _backup(dbname, destination):
 def backup(path_list, destination, opts):
     destination = destination or conf.WORKING_DIR
     destination = os.path.abspath(destination)
-    utils.system("mkdir -p %s" % destination)
+    utils.mkdir_p(destination)
     if not isinstance(path_list, list):
         path_list = [path_list]
+    # selectors only narrow a restore, the whole database is always backed up
+    dbname_list = utils.unique([parse_path(path)[0] for path in path_list])
     return {
         "output_dir": destination,
         "output": [
-            _backup(dbname, destination) for dbname in path_list if dbexists(dbname)
+            _backup(dbname, destination) for dbname in dbname_list if dbexists(dbname)
         ],
     }
 
 
-def _restore(dbname, backup_dir, opts):
-    "look for a backup of $dbname in $backup_dir and restore it"
+def _restore(path, backup_dir, opts):
+    "look for a backup of $dbname in $backup_dir and restore it, or just the selected tables in it"
+    dbname, table_list = parse_path(path)
     try:
         backup_dir = backup_dir or conf.WORKING_DIR
         dump_path = join(backup_dir, backup_name(dbname))
@@ -204,14 +663,49 @@ def _restore(dbname, backup_dir, opts):
             os.path.exists(dump_path),
             "expected path %r does not exist or is not a file." % dump_path,
         )
+        if table_list:
+            LOG.info("restoring tables in PostgreSQL database %r" % dbname)
+            return (path, load_tables(dbname, dump_path, table_list))
+        fast = opts.get("fast_restore")
+        if opts.get("restore_mode") == "swap":
+            LOG.info(
+                "restoring PostgreSQL database %r using a shadow database" % dbname
+            )
+            return (path, swap_load(dbname, dump_path, fast=fast))
         LOG.info("restoring PostgreSQL database %r" % dbname)
+        return (
+            path,
+            all(
+                [
+                    drop_if_exists(dbname),
+                    create(dbname),
+                    load(dbname, dump_path, fast=fast),
+                ]
+            ),
+        )
+    except Exception:
+        LOG.exception("unhandled unexception attempting to restore database %r", path)
+        # raise # this is what we should be doing
+        return (path, False)
+
+
+def restore_stream(dbname, stream, opts):
+    """restores the database `dbname` from the dump read from `stream` as it's read.
+    the dump is loaded into a shadow database that only replaces `dbname` once it has been loaded
+    completely, so a stream that fails leaves `dbname` as it was. see `swap_load`."""
+    try:
+        LOG.info("restoring PostgreSQL database %r as it's streamed" % dbname)
+        fast = opts.get("fast_restore")
         return (
             dbname,
-            all([drop_if_exists(dbname), create(dbname), load(dbname, dump_path)]),
+            _swap_load(
+                dbname,
+                lambda shadow: load_stream(shadow, stream, fast=fast),
+                "a streamed dump",
+            ),
         )
     except Exception:
         LOG.exception("unhandled unexception attempting to restore database %r", dbname)
-        # raise # this is what we should be doing
         return (dbname, False)
 
 
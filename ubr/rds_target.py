@@ -1,5 +1,6 @@
 import botocore.errorfactory
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import time
 import boto3
 import logging
@@ -12,11 +13,11 @@ def rds_conn():
     return boto3.client("rds", **conf.AWS)
 
 
-def rds_snapshot(instance_id, snapshot_name):
+def rds_snapshot(instance_id, snapshot_name, conn=None):
     LOG.info("creating RDS snapshot %r from instance: %s", snapshot_name, instance_id)
 
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/rds.html#RDS.Client.create_db_snapshot
-    return rds_conn().create_db_snapshot(
+    return (conn or rds_conn()).create_db_snapshot(
         **{
             "DBSnapshotIdentifier": snapshot_name,
             "DBInstanceIdentifier": instance_id,
@@ -27,33 +28,73 @@ def rds_snapshot(instance_id, snapshot_name):
     )
 
 
-def wait_until_available(response, max_wait_time_minutes=10):
-    """polls `describe_db_snapshots` until the instance described in the given `response` has
-    reached the 'available' state or times out."""
-    snapshot_id = response["DBSnapshot"]["DBSnapshotIdentifier"]
+POLL_INTERVAL = 10  # seconds, doubled after each poll up to `MAX_POLL_INTERVAL`
+MAX_POLL_INTERVAL = 60  # seconds
+
 
+def describe_snapshots(conn, snapshot_id_list):
+    "returns a map of `{snapshot_id: status}` for the given ubr snapshots in a single paginated query"
+    paginator = conn.get_paginator("describe_db_snapshots")
+    iterator = paginator.paginate(
+        SnapshotType="manual",
+        Filters=[{"Name": "db-snapshot-id", "Values": list(snapshot_id_list)}],
+    )
+    results = {}
+    for page in iterator:
+        for snapshot in page["DBSnapshots"]:
+            results[snapshot["DBSnapshotIdentifier"]] = snapshot["Status"]
+    return results
+
+
+def wait_for_snapshots(response_list, max_wait_time_minutes=10, conn=None):
+    """polls `describe_db_snapshots` until each snapshot described in the given `response_list` has
+    reached the 'available' state, has failed or has timed out.
+    all pending snapshots are polled together, backing off between polls.
+    a snapshot that isn't listed yet is still pending, new snapshots may take a while to be listed.
+    returns a map of `{snapshot_id: available?}`."""
+    conn = conn or rds_conn()
     start_time = time.time()
+    pending = {
+        response["DBSnapshot"]["DBSnapshotIdentifier"]: start_time
+        for response in response_list
+    }
+    results = {}
+    interval = POLL_INTERVAL
+
+    while pending:
+        status_map = describe_snapshots(conn, pending)
+        for snapshot_id, started in list(pending.items()):
+            status = status_map.get(snapshot_id, "missing")
+            if status == "available":
+                LOG.info("snapshot %r is now %s", snapshot_id, status)
+                results[snapshot_id] = True
+            elif status == "failed":
+                LOG.error("snapshot %r is %s, giving up", snapshot_id, status)
+                results[snapshot_id] = False
+            elif (time.time() - started) / 60 > max_wait_time_minutes:
+                LOG.error(
+                    "waited %s minutes, giving up on snapshot: %s",
+                    max_wait_time_minutes,
+                    snapshot_id,
+                )
+                results[snapshot_id] = False
+            else:
+                LOG.info("snapshot %r not available yet: %s", snapshot_id, status)
+                continue
+            del pending[snapshot_id]
 
-    while True:
-        elapsed_seconds = int(time.time() - start_time)
-        if (elapsed_seconds / 60) > max_wait_time_minutes:
-            LOG.error(
-                "waited %s minutes, giving up on snapshot: %s",
-                max_wait_time_minutes,
-                snapshot_id,
-            )
-            return False
+        if pending:
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
 
-        resp = rds_conn().describe_db_snapshots(DBSnapshotIdentifier=snapshot_id)
-        status = resp["DBSnapshots"][0]["Status"]
-        if status != "available":
-            LOG.info("snapshot %r not available yet: %s", snapshot_id, status)
-            time.sleep(10)  # seconds
-            continue
+    return results
 
-        LOG.info("snapshot %r is now %s", snapshot_id, status)
 
-        return True
+def wait_until_available(response, max_wait_time_minutes=10):
+    """polls `describe_db_snapshots` until the instance described in the given `response` has
+    reached the 'available' state or times out."""
+    snapshot_id = response["DBSnapshot"]["DBSnapshotIdentifier"]
+    return wait_for_snapshots([response], max_wait_time_minutes)[snapshot_id]
 
 
 def snapshot_name(instance_id):
@@ -73,21 +114,134 @@ def snapshot_name(instance_id):
 
 
 def backup(target_list, _, __):
+    """snapshots each RDS instance in `target_list`.
+    all snapshots are started before waiting for any of them to become available.
+    returns a list of `(instance_id, available?)` for each instance."""
+    conn = rds_conn()
+    response_list = []
+    instance_idx = {}
     for instance_id in target_list:
         try:
-            wait_until_available(rds_snapshot(instance_id, snapshot_name(instance_id)))
-            # wait_until_available(
-            #    {
-            #        "DBSnapshot": {
-            #            "DBSnapshotIdentifier": "ubr-lax-loadtest1-2022-04-26-06-11-31"
-            #        }
-            #    }
-            # )
+            response = rds_snapshot(instance_id, snapshot_name(instance_id), conn)
         except botocore.errorfactory.ClientError as exc:
             if exc.response["Error"]["Code"] == "DBInstanceNotFound":
                 LOG.error("RDS instance %r not found, skipping", instance_id)
-            else:
-                raise exc
+                continue
+            raise exc
+        response_list.append(response)
+        instance_idx[response["DBSnapshot"]["DBSnapshotIdentifier"]] = instance_id
+
+    results = wait_for_snapshots(response_list, conn=conn) if response_list else {}
+    output = [
+        (instance_id, results.get(snapshot_id, False))
+        for snapshot_id, instance_id in instance_idx.items()
+    ]
+    failed = [instance_id for instance_id, ok in output if not ok]
+    if failed:
+        LOG.error("RDS snapshots failed for instances: %s", ", ".join(failed))
+    return {"output": output}
+
+
+#
+# pruning
+# ubr snapshots older than the retention policy are deleted:
+# - the `keep` most recent snapshots of each instance are always kept
+# - snapshots younger than `keep_days` are always kept
+#
+
+DELETE_THREADS = 4
+# errors that mean too many requests have been made, see `delete_snapshot`
+THROTTLED = ["Throttling", "ThrottlingException", "RequestLimitExceeded"]
+MAX_RETRIES = 5
+
+
+def ubr_snapshots(conn, instance_id_list=None):
+    """returns a list of the manual snapshots created by ubr, optionally limited to those of the
+    instances in `instance_id_list`. snapshots are found a page at a time."""
+    kwargs = {"SnapshotType": "manual"}
+    if instance_id_list:
+        kwargs["Filters"] = [{"Name": "db-instance-id", "Values": instance_id_list}]
+    paginator = conn.get_paginator("describe_db_snapshots")
+    results = []
+    for page in paginator.paginate(**kwargs):
+        for snapshot in page["DBSnapshots"]:
+            tags = {tag["Key"]: tag["Value"] for tag in snapshot.get("TagList", [])}
+            if tags.get("author") == "ubr":
+                results.append(snapshot)
+    return results
+
+
+def expired(snapshot_list, keep, keep_days, now=None):
+    """returns the snapshots in `snapshot_list` outside of the retention policy, oldest first.
+    only available snapshots are considered, snapshots still being created or deleted are left alone.
+    """
+    now = now or datetime.now(timezone.utc)
+    threshold = now - timedelta(days=keep_days)
+    instance_idx = {}
+    for snapshot in snapshot_list:
+        if snapshot["Status"] == "available":
+            instance_idx.setdefault(snapshot["DBInstanceIdentifier"], []).append(
+                snapshot
+            )
+    results = []
+    for instance_snapshots in instance_idx.values():
+        instance_snapshots.sort(key=lambda s: s["SnapshotCreateTime"], reverse=True)
+        results.extend(
+            snapshot
+            for snapshot in instance_snapshots[keep:]
+            if snapshot["SnapshotCreateTime"] < threshold
+        )
+    return sorted(results, key=lambda s: s["SnapshotCreateTime"])
+
+
+def delete_snapshot(conn, snapshot_id):
+    "deletes the snapshot `snapshot_id`, backing off and retrying if requests are being throttled"
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            conn.delete_db_snapshot(DBSnapshotIdentifier=snapshot_id)
+            LOG.info("deleted snapshot %r", snapshot_id)
+            return True
+        except botocore.errorfactory.ClientError as exc:
+            code = exc.response["Error"]["Code"]
+            if code == "DBSnapshotNotFound":
+                LOG.warning("snapshot %r has already been deleted", snapshot_id)
+                return True
+            if code not in THROTTLED or attempt == MAX_RETRIES:
+                LOG.error("failed to delete snapshot %r: %s", snapshot_id, exc)
+                return False
+            time.sleep(2**attempt)
+
+
+def prune(target_list, opts):
+    """deletes the ubr snapshots of each RDS instance in `target_list` outside of the retention policy.
+    if the 'dry_run' option is set, the snapshots that would be deleted are just logged.
+    returns a list of `(snapshot_id, deleted?)` for each expired snapshot."""
+    target_list = list(target_list)
+    if not target_list:
+        # without instances to filter by, every ubr snapshot in the account would be pruned
+        LOG.warning("no RDS instances given, nothing to prune")
+        return {"output": []}
+    conn = rds_conn()
+    snapshot_list = expired(
+        ubr_snapshots(conn, target_list), opts["keep"], opts["keep_days"]
+    )
+    for snapshot in snapshot_list:
+        LOG.info(
+            "%s snapshot %r of instance %r created %s",
+            "would delete" if opts.get("dry_run") else "deleting",
+            snapshot["DBSnapshotIdentifier"],
+            snapshot["DBInstanceIdentifier"],
+            snapshot["SnapshotCreateTime"],
+        )
+    snapshot_id_list = [snapshot["DBSnapshotIdentifier"] for snapshot in snapshot_list]
+    if opts.get("dry_run"):
+        return {"output": [(snapshot_id, False) for snapshot_id in snapshot_id_list]}
+
+    with ThreadPoolExecutor(max_workers=DELETE_THREADS) as executor:
+        deleted = list(
+            executor.map(lambda sid: delete_snapshot(conn, sid), snapshot_id_list)
+        )
+    return {"output": list(zip(snapshot_id_list, deleted))}
 
 
 def backup_name():
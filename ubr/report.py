@@ -2,7 +2,7 @@ import re
 from datetime import datetime
 import logging
 from ubr.utils import group_by_many, visit
-from ubr import conf, s3
+from ubr import conf, s3, archive
 from ubr.descriptions import load_descriptor, find_descriptors, project_name
 
 LOG = logging.getLogger(__name__)
@@ -80,6 +80,31 @@ def dtobj_from_backup(backup):
     return datetime.strptime(dtstr, "%Y%m%d%H%M%S")
 
 
+def backup_family(filename):
+    """backups that are part of a larger backup are grouped together as a family:
+    'archive-1a2b3c4d.incr-0001.tar.gz' => 'archive-1a2b3c4d.tar.gz'
+    'archive-1a2b3c4d.part01.tar.gz' => 'archive-1a2b3c4d.tar.gz'
+    'archive-1a2b3c4d.idx.gz' => 'archive-1a2b3c4d.tar.gz'
+    'files/opt/app/uploads/file.pdf' => 'files'"""
+    if filename.startswith("files/"):
+        return "files"
+    filename = re.sub(r"\.idx\.gz$", ".tar.gz", filename)
+    return re.sub(r"\.(incr-|part)\d+", "", filename)
+
+
+def latest_by_family(backup_list):
+    """returns the most recent backup of each family of backups in `backup_list`.
+    a full archive isn't considered old while it has recent increments."""
+    idx = {}
+    for backup in backup_list:
+        family = backup_family(backup["filename"])
+        if family not in idx or dtobj_from_backup(backup) > dtobj_from_backup(
+            idx[family]
+        ):
+            idx[family] = backup
+    return list(idx.values())
+
+
 def old_backup(backup):
     "predicate, returns true if given backup is 'old' (older than 2 days)"
     dtobj = dtobj_from_backup(backup)
@@ -110,7 +135,7 @@ def check_all():
     problems = []
     for project, hosts in results.items():
         for host, files in hosts.items():
-            for filename, backup in files.items():
+            for backup in latest_by_family(list(files.values())):
                 old_backup(backup) and problems.append(backup)
                 # problems.append(backup)
     if problems:
@@ -134,8 +159,60 @@ def check(hostname, path_list=None):
             )
             path_list = [s3_path for fname, s3_path in latest_for_target]
             backup_list = parse_prefix_list(path_list)
-            for backup in backup_list:
+            for backup in latest_by_family(backup_list):
                 old_backup(backup) and problems.append(backup)
                 # problems.append(backup)
     problems and print_report(problems)
     return problems
+
+
+#
+
+
+def search_indexes(bucket, project, hostname, pattern_list):
+    """searches the index of every 'tar-gzipped' backup of `project` on `hostname` for files matching `pattern_list`.
+    returns a list of matching files with the key of the archive they are in, oldest first.
+    """
+    key_list = s3.filter_listing(
+        s3.s3_project_files(bucket, project),
+        project,
+        hostname,
+        filename=s3.INDEX_PATTERN,
+    )
+    results = []
+    for index_key in sorted(key_list):
+        index = s3.read_index(bucket, index_key)
+        for member in index["members"]:
+            if archive.matches(member["path"], pattern_list):
+                results.append(
+                    {
+                        "key": archive.archive_path(index_key),
+                        "path": member["path"],
+                        "size": member["size"],
+                        "mtime": member["mtime"],
+                        "digest": member["digest"],
+                    }
+                )
+    return results
+
+
+def print_found(result_list):
+    "given a list of found files, prints where each version of each file can be restored from"
+    for path, versions in group_by_many(result_list, ["path"]).items():
+        print(path)
+        for version in versions:
+            ppdt = datetime.fromtimestamp(version["mtime"])
+            print(
+                "   %s: %s (%s bytes, md5 %s)"
+                % (version["key"], ppdt, version["size"], version["digest"])
+            )
+
+
+def find(hostname, pattern_list):
+    "find the backups of this host containing files matching `pattern_list`"
+    results = []
+    for descriptor_path in find_descriptors(conf.DESCRIPTOR_DIR):
+        project = project_name(descriptor_path)
+        results.extend(search_indexes(conf.BUCKET, project, hostname, pattern_list))
+    results and print_found(results)
+    return results
@@ -1,10 +1,13 @@
 import hashlib
-import os, re
+import os, re, io, gzip, json, time, threading
 import boto3
+import botocore.config
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join
 from datetime import datetime
 from ubr.conf import logging
-from ubr import utils, conf
+from ubr import utils, conf, archive, transfer, cache
 from ubr.utils import ensure
 
 LOG = logging.getLogger(__name__)
@@ -24,8 +27,24 @@ def remove_targets(path_list, rooted_at=conf.WORKING_DIR):
 #
 
 
+# boto3's default session isn't thread-safe and clients are created in the transfer threads,
+# so each thread creates it's clients from a session of it's own.
+_local = threading.local()
+
+
+def _session():
+    if not hasattr(_local, "session"):
+        _local.session = boto3.session.Session()
+    return _local.session
+
+
 def s3_conn():
-    return boto3.client("s3", **conf.AWS)
+    # each request is retried with a jittered, exponential backoff, see `transfer`
+    config = botocore.config.Config(
+        retries={"mode": "standard", "max_attempts": 10},
+        max_pool_connections=conf.S3_CONNECTIONS,
+    )
+    return _session().client("s3", config=config, **conf.AWS)
 
 
 # TODO: cachable
@@ -71,6 +90,21 @@ def s3_key(project, hostname, filename, dt=None):
     raise ValueError("given file has no extension.")
 
 
+def s3_files_key(project, hostname, relpath, dt=None):
+    """the key of a file of a 'files' backup. the path of the file within the backup is kept.
+    all the files of a backup share the same prefix, for example:
+    'lax/201701/20170101_prod--lax_230000-files/opt/lax/uploads/file.pdf'"""
+    if not dt:
+        dt = datetime.now()
+    ym = dt.strftime("%Y%m")
+    ymd = dt.strftime("%Y%m%d")
+    hms = dt.strftime("%H%M%S")
+    relpath = relpath.lstrip("/")
+    return (
+        "%(project)s/%(ym)s/%(ymd)s_%(hostname)s_%(hms)s-files/%(relpath)s" % locals()
+    )
+
+
 def s3_project_files(bucket, project, strip=True):
     "returns a list of backups that exist for the given project"
     # listing = s3_conn().list_objects(Bucket=bucket, Prefix=project)
@@ -119,8 +153,13 @@ TARGET_PATTERNS = {
     "tar-gzipped": r"archive-.+\.tar\.gz",
     "mysql-database": r".+\-mysql\.gz",
     "postgresql-database": r".+\-psql.gz",
+    # every file of 'files' backups, see `s3_files_key`
+    "files": r"files/.+",
 }
 
+# the indexes written alongside 'tar-gzipped' archives
+INDEX_PATTERN = r"archive-.+\.idx\.gz"
+
 
 def filter_listing(file_list, project, host, target=None, filename=""):
     if not filename and target:
@@ -199,7 +238,7 @@ def verify_file(filename, bucket, key):
 
 def upload_to_s3(bucket, src, dest):
     LOG.info("attempting to upload %r to s3://%s/%s", src, bucket, dest)
-    s3_conn().upload_file(src, bucket, dest)
+    transfer.manager().upload(s3_conn(), src, bucket, dest)
     ensure(
         verify_file(src, bucket, dest),
         "local file doesn't match results uploaded to s3 (content md5 or content length difference)",
@@ -212,19 +251,41 @@ def upload_backup(bucket, backup_results, project, hostname, remove=True):
     `backup_results` should be a dictionary of targets with their results as values.
     each value will have a 'output' key with the outputs for that target.
     these outputs are what is uploaded to s3"""
-    upload_targets = [
-        target_results["output"]
-        for target_results in backup_results.values()
-        if target_results
-    ]
-    upload_targets = list(filter(os.path.exists, utils.flatten(upload_targets)))
-
-    path_list = [
-        upload_to_s3(bucket, src, s3_key(project, hostname, src))
-        for src in upload_targets
-    ]
+    # all files share the same timestamp so files belonging together, like an archive and it's index,
+    # can be found from each other's keys.
+    dt = datetime.now()
+    upload_pairs = []
+    for target, target_results in backup_results.items():
+        if not target_results:
+            continue
+        for src in filter(os.path.exists, utils.flatten(target_results["output"])):
+            if target == "files":
+                # files keep their path within the backup
+                relpath = os.path.relpath(src, target_results["output_dir"])
+                key = s3_files_key(project, hostname, relpath, dt)
+            else:
+                key = s3_key(project, hostname, src, dt)
+            upload_pairs.append((src, key))
+    upload_targets = [src for src, _ in upload_pairs]
+
+    start = time.time()
+    path_list = transfer.manager().map(
+        lambda pair: upload_to_s3(bucket, *pair), upload_pairs
+    )
+    log_throughput(
+        "uploaded",
+        len(upload_targets),
+        sum(map(os.path.getsize, upload_targets)),
+        time.time() - start,
+    )
     # TODO: consider moving this into `main`
     if remove:
+        if conf.CACHE_UPLOADS and cache.enabled():
+            # uploads moved into the cache are no longer there to be removed
+            conn = s3_conn()
+            for src, key in upload_pairs:
+                etag = conn.head_object(Bucket=bucket, Key=key)["ETag"]
+                cache.put(key, etag, src, move=True)
         remove_targets(upload_targets, rooted_at=utils.common_prefix(upload_targets))
     return path_list
 
@@ -232,8 +293,83 @@ def upload_backup(bucket, backup_results, project, hostname, remove=True):
 ##
 
 
-def download(bucket, remote_src, local_dest):
-    "remote_src is the s3 key. local_dest is a path to a file on the local filesystem"
+#
+# downloads
+# a file is downloaded in ranges with concurrent ranged GETs, each written into place in a preallocated file.
+# the ranges that have finished are recorded in a small file alongside the download, so an
+# interrupted download picks up where it left off rather than starting again.
+# the file is checked against the object's ETag once it's complete.
+# an object that has been downloaded before is taken from the local cache if it's there, see `cache`.
+#
+
+
+def download_state_path(local_dest):
+    return local_dest + ".ubr-download"
+
+
+def read_download_state(local_dest, expected):
+    """returns the set of ranges of a previous, interrupted download of the same object to `local_dest`.
+    an empty set is returned if there was no previous download or it can't be resumed.
+    """
+    try:
+        with open(download_state_path(local_dest), "r") as fh:
+            state = json.load(fh)
+        resumable = (
+            all(state.get(key) == val for key, val in expected.items())
+            and os.path.getsize(local_dest) == expected["size"]
+        )
+    except (OSError, ValueError):
+        return set()
+    return set(state["done"]) if resumable else set()
+
+
+def remove_download_state(local_dest):
+    path = download_state_path(local_dest)
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+def write_download_state(local_dest, state):
+    path = download_state_path(local_dest)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(state, fh)
+    os.replace(tmp_path, path)
+
+
+def preallocate(fd, size):
+    "reserves `size` bytes for the open file `fd`, where the filesystem supports it"
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        pass
+    # a preallocated file may be larger than `size` if it was previously larger
+    os.ftruncate(fd, size)
+
+
+def verify_download(local_dest, etag):
+    """returns `True` if the file `local_dest` matches the S3 `etag`.
+    the ETag of an object uploaded in parts of a size other than those `generate_s3_etag` uses can't be checked.
+    """
+    etag = etag.strip('"')
+    if "-" in etag:
+        local_etag = generate_s3_etag(local_dest).strip('"')
+        if local_etag.split("-")[-1] != etag.split("-")[-1]:
+            LOG.warning(
+                "can't verify %r, it was uploaded in parts of an unknown size",
+                local_dest,
+            )
+            return True
+        return local_etag == etag
+    return utils.generate_file_md5(local_dest) == etag
+
+
+def download(bucket, remote_src, local_dest, part_size=None, threads=None):
+    """remote_src is the s3 key. local_dest is a path to a file on the local filesystem.
+    the file is downloaded `part_size` bytes at a time with `threads` ranged GETs at once.
+    an interrupted download of the same object to `local_dest` is resumed."""
+    part_size = part_size or conf.S3_DOWNLOAD_PART_SIZE
+    threads = threads or conf.S3_DOWNLOAD_CONNECTIONS
     remote_src = remote_src.lstrip("/")
     obj = s3_file(bucket, remote_src)
 
@@ -242,10 +378,91 @@ def download(bucket, remote_src, local_dest):
 
     utils.mkdir_p(os.path.dirname(local_dest))
 
-    s3_conn().download_file(bucket, remote_src, local_dest)
+    conn = s3_conn()
+    head = conn.head_object(Bucket=bucket, Key=remote_src)
+    if cache.get(remote_src, head["ETag"], local_dest):
+        remove_download_state(local_dest)
+        return local_dest
+    size = head["ContentLength"]
+    state = {"etag": head["ETag"], "size": size, "part_size": part_size}
+    done = read_download_state(local_dest, state)
+    state["done"] = sorted(done)
+    if not done and os.path.lexists(local_dest):
+        # written to from nothing, never in place. it may be a file linked to the cache.
+        os.unlink(local_dest)
+    ranges = [
+        (i, start, min(start + part_size, size))
+        for i, start in enumerate(range(0, size, part_size))
+        if i not in done
+    ]
+    if done:
+        LOG.info(
+            "resuming download of %r, %s of %s parts remaining",
+            remote_src,
+            len(ranges),
+            len(ranges) + len(done),
+        )
+
+    lock = threading.Lock()
+    manager = transfer.manager()
+
+    def _download_part(i, start, end):
+        manager.download_range(conn, bucket, remote_src, start, end, fd)
+        with lock:
+            state["done"].append(i)
+            write_download_state(local_dest, state)
+
+    fd = os.open(local_dest, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+        preallocate(fd, size)
+        # parts are fetched on a pool of their own, downloads may already be running on the manager's pool
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            future_list = [
+                executor.submit(_download_part, *part_range) for part_range in ranges
+            ]
+            for future in future_list:
+                future.result()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if not verify_download(local_dest, head["ETag"]):
+        # the whole file is suspect, start again from nothing the next time
+        os.unlink(local_dest)
+        remove_download_state(local_dest)
+        raise ValueError(
+            "downloaded file %r doesn't match the ETag of %r" % (local_dest, remote_src)
+        )
+    remove_download_state(local_dest)
+    cache.put(remote_src, head["ETag"], local_dest)
     return local_dest
 
 
+def download_all(bucket, pair_list):
+    "downloads each `(key, local_dest)` in `pair_list` concurrently, see `transfer`"
+    start = time.time()
+    results = transfer.manager().map(lambda pair: download(bucket, *pair), pair_list)
+    log_throughput(
+        "downloaded",
+        len(results),
+        sum(map(os.path.getsize, results)),
+        time.time() - start,
+    )
+    return results
+
+
+def log_throughput(action, num_files, num_bytes, elapsed):
+    elapsed = max(elapsed, 0.001)
+    LOG.info(
+        "%s %s files (%s bytes) in %.1fs, %.1f MiB/s",
+        action,
+        num_files,
+        num_bytes,
+        elapsed,
+        num_bytes / elapsed / 2**20,
+    )
+
+
 def backups(bucket, project, hostname, target, path=None):
     "further filtering of the available backups for a given project"
     # TODO: merge this into `s3_project_files` ?
@@ -323,13 +540,333 @@ def latest_backups(bucket, project, hostname, target, backupname=None):
     return [(backupnom, sorted(pb)[-1]) for backupnom, pb in filename_idx.items()]
 
 
+def latest_archive_set(bucket, project, hostname, filename):
+    """returns the latest 'tar-gzipped' archive called `filename`, or the latest set of archives if it was sharded.
+    the archives in a set are uploaded together and share the same timestamp in their keys.
+    """
+    regex = re.compile(re.escape(filename) + r"(\.part\d+)?\.tar\.gz$")
+    backup_list = [
+        (backupname, key)
+        for backupname, key in latest_backups(bucket, project, hostname, "tar-gzipped")
+        if regex.match(backupname)
+    ]
+    if not backup_list:
+        return []
+    _, latest_key = max(backup_list, key=lambda backup: backup[1])
+    prefix = latest_key.rsplit("-" + filename, 1)[0]
+    return sorted(
+        backup for backup in backup_list if backup[1].startswith(prefix + "-")
+    )
+
+
+def latest_increments(bucket, project, hostname, filename, key):
+    """returns the keys of the latest increments of the 'tar-gzipped' archive called `filename`
+    uploaded after the full archive at `key`, oldest first."""
+    return sorted(
+        increment_key
+        for name, increment_key in latest_backups(
+            bucket, project, hostname, "tar-gzipped"
+        )
+        if name.startswith(filename + ".incr-") and increment_key > key
+    )
+
+
+def read_index(bucket, index_key):
+    "returns the archive index at `index_key`"
+    body = s3_conn().get_object(Bucket=bucket, Key=index_key)["Body"].read()
+    return json.loads(gzip.decompress(body))
+
+
+def s3_prefixes(bucket, prefix):
+    "returns the common prefixes, the 'directories', directly beneath `prefix`"
+    paginator = s3_conn().get_paginator("list_objects")
+    iterator = paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/")
+    return [p["Prefix"] for page in iterator for p in page.get("CommonPrefixes", [])]
+
+
+def files_backup_runs(bucket, project, hostname):
+    """yields the prefix of each 'files' backup of `hostname`, the latest first.
+    'lax/201701/20170101_prod--lax_230000-files/'
+    only the months of the project and the backups within each month are listed, not their files,
+    and each month is only listed once the backups of the months after it have been yielded.
+    """
+    regex = re.compile(r"\d+_%s_\d+\-files/$" % re.escape(hostname))
+    for month in sorted(s3_prefixes(bucket, project + "/"), reverse=True):
+        run_list = [
+            p for p in s3_prefixes(bucket, month) if regex.match(p[len(month) :])
+        ]
+        yield from sorted(run_list, reverse=True)
+
+
+def latest_files_backup(bucket, project, hostname):
+    """returns a list of `(path, key)` for each file of the latest 'files' backup.
+    an incremental backup has just the files that changed, so the latest version of each file in it's
+    manifest is found in earlier backups, listing just as many earlier backups as it takes.
+    """
+    run_iter = files_backup_runs(bucket, project, hostname)
+    latest_run = next(run_iter, None)
+    if not latest_run:
+        LOG.warning(
+            "no 'files' backups found for project %r on host %r", project, hostname
+        )
+        return []
+
+    def run_files(run):
+        return {key[len(run) :]: key for key in s3_project_files(bucket, run)}
+
+    latest = run_files(latest_run)
+    manifest_list = [path for path in latest if path.endswith(".manifest.json")]
+    if not manifest_list:
+        return sorted(latest.items())
+
+    # an incremental backup
+    body = s3_conn().get_object(Bucket=bucket, Key=latest[manifest_list[0]])["Body"]
+    manifest = json.loads(body.read())
+    results = {manifest_list[0]: latest[manifest_list[0]]}
+    missing = set()
+    for path in manifest["files"]:
+        path = path.lstrip("/")
+        if path in latest:
+            results[path] = latest[path]
+        else:
+            missing.add(path)
+    # files that haven't changed since an earlier backup
+    for run in run_iter:
+        if not missing:
+            break
+        for path, key in run_files(run).items():
+            if path in missing:
+                results[path] = key
+                missing.remove(path)
+    for path in sorted(missing):
+        LOG.error("file %r in manifest %r has no backup", path, manifest_list[0])
+    return sorted(results.items())
+
+
+def download_files_backup(to, bucket, project, hostname):
+    """downloads every file of the latest 'files' backup into `to`, keeping their paths.
+    returns a list of the files downloaded."""
+    # the indices of a previous download no longer describe what's in `to`
+    if os.path.isdir(to):
+        for name in os.listdir(to):
+            if name.endswith(".manifest.json") or name.endswith(".bundles.json"):
+                os.unlink(os.path.join(to, name))
+
+    backup_list = latest_files_backup(bucket, project, hostname)
+    LOG.info("downloading %s files to %r", len(backup_list), to)
+    return download_all(bucket, [(key, join(to, path)) for path, key in backup_list])
+
+
+def range_reader(bucket, key):
+    "returns a function that reads a range of bytes from the s3 object at `key`"
+    conn = s3_conn()
+
+    def read_range(start, end):
+        return transfer.manager().read_range(conn, bucket, key, start, end)
+
+    return read_range
+
+
+#
+# streaming
+# an object is read in parts with concurrent ranged GETs and handed over in order as it's read.
+# no more than a few parts are held in memory at once.
+# the object's ETag is checked before the last of it is handed over.
+#
+
+# 8MiB, the same as the parts of uploads, see `generate_s3_etag`
+STREAM_PART_SIZE = 8 * 2**20
+STREAM_THREADS = 8
+
+
+class ObjectStream(io.RawIOBase):
+    "a readable stream of the s3 object at `key`"
+
+    def __init__(self, bucket, key, threads=STREAM_THREADS, part_size=STREAM_PART_SIZE):
+        self.key = key
+        head = s3_conn().head_object(Bucket=bucket, Key=key)
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+        self.read_range = range_reader(bucket, key)
+        self.part_size = part_size
+        # parts are fetched by the transfer manager, within it's budget of connections
+        self.threads = threads
+        self.manager = transfer.manager()
+        self.offsets = iter(range(0, self.size, part_size))
+        self.pending = deque()
+        self.part_md5s = []
+        self.md5 = hashlib.md5()
+        self.buf = memoryview(b"")
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def _fetch(self, start):
+        data = self.read_range(start, min(start + self.part_size, self.size))
+        return data, hashlib.md5(data)
+
+    def _fill(self):
+        # bound the number of parts being fetched or waiting to be read
+        while len(self.pending) < self.threads * 2:
+            start = next(self.offsets, None)
+            if start is None:
+                break
+            self.pending.append(self.manager.submit(self._fetch, start))
+
+    def _verify(self):
+        "raises a `ValueError` if the data read doesn't match the object's ETag"
+        if "-" in self.etag:
+            if self.etag.strip('"').endswith("-%s" % len(self.part_md5s)):
+                digests = b"".join(md5.digest() for md5 in self.part_md5s)
+                local_etag = '"%s-%s"' % (
+                    hashlib.md5(digests).hexdigest(),
+                    len(self.part_md5s),
+                )
+            else:
+                LOG.warning(
+                    "can't verify %r, it was uploaded in parts of a different size",
+                    self.key,
+                )
+                return
+        else:
+            local_etag = '"%s"' % self.md5.hexdigest()
+        if local_etag != self.etag:
+            raise ValueError(
+                "ETags for %r (%s, streamed) and (%s, remote) do not match"
+                % (self.key, local_etag, self.etag)
+            )
+
+    def readinto(self, b):
+        if not self.buf:
+            self._fill()
+            if not self.pending:
+                return 0
+            data, md5 = self.pending.popleft().result()
+            self.part_md5s.append(md5)
+            if "-" not in self.etag:
+                self.md5.update(data)
+            self.bytes_read += len(data)
+            if self.bytes_read >= self.size:
+                # nothing is handed over from the last part until the whole object has been checked
+                self._verify()
+            self.buf = memoryview(data)
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+    def close(self):
+        # parts that haven't been fetched yet are no longer needed
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        super().close()
+
+
+def open_stream(bucket, key, threads=STREAM_THREADS):
+    "returns a buffered, readable stream of the s3 object at `key`, see `ObjectStream`"
+    LOG.info("streaming s3://%s/%s", bucket, key)
+    return io.BufferedReader(ObjectStream(bucket, key, threads), buffer_size=2**20)
+
+
+def archive_index(bucket, key):
+    "returns the index of the archive at `key`. the archive must have been created with an index."
+    index_key = archive.index_path(key)
+    msg = "archive %r has no index %r, it can't be partially restored. was it created with --no-index?"
+    ensure(s3_file_exists(s3_file(bucket, index_key)), msg % (key, index_key))
+    return read_index(bucket, index_key)
+
+
+def archive_headers(bucket, key, index):
+    "returns the pax global header of the archive at `key`, reading just it's first frame"
+    if not index["frames"]:
+        return {}
+    _, offset, size = index["frames"][0]
+    data = range_reader(bucket, key)(offset, offset + size)
+    return archive.read_headers(io.BytesIO(data))
+
+
+def restore_archive_members(bucket, key, patterns, root="/"):
+    """restores the files matching `patterns` in the archive at `key` to `root`.
+    only the archive's index and the parts of the archive the files occupy are downloaded.
+    the archive must have been created with an index."""
+    index = archive_index(bucket, key)
+    LOG.info("restoring files matching %r from s3://%s/%s", patterns, bucket, key)
+    return archive.extract_members(index, range_reader(bucket, key), patterns, root)
+
+
+def restore_chain_members(bucket, key, increment_list, patterns, root="/"):
+    """restores the files matching `patterns` in the full archive at `key` as changed by it's increments.
+    increments in `increment_list` from other chains are ignored, see `tgz_target._restore_chain`.
+    the latest copy of each file in the chain is extracted from the archive that has it,
+    files deleted by a later increment are not restored."""
+    index = archive_index(bucket, key)
+    chain = archive_headers(bucket, key, index).get("ubr.chain")
+    increments = {}
+    for increment_key in increment_list:
+        increment_index = archive_index(bucket, increment_key)
+        headers = archive_headers(bucket, increment_key, increment_index)
+        if headers.get("ubr.chain") == chain:
+            increments[int(headers["ubr.seq"])] = (
+                increment_key,
+                increment_index,
+                headers,
+            )
+        else:
+            LOG.debug("skipping increment %r from another chain", increment_key)
+
+    # the key of the archive with the latest copy of each file
+    latest = {m["path"]: key for m in index["members"]}
+    archive_list = [(key, index)]
+    seq = 1
+    while seq in increments:
+        increment_key, increment_index, headers = increments.pop(seq)
+        latest.update((m["path"], increment_key) for m in increment_index["members"])
+        for deleted_path in json.loads(headers.get("ubr.deleted", "[]")):
+            latest.pop(deleted_path, None)
+        archive_list.append((increment_key, increment_index))
+        seq += 1
+
+    if increments:
+        LOG.error(
+            "increment %s of chain %s is missing, increments %s were not restored",
+            seq,
+            chain,
+            sorted(increments),
+        )
+
+    extracted = []
+    for archive_key, chain_index in archive_list:
+        members = [
+            m for m in chain_index["members"] if latest.get(m["path"]) == archive_key
+        ]
+        if not members:
+            continue
+        LOG.info(
+            "restoring files matching %r from s3://%s/%s", patterns, bucket, archive_key
+        )
+        extracted.extend(
+            archive.extract_members(
+                dict(chain_index, members=members),
+                range_reader(bucket, archive_key),
+                patterns,
+                root,
+            )
+        )
+    return extracted
+
+
 def download_latest_backup(to, bucket, project, hostname, target, path=None):
     if path and "*" in path:
         path = None
     backup_list = latest_backups(bucket, project, hostname, target, path)
-    results = []
-    for backupname, remote_src in backup_list:
-        local_dest = join(to, path or backupname)
+
+    pair_list = [
+        (remote_src, join(to, path or backupname))
+        for backupname, remote_src in backup_list
+    ]
+    for remote_src, local_dest in pair_list:
         LOG.info("downloading s3 file %r to %r", remote_src, local_dest)
-        results.append(download(bucket, remote_src, local_dest))
-    return results
+    # the archives in a set of 'tar-gzipped' archives are downloaded in parallel
+    return download_all(bucket, pair_list)
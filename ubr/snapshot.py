@@ -0,0 +1,96 @@
+import os, json
+from ubr import conf, utils
+from ubr.conf import logging
+
+LOG = logging.getLogger(__name__)
+
+#
+# a snapshot index records the state of a set of files at the time of their last backup.
+# the next backup compares the current state of the files against it to find what has changed.
+#
+# {"chain": "1a2b3c4d", "seq": 3, "files": {"/path/to/file": {"size": 123, "mtime": 1.0, "inode": 456, "digest": "..."}}}
+#
+# 'chain' identifies the full backup a series of incremental backups build on.
+# 'seq' is the number of incremental backups since the full backup (0 for the full backup itself).
+#
+# a backup writes it's new index as pending. the pending index replaces the previous one with `commit`
+# once the backup has been kept, after it has been uploaded for example. a backup that fails to upload
+# leaves the previous index in place and the next backup includes it's changes again.
+#
+
+
+def index_path(name):
+    return os.path.join(conf.STATE_DIR, name + ".snapshot.json")
+
+
+def read(name):
+    "returns the snapshot index with the given `name` or `None` if one doesn't exist or can't be read"
+    path = index_path(name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except ValueError:
+        LOG.warning("ignoring unreadable snapshot index: %s", path)
+        return None
+
+
+def pending_path(name):
+    return index_path(name) + ".pending"
+
+
+def write(name, index, pending=False):
+    """writes the snapshot `index` with the given `name`, replacing any previous index atomically.
+    a `pending` index isn't read until it's committed, see `commit`."""
+    path = pending_path(name) if pending else index_path(name)
+    utils.mkdir_p(os.path.dirname(path))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(index, fh)
+    os.replace(tmp_path, path)
+    return path
+
+
+def commit(name):
+    "replaces the snapshot index with the given `name` with it's pending index, if there is one"
+    path = pending_path(name)
+    if not os.path.exists(path):
+        return None
+    os.replace(path, index_path(name))
+    return index_path(name)
+
+
+def file_state(path):
+    "returns the state of the file at `path` as recorded in a snapshot index, minus it's digest"
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime, "inode": st.st_ino}
+
+
+def changed(state, previous_state):
+    "returns `True` if the file `state` differs from the `previous_state` of the same file"
+    if not previous_state:
+        return True
+    return any(state[key] != previous_state.get(key) for key in state)
+
+
+def diff(previous_files, path_list):
+    """compares the current state of the files in `path_list` with `previous_files`.
+    returns a triple of `(current_files, changed_paths, deleted_paths)`.
+    files that have disappeared since the `path_list` was made are treated as deleted.
+    """
+    current_files = {}
+    changed_paths = []
+    for path in path_list:
+        try:
+            state = file_state(path)
+        except FileNotFoundError:
+            continue
+        previous_state = previous_files.get(path)
+        if changed(state, previous_state):
+            changed_paths.append(path)
+        else:
+            state["digest"] = previous_state.get("digest")
+        current_files[path] = state
+    deleted_paths = sorted(set(previous_files) - set(current_files))
+    return current_files, changed_paths, deleted_paths
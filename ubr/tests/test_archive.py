@@ -0,0 +1,216 @@
+import gzip, io, os, tarfile
+from unittest import mock
+from ubr import archive, tgz_target, utils
+from .base import BaseCase
+
+
+class ParallelGzip(BaseCase):
+    def test_frames_are_a_valid_gzip_stream(self):
+        "data compressed in many frames decompresses back to the original"
+        data = os.urandom(1000) * 50
+        dest = io.BytesIO()
+        gz = archive.ParallelGzipWriter(dest, threads=3, frame_size=1024)
+        for i in range(0, len(data), 700):
+            gz.write(data[i : i + 700])
+        gz.close()
+        self.assertEqual(gzip.decompress(dest.getvalue()), data)
+        self.assertEqual(gz.bytes_in, len(data))
+        self.assertEqual(gz.bytes_out, len(dest.getvalue()))
+
+        # each frame can be decompressed on it's own
+        compressed = dest.getvalue()
+        for u_offset, c_offset, c_size in gz.frames:
+            frame = gzip.decompress(compressed[c_offset : c_offset + c_size])
+            self.assertEqual(frame, data[u_offset : u_offset + len(frame)])
+
+
+class WriteArchive(BaseCase):
+    def setUp(self):
+        self.tempdir, self.rmtempdir = utils.tempdir()
+
+    def tearDown(self):
+        self.rmtempdir()
+
+    def test_write_archive(self):
+        "files are archived under their absolute paths along with their metadata"
+        paths = [
+            os.path.join(self.fixture_dir, "img1.png"),
+            os.path.join(self.fixture_dir, "subdir", "img3.jpg"),
+        ]
+        output_path = os.path.join(self.tempdir, "archive.tar.gz")
+        index = archive.write_archive(iter(paths), output_path)
+        file_list = index["members"]
+
+        self.assertEqual([f["path"] for f in file_list], paths)
+        for f in file_list:
+            self.assertEqual(f["digest"], utils.generate_file_md5(f["path"]))
+            self.assertEqual(f["size"], os.path.getsize(f["path"]))
+
+        with tarfile.open(output_path, "r:gz") as tar:
+            self.assertEqual(tar.getnames(), paths)
+
+    def test_write_archive__missing_file(self):
+        "files that disappear before being archived are skipped"
+        paths = [os.path.join(self.fixture_dir, "img1.png"), "/does/not/exist"]
+        output_path = os.path.join(self.tempdir, "archive.tar.gz")
+        index = archive.write_archive(iter(paths), output_path)
+        self.assertEqual([f["path"] for f in index["members"]], paths[:1])
+
+
+class Extract(BaseCase):
+    def setUp(self):
+        self.tempdir, self.rmtempdir = utils.tempdir()
+        self.archive_path = os.path.join(self.tempdir, "archive.tar.gz")
+        self.paths = [
+            os.path.join(self.fixture_dir, "img1.png"),
+            os.path.join(self.fixture_dir, "hello.txt"),
+            os.path.join(self.fixture_dir, "subdir", "subdir2", "img4.jpg"),
+        ]
+        with mock.patch("ubr.archive.FRAME_SIZE", 1024):
+            self.index = archive.write_archive(iter(self.paths), self.archive_path)
+
+    def tearDown(self):
+        self.rmtempdir()
+
+    def test_extract(self):
+        "small and large files are extracted beneath the given root with their metadata"
+        root = os.path.join(self.tempdir, "root")
+        with mock.patch("ubr.archive.SMALL_FILE_SIZE", 1024):
+            extracted = archive.extract(self.archive_path, root=root)
+        expected = [root + path for path in self.paths]
+        self.assertEqual(extracted, expected)
+        for original, path in zip(self.paths, extracted):
+            self.assertEqual(
+                utils.generate_file_md5(original), utils.generate_file_md5(path)
+            )
+            self.assertEqual(
+                int(os.path.getmtime(original)), int(os.path.getmtime(path))
+            )
+
+    def test_extract__many_frames(self):
+        "every frame of an archive larger than a single frame is extracted"
+        paths = []
+        for i in range(3):
+            path = os.path.join(self.tempdir, "src", "file%s.bin" % i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fh:
+                fh.write(os.urandom(archive.FRAME_SIZE))
+            paths.append(path)
+        index = archive.write_archive(iter(paths), self.archive_path)
+        self.assertTrue(len(index["frames"]) > 1)
+        root = os.path.join(self.tempdir, "root")
+        extracted = archive.extract(self.archive_path, root=root)
+        self.assertEqual(extracted, [root + path for path in paths])
+        for original, path in zip(paths, extracted):
+            self.assertEqual(
+                utils.generate_file_md5(original), utils.generate_file_md5(path)
+            )
+
+    def tar(self, member_list):
+        "writes an archive of `(name, symlink target or contents)` like those written by `tar czf`"
+        with tarfile.open(self.archive_path, "w:gz") as tar:
+            for name, value in member_list:
+                member = tarfile.TarInfo(name)
+                if isinstance(value, str):
+                    member.type, member.linkname = tarfile.SYMTYPE, value
+                    tar.addfile(member)
+                else:
+                    member.size = len(value)
+                    tar.addfile(member, io.BytesIO(value))
+
+    def test_extract__symlinks(self):
+        "symlinks are extracted as symlinks"
+        self.tar(
+            [("opt/app/data.txt", b"data"), ("opt/app/current", "/opt/app/data.txt")]
+        )
+        root = os.path.join(self.tempdir, "root")
+        extracted = archive.extract(self.archive_path, root=root)
+        link = root + "/opt/app/current"
+        self.assertEqual(extracted, [root + "/opt/app/data.txt", link])
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.readlink(link), "/opt/app/data.txt")
+
+    def test_extract__outside_root(self):
+        "members that would be extracted outside of the root are an error"
+        root = os.path.join(self.tempdir, "root")
+        cases = [
+            [("../escaped.txt", b"data")],
+            [("opt/../../escaped.txt", b"data")],
+            [("opt/link", self.tempdir), ("opt/link/escaped.txt", b"data")],
+        ]
+        for member_list in cases:
+            self.tar(member_list)
+            self.assertRaises(AssertionError, archive.extract, self.archive_path, root)
+            self.assertFalse(os.path.exists(os.path.join(self.tempdir, "escaped.txt")))
+
+    def test_extract_corrupt_archive(self):
+        "a truncated archive is detected while it's being extracted"
+        with open(self.archive_path, "rb") as fh:
+            data = fh.read()
+        with open(self.archive_path, "wb") as fh:
+            fh.write(data[: len(data) // 2])
+        root = os.path.join(self.tempdir, "root")
+        self.assertRaises(
+            (EOFError, tarfile.ReadError), archive.extract, self.archive_path, root
+        )
+
+    def test_unpack_bad_archive(self):
+        "a gzipped file that isn't a tar file fails to unpack"
+        with gzip.open(self.archive_path, "wb") as fh:
+            fh.write(os.urandom(2048))
+        self.assertRaises(AssertionError, tgz_target.unpack, self.archive_path)
+
+    def test_extract__patterns(self):
+        "only files matching the patterns or within matching directories are extracted"
+        root = os.path.join(self.tempdir, "root")
+        patterns = ["*.png", os.path.join(self.fixture_dir, "subdir")]
+        extracted = archive.extract(self.archive_path, root=root, patterns=patterns)
+        self.assertEqual(extracted, [root + self.paths[0], root + self.paths[2]])
+
+    def test_extract_members(self):
+        "files are extracted by reading just the frames they occupy"
+        root = os.path.join(self.tempdir, "root")
+        ranges = []
+        read_range = archive.file_range_reader(self.archive_path)
+
+        def recording_reader(start, end):
+            ranges.append((start, end))
+            return read_range(start, end)
+
+        extracted = archive.extract_members(
+            self.index, recording_reader, ["*/hello.txt"], root=root
+        )
+        expected = root + self.paths[1]
+        self.assertEqual(extracted, [expected])
+        self.assertEqual(
+            utils.generate_file_md5(self.paths[1]), utils.generate_file_md5(expected)
+        )
+        self.assertTrue(
+            sum(end - start for start, end in ranges)
+            < os.path.getsize(self.archive_path)
+        )
+
+    def test_extract_members__limited_reads(self):
+        "members spread over many frames are extracted reading a few frames at a time"
+        root = os.path.join(self.tempdir, "root")
+        ranges = []
+        read_range = archive.file_range_reader(self.archive_path)
+
+        def recording_reader(start, end):
+            ranges.append((start, end))
+            return read_range(start, end)
+
+        with mock.patch("ubr.archive.MAX_READ_SIZE", 4096):
+            extracted = archive.extract_members(
+                self.index, recording_reader, ["*"], root
+            )
+        self.assertEqual(extracted, [root + path for path in self.paths])
+        for original, path in zip(self.paths, extracted):
+            self.assertEqual(
+                utils.generate_file_md5(original), utils.generate_file_md5(path)
+            )
+        self.assertTrue(len(ranges) > 1)
+        largest_frame = max(size for _, _, size in self.index["frames"])
+        self.assertTrue(
+            all(end - start <= max(4096, largest_frame) for start, end in ranges)
+        )
@@ -0,0 +1,105 @@
+import os, time
+from unittest import mock
+import pytest
+from ubr import cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    with (
+        mock.patch("ubr.conf.CACHE_DIR", cache_dir),
+        mock.patch("ubr.conf.CACHE_SIZE", 1000),
+    ):
+        yield cache_dir
+
+
+def write(path, data):
+    with open(path, "w") as fh:
+        fh.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(path, "r") as fh:
+        return fh.read()
+
+
+def test_put_get(cache_dir, tmp_path):
+    "a file put in the cache can be got back, but only for the same ETag"
+    src = write(tmp_path / "src", "hello")
+    cache.put("project/key", '"etag"', src)
+    dest = str(tmp_path / "dest" / "file")
+    assert cache.get("project/key", '"etag"', dest)
+    assert read(dest) == "hello"
+    assert not cache.get("project/key", '"changed"', str(tmp_path / "other"))
+    assert not os.path.exists(tmp_path / "other")
+
+
+def test_put__move(cache_dir, tmp_path):
+    "a file can be moved into the cache"
+    src = write(tmp_path / "src", "hello")
+    cache.put("project/key", '"etag"', src, move=True)
+    assert not os.path.exists(src)
+    assert read(cache.cache_path("project/key", '"etag"')) == "hello"
+
+
+def test_disabled(tmp_path):
+    "nothing is cached when the cache has no size"
+    src = write(tmp_path / "src", "hello")
+    with (
+        mock.patch("ubr.conf.CACHE_DIR", str(tmp_path / "cache")),
+        mock.patch("ubr.conf.CACHE_SIZE", 0),
+    ):
+        cache.put("project/key", '"etag"', src, move=True)
+        assert os.path.exists(src)
+        assert not cache.get("project/key", '"etag"', str(tmp_path / "dest"))
+    assert not os.path.exists(tmp_path / "cache")
+
+
+def test_evict(cache_dir, tmp_path):
+    "the least recently used files are removed once the cache is too large"
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, "etag", write(tmp_path / key, "x" * 40))
+        path = cache.cache_path(key, "etag")
+        os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+    # 'a' is used, 'b' is now the least recently used
+    assert cache.get("a", "etag", str(tmp_path / "dest"))
+    assert len(cache.evict(100)) == 1
+    assert os.path.exists(cache.cache_path("a", "etag"))
+    assert not os.path.exists(cache.cache_path("b", "etag"))
+    assert os.path.exists(cache.cache_path("c", "etag"))
+
+
+def test_put__copied(cache_dir, tmp_path):
+    "the cache keeps it's own copy, changing the file given or got doesn't change the cache"
+    src = write(tmp_path / "src", "hello")
+    cache.put("project/key", '"etag"', src)
+    assert (
+        os.stat(src).st_ino != os.stat(cache.cache_path("project/key", '"etag"')).st_ino
+    )
+    write(src, "changed")
+    dest = str(tmp_path / "dest")
+    assert cache.get("project/key", '"etag"', dest)
+    write(dest, "changed")
+    assert cache.get("project/key", '"etag"', dest)
+    assert read(dest) == "hello"
+
+
+def test_get__changed(cache_dir, tmp_path):
+    "a cached file that has changed is removed rather than used"
+    cache.put("project/key", '"etag"', write(tmp_path / "src", "hello"))
+    path = cache.cache_path("project/key", '"etag"')
+    write(path, "jello")
+    dest = str(tmp_path / "dest")
+    assert not cache.get("project/key", '"etag"', dest)
+    assert not os.path.exists(dest)
+    assert not os.path.exists(path)
+    assert not os.path.exists(cache.meta_path(path))
+
+
+def test_get__no_record(cache_dir, tmp_path):
+    "a cached file without a record of it's md5 isn't used"
+    cache.put("project/key", '"etag"', write(tmp_path / "src", "hello"))
+    os.unlink(cache.meta_path(cache.cache_path("project/key", '"etag"')))
+    assert not cache.get("project/key", '"etag"', str(tmp_path / "dest"))
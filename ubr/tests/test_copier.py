@@ -0,0 +1,94 @@
+import os, stat
+from unittest import mock
+from ubr import copier, utils
+from .base import BaseCase
+
+
+class Copy(BaseCase):
+    def setUp(self):
+        self.tempdir, self.rmtempdir = utils.tempdir()
+
+    def tearDown(self):
+        self.rmtempdir()
+
+    def path(self, name):
+        return os.path.join(self.tempdir, name)
+
+    def test_copy(self):
+        "a file is copied, replacing any existing file"
+        src = os.path.join(self.fixture_dir, "img1.png")
+        dest = self.path("img1.png")
+        with open(dest, "w") as fh:
+            fh.write("x" * 10**6)
+        self.assertEqual(copier.copy(src, dest), os.path.getsize(src))
+        self.assertEqual(utils.generate_file_md5(src), utils.generate_file_md5(dest))
+
+    def test_copy__attrs(self):
+        "the permissions and modification time of a file are copied with it"
+        src = self.path("script.sh")
+        with open(src, "w") as fh:
+            fh.write("#!/bin/sh\n")
+        os.chmod(src, 0o755)
+        os.utime(src, ns=(1500000000123456789, 1500000000123456789))
+        dest = self.path("copy.sh")
+        copier.copy(src, dest)
+        st = os.stat(dest)
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o755)
+        self.assertEqual(st.st_mtime_ns, 1500000000123456789)
+
+    def test_copy__without_kernel_support(self):
+        "files are copied by reading and writing them when nothing better is supported"
+        src = os.path.join(self.fixture_dir, "img1.png")
+        dest = self.path("img1.png")
+        with (
+            mock.patch("ubr.copier._no_reflink", mock.MagicMock()),
+            mock.patch("ubr.copier._no_copy_range", mock.MagicMock()) as no_copy_range,
+        ):
+            no_copy_range.__contains__.return_value = True
+            copier.copy(src, dest)
+        self.assertEqual(utils.generate_file_md5(src), utils.generate_file_md5(dest))
+
+    def test_copy__sparse(self):
+        "holes in sparse files are kept"
+        src = self.path("sparse")
+        size = 64 * 2**20
+        with open(src, "wb") as fh:
+            fh.write(b"start")
+            fh.seek(size // 2)
+            fh.write(b"middle")
+            fh.truncate(size)
+        dest = self.path("sparse-copy")
+        copier.copy(src, dest)
+        self.assertEqual(os.path.getsize(dest), size)
+        self.assertEqual(utils.generate_file_md5(src), utils.generate_file_md5(dest))
+        if os.stat(src).st_blocks * 512 < size:
+            # the filesystem supports sparse files
+            self.assertTrue(os.stat(dest).st_blocks * 512 < size)
+
+    def test_copy_files(self):
+        "many files are copied in parallel into new directories, skipping any that disappear"
+        src_list = [
+            os.path.join(self.fixture_dir, "img1.png"),
+            os.path.join(self.fixture_dir, "does-not-exist.txt"),
+            os.path.join(self.fixture_dir, "subdir", "subdir2", "img4.jpg"),
+        ]
+        pairs = [(src, self.path(src.lstrip("/"))) for src in src_list]
+        results = copier.copy_files(iter(pairs), threads=2, digest=True)
+        self.assertEqual([r["src"] for r in results], [src_list[0], src_list[2]])
+        for result in results:
+            self.assertEqual(result["digest"], utils.generate_file_md5(result["src"]))
+            self.assertEqual(result["size"], os.path.getsize(result["dest"]))
+
+    def test_copy__hardlinked_dest(self):
+        "a file linked to the file being replaced is left alone"
+        backup = self.path("backup.txt")
+        with open(backup, "w") as fh:
+            fh.write("original")
+        restored = self.path("restored.txt")
+        os.link(backup, restored)
+        src = os.path.join(self.fixture_dir, "img1.png")
+        copier.copy(src, backup)
+        self.assertEqual(utils.generate_file_md5(src), utils.generate_file_md5(backup))
+        with open(restored, "r") as fh:
+            self.assertEqual(fh.read(), "original")
+        self.assertFalse(os.path.exists(backup + ".ubr-copy"))
@@ -105,3 +105,23 @@ def test_subdesc__no_desc():
     given = "foo.bar"
     expected = {}
     assert descriptions._subdesc(desc, given) == expected
+
+
+def test_subdesc__selector():
+    "a path with a selector matches it's un-selected path in the descriptor and keeps the selector"
+    desc = {"postgresql-database": ["pdb1", "pdb2"]}
+    given = "postgresql-database.pdb2:public.articles"
+    expected = {"postgresql-database": ["pdb2:public.articles"]}
+    assert descriptions._subdesc(desc, given) == expected
+
+
+def test_split_selector():
+    cases = [
+        (("postgresql-database", "pdb1"), ("pdb1", None)),
+        (("postgresql-database", "pdb1:"), ("pdb1", None)),
+        (("postgresql-database", "pdb1:public.articles"), ("pdb1", "public.articles")),
+        # targets without selector support are left alone
+        (("files", "/opt/thing/a:b.txt"), ("/opt/thing/a:b.txt", None)),
+    ]
+    for given, expected in cases:
+        assert descriptions.split_selector(*given) == expected
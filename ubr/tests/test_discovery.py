@@ -0,0 +1,95 @@
+import os, time
+from ubr import discovery, utils
+from .base import BaseCase
+
+
+class FindFiles(BaseCase):
+    def setUp(self):
+        self.root, self.rm_root = utils.tempdir()
+        for path in [
+            "a.txt",
+            "b.jpg",
+            ".hidden.txt",
+            "sub/c.txt",
+            "sub/d.tmp",
+            "sub/deeper/e.txt",
+            "cache/f.txt",
+            ".git/config",
+        ]:
+            self.write(path, "x")
+
+    def tearDown(self):
+        self.rm_root()
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fh:
+            fh.write(content)
+        return path
+
+    def find(self, path_list):
+        root = self.root + "/"
+        return [
+            path[len(root) :]
+            for path in discovery.find_files(
+                [p if discovery.is_option(p) else root + p for p in path_list]
+            )
+        ]
+
+    def test_find_files(self):
+        "literal paths and patterns are expanded to files, like `glob2`"
+        cases = [
+            (["a.txt"], ["a.txt"]),
+            (["*"], ["a.txt", "b.jpg"]),
+            (["*.txt"], ["a.txt"]),
+            (["*/**"], ["cache/f.txt", "sub/c.txt", "sub/d.tmp", "sub/deeper/e.txt"]),
+            (
+                ["**/*.txt"],
+                ["a.txt", "cache/f.txt", "sub/c.txt", "sub/deeper/e.txt"],
+            ),
+            (["sub/*"], ["sub/c.txt", "sub/d.tmp"]),
+            (["s?b/*.t[mx]?"], ["sub/c.txt", "sub/d.tmp"]),
+            ([".*"], [".hidden.txt"]),
+            (["sub/"], []),
+            (["does-not-exist", "*/nothing"], []),
+        ]
+        for given, expected in cases:
+            self.assertEqual(self.find(given), expected, given)
+
+    def test_find_files__overlapping(self):
+        "literal paths come first and files matched by more than one path are found once"
+        given = ["sub/deeper/e.txt", "sub/**", "sub/*.txt", "**/e.txt"]
+        expected = ["sub/deeper/e.txt", "sub/c.txt", "sub/d.tmp"]
+        self.assertEqual(self.find(given), expected)
+
+    def test_find_files__options(self):
+        "files can be excluded and limited by size and age"
+        self.write("big.txt", "x" * 2048)
+        old = self.write("old.txt", "x")
+        an_hour_ago = time.time() - 60 * 60
+        os.utime(old, (an_hour_ago, an_hour_ago))
+
+        excludes = ["exclude=*.tmp", "exclude=" + os.path.join(self.root, "cache")]
+        given = ["**"] + excludes
+        expected = [
+            "a.txt",
+            "b.jpg",
+            "big.txt",
+            "old.txt",
+            "sub/c.txt",
+            "sub/deeper/e.txt",
+        ]
+        self.assertEqual(self.find(given), expected)
+
+        given = ["*.txt", "max-size=1K", "max-age=30m"]
+        self.assertEqual(self.find(given), ["a.txt"])
+
+    def test_split_options(self):
+        given = ["/opt/app/**", "exclude=*.tmp", "max-size=2M", "max-age=7d"]
+        expected = (
+            ["/opt/app/**"],
+            {"exclude": ["*.tmp"], "max-size": 2 * 2**20, "max-age": 7 * 24 * 60 * 60},
+        )
+        self.assertEqual(discovery.split_options(given), expected)
+        self.assertRaises(ValueError, discovery.split_options, ["max-size=lots"])
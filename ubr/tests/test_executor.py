@@ -0,0 +1,153 @@
+import json, threading, time
+from unittest import mock
+from ubr import conf, executor, main, utils
+from .base import BaseCase
+
+
+class Run(BaseCase):
+    def setUp(self):
+        self.state_dir, self.rm_state_dir = utils.tempdir()
+        self.patcher = mock.patch("ubr.conf.STATE_DIR", self.state_dir)
+        self.patcher.start()
+        self.lock = threading.Lock()
+        self.running = {}
+        self.most_running = {}
+        self.started = []
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.rm_state_dir()
+
+    def work(self, kind, name):
+        with self.lock:
+            self.started.append(name)
+            self.running[kind] = self.running.get(kind, 0) + 1
+            self.most_running[kind] = max(
+                self.most_running.get(kind, 0), self.running[kind]
+            )
+        time.sleep(0.05)
+        with self.lock:
+            self.running[kind] -= 1
+        return name
+
+    def test_run(self):
+        "jobs run concurrently, but no more jobs of a kind than the limit run against a server"
+        job_list = [
+            executor.job("db%s" % i, "mysql-database", self.work, "mysql", "db%s" % i)
+            for i in range(3)
+        ]
+        job_list += [
+            executor.job("tgz%s" % i, "tar-gzipped", self.work, "archive", "tgz%s" % i)
+            for i in range(4)
+        ]
+        results = executor.run(job_list, threads=4, limits={"mysql": 1, "archive": 2})
+        self.assertEqual([r["result"] for r in results], [j["name"] for j in job_list])
+        self.assertEqual(self.most_running, {"mysql": 1, "archive": 2})
+
+    def test_run__longest_first(self):
+        "the jobs that took longest the last time they ran are started first"
+        job_list = [
+            executor.job(name, "tar-gzipped", self.work, "archive", name)
+            for name in ["short", "long", "new"]
+        ]
+        with open(executor.durations_path(), "w") as fh:
+            json.dump({"short": 1.0, "long": 60.0}, fh)
+        executor.run(job_list, threads=1)
+        self.assertEqual(self.started, ["new", "long", "short"])
+        self.assertEqual(sorted(executor.read_durations()), ["long", "new", "short"])
+
+    def test_write_durations__expired(self):
+        "jobs that haven't succeeded for a while are forgotten"
+        old = time.time() - executor.DURATIONS_MAX_AGE - 1
+        with open(executor.durations_path(), "w") as fh:
+            json.dump(
+                {
+                    "stale": {"duration": 1.0, "finished": old},
+                    "recent": {"duration": 2.0, "finished": time.time()},
+                    "untimed": 3.0,
+                },
+                fh,
+            )
+        self.assertEqual(
+            executor.read_durations(), {"stale": 1.0, "recent": 2.0, "untimed": 3.0}
+        )
+        result = {"steps": [{"name": "new", "duration": 4.0, "error": None}]}
+        executor.write_durations([result])
+        self.assertEqual(executor.read_durations(), {"recent": 2.0, "new": 4.0})
+
+    def test_run__bad_limits(self):
+        "a limit that would never let a job of it's kind start is an error"
+        job_list = [executor.job("db", "mysql-database", self.work, "mysql", "db")]
+        self.assertRaises(
+            ValueError, executor.run, job_list, threads=2, limits={"mysql": 0}
+        )
+        self.assertEqual(self.started, [])
+
+    def test_run__failure(self):
+        "a job that fails doesn't stop the others"
+
+        def fail():
+            raise OSError("bad dump")
+
+        job_list = [
+            executor.job("bad", "mysql-database", fail),
+            executor.job("good", "tar-gzipped", self.work, "archive", "good"),
+        ]
+        results = executor.run(job_list, threads=1)
+        self.assertEqual(results[1]["result"], "good")
+        self.assertTrue(isinstance(executor.first_error(results), OSError))
+
+    def test_backup__failure(self):
+        "the first failure of a backup is raised once all targets have been backed up"
+        backed_up = []
+
+        def dispatch(target, func_name, args, output_dir, opts):
+            if target == "mysql-database":
+                raise OSError("bad dump")
+            backed_up.append(target)
+            return {"output": []}
+
+        descriptor = {"mysql-database": ["db"], "tar-gzipped": ["/tmp/does-not-exist"]}
+        with mock.patch("ubr.main.module_dispatch", side_effect=dispatch):
+            self.assertRaises(
+                OSError, main.backup, descriptor, "/tmp", conf.DEFAULT_CLI_OPTS
+            )
+        self.assertEqual(backed_up, ["tar-gzipped"])
+
+    def test_run__chain(self):
+        "a job is started as soon as the job before it in it's chain has succeeded"
+        job_list = [
+            executor.chain(
+                executor.job("download-a", "s3", self.work, "s3", "download-a"),
+                executor.job("restore-a", "mysql-database", self.work, "mysql", "a"),
+            ),
+            executor.chain(
+                executor.job("download-b", "s3", self.work, "s3", "download-b"),
+                executor.job("restore-b", "mysql-database", self.work, "mysql", "b"),
+            ),
+            executor.job("download-c", "s3", self.work, "s3", "download-c"),
+        ]
+        results = executor.run(job_list, threads=1)
+        self.assertEqual([r["result"] for r in results], ["a", "b", "download-c"])
+        self.assertEqual(
+            [step["name"] for step in results[0]["steps"]], ["download-a", "restore-a"]
+        )
+        # restoring 'a' didn't wait for the other downloads
+        self.assertEqual(self.started[:2], ["download-a", "a"])
+
+    def test_run__chain_failure(self):
+        "the rest of a chain isn't run if a job in it fails"
+
+        def fail():
+            raise OSError("failed download")
+
+        job_list = [
+            executor.chain(
+                executor.job("download", "s3", fail),
+                executor.job("restore", "mysql-database", self.work, "mysql", "a"),
+            )
+        ]
+        results = executor.run(job_list)
+        self.assertEqual(results[0]["name"], "download")
+        self.assertTrue(isinstance(results[0]["error"], OSError))
+        self.assertEqual(self.started, [])
@@ -1,4 +1,5 @@
-import os, shutil, tempfile
+import os, shutil, stat, json
+from unittest import mock
 from ubr import main, utils, file_target, conf
 from .base import BaseCase
 
@@ -144,19 +145,6 @@ class TestFileBackup(BaseCase):
         "what happens when the path we specify in the descriptor doesn't yield any files?"
         pass
 
-    def test_wrangle_files_dne(self):
-        "wrangle_files removes directories and non-existant files"
-        temp = tempfile.NamedTemporaryFile()
-        cases = ["/tmp/", temp.name, "/dne/"]
-        expected = [temp.name]
-        self.assertEqual(expected, file_target.wrangle_files(cases))
-
-    def test_wrangle_files_all_dne(self):
-        "when all givens paths do not exist, wrangle_files returns an empty list"
-        cases = ["/does/not/exist1", "/does/not/exist2", "/dne3"]
-        expected = []
-        self.assertEqual(file_target.wrangle_files(cases), expected)
-
 
 class TestFileRestore(BaseCase):
     def setUp(self):
@@ -193,3 +181,216 @@ class TestFileRestore(BaseCase):
         self.assertEqual(open(fixture, "r").read(), open(fixture_copy, "r").read())
         restored_md5 = utils.generate_file_md5(fixture_copy)
         self.assertEqual(md5, restored_md5)
+
+
+class TestBatchedFileRestore(BaseCase):
+    def setUp(self):
+        self.src_dir, self.rm_src_dir = utils.tempdir()
+        self.output_dir, self.rm_output_dir = utils.tempdir()
+        self.opts = conf.DEFAULT_CLI_OPTS
+        self.paths = [
+            os.path.join(self.src_dir, "a.txt"),
+            os.path.join(self.src_dir, "sub", "*.txt"),
+            os.path.join(self.src_dir, "missing.txt"),
+        ]
+        for name in ["a.txt", "sub/b.txt", "sub/c.txt"]:
+            path = os.path.join(self.src_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as fh:
+                fh.write(name)
+        main.backup({"files": self.paths}, self.output_dir, self.opts)
+        shutil.rmtree(os.path.join(self.src_dir, "sub"))
+        with open(os.path.join(self.src_dir, "a.txt"), "w") as fh:
+            fh.write("garbage")
+
+    def tearDown(self):
+        self.rm_src_dir()
+        self.rm_output_dir()
+
+    def test_restore(self):
+        "each file matching the paths is restored and paths that match nothing are reported"
+        results = main.restore({"files": self.paths}, self.output_dir, self.opts)
+        expected = [
+            (os.path.join(self.src_dir, "missing.txt"), False),
+            (os.path.join(self.src_dir, "a.txt"), True),
+            (os.path.join(self.src_dir, "sub", "b.txt"), True),
+            (os.path.join(self.src_dir, "sub", "c.txt"), True),
+        ]
+        self.assertEqual(results["files"]["output"], expected)
+        with open(os.path.join(self.src_dir, "a.txt")) as fh:
+            self.assertEqual(fh.read(), "a.txt")
+
+    def test_restore__missing(self):
+        "paths missing from the backup are reported as having nothing to restore, not as failing validation"
+        with mock.patch("ubr.discovery.LOG.error") as discovery_error:
+            with mock.patch("ubr.file_target.LOG.error") as restore_error:
+                main.restore({"files": self.paths}, self.output_dir, self.opts)
+        self.assertFalse(discovery_error.called)
+        restore_error.assert_called_once_with(
+            "nothing to restore for %r in %r",
+            os.path.join(self.src_dir, "missing.txt"),
+            self.output_dir,
+        )
+
+    def test_restore__attrs(self):
+        "restored files get back the permissions and modification time they were backed up with"
+        path = os.path.join(self.src_dir, "script.sh")
+        with open(path, "w") as fh:
+            fh.write("#!/bin/sh\n")
+        os.chmod(path, 0o755)
+        os.utime(path, (1500000000, 1500000000))
+        main.backup({"files": [path]}, self.output_dir, self.opts)
+        with open(path, "w") as fh:
+            fh.write("garbage")
+        os.chmod(path, 0o600)
+
+        main.restore({"files": [path]}, self.output_dir, self.opts)
+        st = os.stat(path)
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o755)
+        self.assertEqual(st.st_mtime, 1500000000)
+
+    def test_restore__hardlink(self):
+        "files can be restored as hardlinks to their backups"
+        opts = dict(self.opts, hardlink=True)
+        main.restore({"files": self.paths}, self.output_dir, opts)
+        restored = os.path.join(self.src_dir, "sub", "b.txt")
+        backup = os.path.join(self.output_dir, restored.lstrip("/"))
+        self.assertTrue(os.path.samefile(restored, backup))
+
+
+class TestIncrementalFileBackup(BaseCase):
+    def setUp(self):
+        self.state_dir, self.rm_state_dir = utils.tempdir()
+        self.src_dir, self.rm_src_dir = utils.tempdir()
+        self.output_dir, self.rm_output_dir = utils.tempdir()
+        self.patcher = mock.patch("ubr.conf.STATE_DIR", self.state_dir)
+        self.patcher.start()
+        self.opts = dict(conf.DEFAULT_CLI_OPTS, incremental=True)
+        self.paths = [os.path.join(self.src_dir, "**")]
+        self.descriptor = {"files": self.paths}
+        for name in ["a.txt", "sub/b.txt"]:
+            self.write(name, name)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.rm_state_dir()
+        self.rm_src_dir()
+        self.rm_output_dir()
+
+    def write(self, name, content):
+        path = os.path.join(self.src_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fh:
+            fh.write(content)
+        return path
+
+    def backup(self):
+        return main.backup(self.descriptor, self.output_dir, self.opts)["files"]
+
+    def manifest(self, output):
+        with open(output["output"][-1], "r") as fh:
+            return json.load(fh)
+
+    def test_incremental_backup(self):
+        "only new and changed files are copied and deleted files are recorded"
+        output = self.backup()
+        self.assertEqual(len(output["output"]), 3)  # two files and a manifest
+
+        os.unlink(os.path.join(self.src_dir, "a.txt"))
+        c = self.write("c.txt", "c")
+        output = self.backup()
+        expected = [os.path.join(self.output_dir, c.lstrip("/"))]
+        self.assertEqual(output["output"][:-1], expected)
+
+        manifest = self.manifest(output)
+        self.assertEqual(manifest["seq"], 1)
+        self.assertEqual(manifest["changed"], [c])
+        self.assertEqual(manifest["deleted"], [os.path.join(self.src_dir, "a.txt")])
+        self.assertEqual(
+            sorted(manifest["files"]), [c, os.path.join(self.src_dir, "sub/b.txt")]
+        )
+        self.assertEqual(manifest["files"][c]["digest"], utils.generate_file_md5(c))
+
+        # nothing changed
+        output = self.backup()
+        self.assertEqual(len(output["output"]), 1)
+
+    def test_incremental_backup__not_kept(self):
+        "the state of a backup isn't recorded until it has been kept"
+        file_target.backup(self.paths, self.output_dir, self.opts)
+        output = self.backup()
+        self.assertEqual(len(output["output"]), 3)
+        self.assertEqual(self.manifest(output)["seq"], 0)
+
+    def test_incremental_restore(self):
+        "the full set of files in the latest manifest is restored"
+        self.backup()
+        self.write("sub/b.txt", "b2")
+        self.write("c.txt", "c")
+        self.backup()
+
+        shutil.rmtree(self.src_dir)
+        results = main.restore(self.descriptor, self.output_dir, self.opts)
+        expected = [
+            (os.path.join(self.src_dir, name), True)
+            for name in ["a.txt", "c.txt", "sub/b.txt"]
+        ]
+        self.assertEqual(results["files"]["output"], expected)
+        with open(os.path.join(self.src_dir, "sub/b.txt")) as fh:
+            self.assertEqual(fh.read(), "b2")
+
+
+class TestBundledFileBackup(BaseCase):
+    def setUp(self):
+        self.src_dir, self.rm_src_dir = utils.tempdir()
+        self.output_dir, self.rm_output_dir = utils.tempdir()
+        self.opts = dict(conf.DEFAULT_CLI_OPTS, bundle=True)
+        self.paths = [os.path.join(self.src_dir, "**")]
+        self.descriptor = {"files": self.paths}
+        self.sizes = {"a.txt": 300, "b.txt": 300, "sub/c.txt": 300, "large.bin": 2000}
+        for name, size in self.sizes.items():
+            path = os.path.join(self.src_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as fh:
+                fh.write(name[0] * size)
+        patchers = [
+            mock.patch("ubr.file_target.BUNDLE_SIZE", 500),
+            mock.patch("ubr.file_target.BUNDLE_FILE_SIZE", 1000),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.rm_src_dir()
+        self.rm_output_dir()
+
+    def test_bundled_backup(self):
+        "small files are packed into bundles and large files are copied as they are"
+        output = main.backup(self.descriptor, self.output_dir, self.opts)["files"]
+        filename = file_target.filename_for_paths(self.paths)
+        large = os.path.join(self.src_dir, "large.bin")
+        expected = [
+            os.path.join(self.output_dir, filename + ".bundle-0001.tar.gz"),
+            os.path.join(self.output_dir, filename + ".bundle-0002.tar.gz"),
+            os.path.join(self.output_dir, large.lstrip("/")),
+            os.path.join(self.output_dir, filename + ".bundles.json"),
+        ]
+        self.assertEqual(output["output"], expected)
+        with open(expected[-1]) as fh:
+            bundle_index = json.load(fh)
+        self.assertEqual(bundle_index["files"], [large])
+        self.assertEqual(
+            bundle_index["bundles"][filename + ".bundle-0002.tar.gz"],
+            [os.path.join(self.src_dir, "sub/c.txt")],
+        )
+
+    def test_bundled_restore(self):
+        "files in bundles and large files are restored"
+        main.backup(self.descriptor, self.output_dir, self.opts)
+        shutil.rmtree(self.src_dir)
+        results = main.restore(self.descriptor, self.output_dir, self.opts)
+        self.assertTrue(all(ok for _, ok in results["files"]["output"]))
+        self.assertEqual(len(results["files"]["output"]), len(self.sizes))
+        for name, size in self.sizes.items():
+            self.assertEqual(os.path.getsize(os.path.join(self.src_dir, name)), size)
@@ -1,5 +1,5 @@
 import pytest
-import os
+import os, subprocess, sys
 from unittest import mock
 from os.path import join
 from ubr import main, utils, psql_target as psql, s3, conf
@@ -216,3 +216,83 @@ def test_parseargs__backup_rds():
     given = "--action backup --location rds-snapshot --hostname prod--lax"
     with mock.patch("ubr.rds_target.backup"):
         main.parseargs(given.split())
+
+
+def test_parseargs__find():
+    "'find' searches for the given paths and requires at least one"
+    given = "--action find --paths /opt/app/uploads/*.pdf"
+    (action, location, hostname, paths), _ = main.parseargs(given.split())
+    assert (action, paths) == ("find", ["/opt/app/uploads/*.pdf"])
+    with pytest.raises(SystemExit):
+        main.parseargs("--action find".split())
+
+
+def test_parseargs__prune_rds():
+    "RDS snapshots can be pruned, but nothing else"
+    given = "--action prune --location rds-snapshot --keep 3 --keep-days 10 --dry-run"
+    (action, location, _, _), opts = main.parseargs(given.split())
+    assert (action, location) == ("prune", "rds-snapshot")
+    assert (opts["keep"], opts["keep_days"], opts["dry_run"]) == (3, 10, True)
+    with pytest.raises(SystemExit):
+        main.parseargs("--action prune --location s3".split())
+
+
+def test_restore_from_s3__pipelined(tmp_path):
+    "each target is restored as soon as it's downloaded and a failed target doesn't stop the others"
+    descriptor = {
+        "postgresql-database": ["db1"],
+        "mysql-database": ["db2"],
+        "files": ["/opt/app/**"],
+    }
+    events = []
+
+    def download_target(hostname, project, target, *args):
+        events.append(("download", target))
+        if target == "files":
+            raise OSError("failed download")
+        return []
+
+    def dispatch(target, func_name, *args):
+        events.append((func_name, target))
+        return {"output": [(target, True)]}
+
+    with mock.patch("ubr.conf.STATE_DIR", str(tmp_path)):
+        with mock.patch(
+            "ubr.main.find_descriptors", return_value=["/etc/ubr/app-backup.yaml"]
+        ):
+            with mock.patch("ubr.main.load_descriptor", return_value=descriptor):
+                with mock.patch(
+                    "ubr.main.download_target", side_effect=download_target
+                ):
+                    with mock.patch("ubr.main.module_dispatch", side_effect=dispatch):
+                        with pytest.raises(OSError):
+                            main.restore_from_s3("prod--app", [], conf.DEFAULT_CLI_OPTS)
+    restored = [target for event, target in events if event == "restore"]
+    assert sorted(restored) == ["mysql-database", "postgresql-database"]
+    for target in restored:
+        assert events.index(("download", target)) < events.index(("restore", target))
+
+
+def test_import__lightweight():
+    "importing `main` doesn't import the targets, their database drivers or the AWS SDK, or log anywhere"
+    heavy = ["boto3", "botocore", "pymysql", "pg8000", "schema", "yaml", "ubr.s3"]
+    heavy += main.KNOWN_TARGET_FNS
+    script = "import sys, ubr.main, logging; print([m for m in %r if m in sys.modules]); print(logging.getLogger('').handlers)"
+    output = subprocess.check_output([sys.executable, "-c", script % heavy], text=True)
+    assert output.splitlines() == ["[]", "[]"]
+
+
+def test_target_module():
+    "target modules are imported when they are dispatched to"
+    assert main.target_module("postgresql-database") is psql
+    assert main.module_dispatch("postgresql-database", "backup_name", "foo") == (
+        "foo-psql.gz"
+    )
+
+
+def test_stream_keys__mysql():
+    "MySQL databases are committed as they are loaded and are never streamed"
+    with mock.patch("ubr.s3.latest_backups") as latest_backups:
+        keys = main.stream_keys("localhost", "project", "mysql-database", ["mydb"], {})
+    assert keys is None
+    assert not latest_backups.called
@@ -104,3 +104,35 @@ class TestDatabaseRestore(BaseCase):
 
         # check data is as it was prior to dump
         self.assertEqual(table_test(), original_expected_result)
+
+    def test_restore_modified_db_using_swap(self):
+        "a database can be restored into a shadow database that is swapped with the live one"
+        descriptor = {"mysql-database": [self.project_name]}
+        table_test = partial(
+            mysql_target.fetchone, self.project_name, "select count(*) from table2"
+        )
+        main.backup(
+            descriptor, output_dir=self.expected_output_dir, opts=self.default_opts
+        )
+        mysql_target.mysql_query(self.project_name, "delete from table2")
+        self.assertEqual(table_test(), {"count(*)": 0})
+
+        opts = dict(self.default_opts, restore_mode="swap")
+        main.restore(descriptor, backup_dir=self.expected_output_dir, opts=opts)
+        self.assertEqual(table_test(), {"count(*)": 2})
+        self.assertFalse(
+            mysql_target.dbexists(mysql_target.shadow_name(self.project_name))
+        )
+
+
+def test_swap_sql():
+    "live tables are moved out and shadow tables moved in with a single statement"
+    expected = (
+        "RENAME TABLE `db`.`t1` TO `db__ubr_old`.`t1`, "
+        "`db__ubr_restore`.`t1` TO `db`.`t1`, "
+        "`db__ubr_restore`.`t2` TO `db`.`t2`"
+    )
+    actual = mysql_target.swap_sql(
+        "db", "db__ubr_restore", "db__ubr_old", ["t1"], ["t1", "t2"]
+    )
+    assert actual == expected
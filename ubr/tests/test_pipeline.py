@@ -0,0 +1,99 @@
+import gzip, io, os, threading
+from unittest import mock
+import pytest
+from ubr import pipeline
+
+
+def test_run():
+    "the output of each command is piped into the next and counted"
+    lines = []
+    result = pipeline.run(
+        [["seq", "1", "100000"], ["gzip"], ["gunzip"], ["wc", "-l"]],
+        stdout=lines.append,
+    )
+    assert result["ok"]
+    assert lines == ["100000"]
+    assert [stage["name"] for stage in result["stages"]] == [
+        "seq",
+        "gzip",
+        "gunzip",
+        "wc",
+    ]
+    seq, gz, gunzip, _ = result["stages"]
+    assert (
+        seq["bytes"]
+        == gunzip["bytes"]
+        == len("".join("%s\n" % i for i in range(1, 100001)))
+    )
+    assert 0 < gz["bytes"] < seq["bytes"]
+    assert all(stage["cpu"] is not None for stage in result["stages"])
+
+
+def test_run__files(tmp_path):
+    "a pipeline can read from and write to files"
+    src = tmp_path / "src.txt"
+    src.write_text("hello\n")
+    dest = str(tmp_path / "dest.gz")
+    assert pipeline.run([["gzip"]], stdin=str(src), stdout=dest)["ok"]
+    with gzip.open(dest, "rt") as fh:
+        assert fh.read() == "hello\n"
+
+
+def test_run__stdin_object():
+    "a pipeline can read from a file-like object"
+    lines = []
+    result = pipeline.run([["cat"]], stdin=io.BytesIO(b"a\nb\n"), stdout=lines.append)
+    assert result["ok"]
+    assert lines == ["a", "b"]
+
+
+def test_run__stdin_fails():
+    "an error reading the input kills the pipeline and is raised"
+    stdin = mock.Mock()
+    stdin.read.side_effect = ValueError("bad ETag")
+    with pytest.raises(ValueError):
+        pipeline.run([["cat"]], stdin=stdin)
+
+
+def test_run__stdin_fails_before_eof(tmp_path):
+    "the commands are killed before they see the end of an input that couldn't be read"
+    marker = str(tmp_path / "finished")
+    stdin = mock.Mock()
+    stdin.read.side_effect = [b"partial\n", EOFError("truncated")]
+    with pytest.raises(EOFError):
+        pipeline.run([["sh", "-c", 'cat > /dev/null; touch "$0"', marker]], stdin=stdin)
+    assert not os.path.exists(marker)
+
+
+def test_run__pipefail():
+    "a pipeline fails if any of it's commands fail, like `set -o pipefail`"
+    with mock.patch("ubr.pipeline.LOG") as mock_log:
+        result = pipeline.run([["sh", "-c", "echo oops >&2; exit 3"], ["cat"]])
+    assert not result["ok"]
+    assert result["returncode"] == 3
+    mock_log.warning.assert_any_call("%s: %s", "sh", "oops")
+
+
+def test_run__not_found():
+    "a command that doesn't exist fails like it would in a shell"
+    result = pipeline.run([["ubr-no-such-command"], ["cat"]])
+    assert not result["ok"]
+    assert result["returncode"] == pipeline.NOT_FOUND
+
+
+def test_run__timeout():
+    "the commands of a pipeline that takes too long are killed"
+    result = pipeline.run([["sleep", "10"]], timeout=0.2)
+    assert not result["ok"]
+    assert result["error"] == "timed out after 0.2s"
+    assert result["elapsed"] < 5
+
+
+def test_run__cancel():
+    "the commands of a cancelled pipeline are killed"
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    result = pipeline.run([["sleep", "10"], ["cat"]], cancel=cancel)
+    assert not result["ok"]
+    assert result["error"] == "cancelled"
+    assert result["elapsed"] < 5
@@ -1,8 +1,9 @@
-import os, types
+import gzip, io, os, types
+from unittest import mock
 import pg8000 as pg8k
 from os.path import join
 from .base import BaseCase
-from ubr import psql_target as psql, conf
+from ubr import psql_target as psql, conf, utils
 
 
 class One(BaseCase):
@@ -28,6 +29,174 @@ class One(BaseCase):
         for given in cases:
             self.assertRaises(ValueError, psql.backup_name, given)
 
+    def test_parse_path(self):
+        cases = [
+            ("foo", ("foo", [])),
+            ("foo:", ("foo", [])),
+            ("foo:public.bar", ("foo", [("public", "bar")])),
+            ("foo:bar", ("foo", [(None, "bar")])),
+            (
+                "foo:public.bar, baz,other.*",
+                ("foo", [("public", "bar"), (None, "baz"), ("other", None)]),
+            ),
+        ]
+        for given, expected in cases:
+            self.assertEqual(psql.parse_path(given), expected)
+
+    def test_parse_path__bad_selector(self):
+        "selecting everything in every schema isn't a selective restore"
+        self.assertRaises(ValueError, psql.parse_path, "foo:*")
+
+    def test_fast_load__truncated_dump(self):
+        "psql is killed before the end of a truncated dump is reached, so nothing it has loaded is committed"
+        tempdir, rmtempdir = utils.tempdir()
+        self.addCleanup(rmtempdir)
+        dump = b"COPY public.table1 (field1) FROM stdin;\n" + b"1\n" * 100000
+        path = join(tempdir, "truncated-psql.gz")
+        with open(path, "wb") as fh:
+            fh.write(gzip.compress(dump)[:-100])
+        # stands in for psql, reads everything it's given and then 'commits' it
+        committed = join(tempdir, "committed")
+        fake_psql = ["sh", "-c", 'cat > /dev/null && touch "$0"', committed]
+        with mock.patch("ubr.psql_target.psql_cmd", return_value=fake_psql):
+            self.assertRaises(EOFError, psql.load, "foo", path, fast=True)
+        self.assertFalse(os.path.exists(committed))
+
+    def test_load_stream(self):
+        "a streamed dump is read by psql as a file, so it's loaded in a single transaction that stops at the first error"
+        stream = io.BytesIO(gzip.compress(b"SELECT 1;\n"))
+        with mock.patch("ubr.psql_target.pipeline.run") as run:
+            run.return_value = {"ok": True, "elapsed": 0.1}
+            self.assertTrue(psql.load_stream("foo", stream))
+        cmd = run.call_args[0][0][0]
+        self.assertIn("--single-transaction", cmd)
+        self.assertIn("ON_ERROR_STOP=1", cmd)
+        self.assertEqual(cmd[cmd.index("--file") + 1], "-")
+
+    def test_restore_stream__fails(self):
+        "a stream that fails to load leaves the live database alone and it's shadow database is dropped"
+        stream = io.BytesIO(gzip.compress(b"SELECT 1;\n"))
+        with (
+            mock.patch.multiple(
+                "ubr.psql_target",
+                dbexists=mock.DEFAULT,
+                drop=mock.DEFAULT,
+                load_stream=mock.DEFAULT,
+                swap=mock.DEFAULT,
+            ) as mocks,
+            mock.patch("ubr.psql_target.create") as create,
+        ):
+            mocks["load_stream"].return_value = False
+            self.assertEqual(psql.restore_stream("foo", stream, {}), ("foo", False))
+        create.assert_called_once_with("foo__ubr_restore")
+        mocks["load_stream"].assert_called_once_with(
+            "foo__ubr_restore", stream, fast=None
+        )
+        self.assertFalse(mocks["swap"].called)
+        self.assertNotIn(mock.call("foo"), mocks["drop"].call_args_list)
+
+    def test_restore_list(self):
+        "the table of contents entries of the selected tables and their indexes, constraints and sequences are kept"
+        toc = [
+            ";",
+            "; Selected TOC Entries:",
+            ";",
+            "215; 1259 16386 TABLE public articles postgres",
+            "216; 1259 16391 SEQUENCE public articles_id_seq postgres",
+            "3360; 0 0 SEQUENCE OWNED BY public articles_id_seq postgres",
+            "217; 1259 16392 TABLE public authors postgres",
+            "3205; 2604 16395 DEFAULT public articles id postgres",
+            "3353; 0 16386 TABLE DATA public articles postgres",
+            "3354; 0 16392 TABLE DATA public authors postgres",
+            "3361; 0 0 SEQUENCE SET public articles_id_seq postgres",
+            "3208; 2606 16397 CONSTRAINT public articles articles_pkey postgres",
+            "3210; 2606 16399 CONSTRAINT public authors authors_pkey postgres",
+            "3206; 1259 16400 INDEX public articles_title_idx postgres",
+            "3211; 1259 16401 INDEX public authors_name_idx postgres",
+            "3212; 2606 16402 FK CONSTRAINT public articles articles_author_id_fkey postgres",
+            "3213; 2620 16403 TRIGGER public articles articles_touch postgres",
+            "3362; 0 0 COMMENT public TABLE articles postgres",
+        ]
+        schema = [
+            "-- Name: articles_id_seq; Type: SEQUENCE; Schema: public; Owner: postgres",
+            "CREATE SEQUENCE public.articles_id_seq",
+            "    AS integer;",
+            "-- Name: articles_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: postgres",
+            "ALTER SEQUENCE public.articles_id_seq OWNED BY public.articles.id;",
+            "-- Name: articles_title_idx; Type: INDEX; Schema: public; Owner: postgres",
+            "CREATE INDEX articles_title_idx ON public.articles USING btree (title);",
+            "-- Name: authors_name_idx; Type: INDEX; Schema: public; Owner: postgres",
+            "CREATE INDEX authors_name_idx ON public.authors USING btree (name);",
+        ]
+        expected = [line for line in toc if " articles" in line]
+        self.assertEqual(len(expected), 11)
+        self.assertEqual(
+            psql._restore_list(toc, schema, [("public", "articles")]), expected
+        )
+        # a table in any schema
+        self.assertEqual(
+            psql._restore_list(toc, schema, [(None, "articles")]), expected
+        )
+        # everything in a schema
+        self.assertEqual(
+            psql._restore_list(toc, schema, [("public", None)]),
+            [line for line in toc if not line.startswith(";")],
+        )
+        self.assertEqual(psql._restore_list(toc, schema, [("other", None)]), [])
+
+    def test_restore_list__referenced(self):
+        "the foreign keys of other tables referencing the selected tables are kept"
+        toc = [
+            "217; 1259 16392 TABLE public authors postgres",
+            "3354; 0 16392 TABLE DATA public authors postgres",
+            "3210; 2606 16399 CONSTRAINT public authors authors_pkey postgres",
+            "3212; 2606 16402 FK CONSTRAINT public articles articles_author_id_fkey postgres",
+            "3214; 2606 16404 FK CONSTRAINT public articles articles_editor_id_fkey postgres",
+        ]
+        schema = [
+            "-- Name: articles articles_author_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres",
+            "ALTER TABLE ONLY public.articles",
+            "    ADD CONSTRAINT articles_author_id_fkey FOREIGN KEY (author_id) REFERENCES public.authors(id);",
+            "-- Name: articles articles_editor_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres",
+            "ALTER TABLE ONLY public.articles",
+            "    ADD CONSTRAINT articles_editor_id_fkey FOREIGN KEY (editor_id) REFERENCES public.editors(id);",
+        ]
+        self.assertEqual(
+            psql._restore_list(toc, schema, [("public", "authors")]), toc[:4]
+        )
+
+    def test_owning_tables(self):
+        "the tables of indexes and identity sequences are found with quoted names"
+        schema = [
+            "-- Name: My Index; Type: INDEX; Schema: public; Owner: postgres",
+            'CREATE UNIQUE INDEX "My Index" ON ONLY public."My Table" USING btree (id);',
+            "-- Name: t_id_seq; Type: SEQUENCE; Schema: public; Owner: postgres",
+            "ALTER TABLE public.t ALTER COLUMN id ADD GENERATED ALWAYS AS IDENTITY (",
+            "    SEQUENCE NAME public.t_id_seq",
+            ");",
+        ]
+        expected = {
+            ("INDEX", "public", "My Index"): ("public", "My Table"),
+            ("SEQUENCE", "public", "t_id_seq"): ("public", "t"),
+        }
+        self.assertEqual(psql._owning_tables(schema), expected)
+
+    def test_dump_reader(self):
+        "a dump is read verbatim and the rows in it's COPY blocks are counted"
+        dump = b"".join(
+            [
+                b"SET statement_timeout = 0;\n",
+                b"COPY public.table1 (field1, field2) FROM stdin;\n",
+                b"1\tfoo\n",
+                b"2\tbar\n",
+                b"\\.\n",
+                b"CREATE INDEX foo ON public.table1 (field1);\n",
+            ]
+        )
+        reader = psql._DumpReader(io.BytesIO(dump))
+        self.assertEqual(b"".join(iter(lambda: reader.read(8), b"")), dump)
+        self.assertEqual((reader.bytes, reader.rows), (len(dump), 2))
+
 
 class Two(BaseCase):
     def setUp(self):
@@ -140,6 +309,125 @@ class Restore(BaseCase):
         psql.restore([self.db], backup_dir=self.fixture_dir, opts=self.default_opts)
         self.assertEqual(2, len(list(psql.runsql(self.db, "select * from table1"))))
 
+    def test_fast_restore(self):
+        "a database dump can be restored using the fast path"
+        opts = dict(self.default_opts, fast_restore=True)
+        expected = {"output": [(self.db, True)]}
+        self.assertEqual(
+            expected, psql.restore([self.db], backup_dir=self.fixture_dir, opts=opts)
+        )
+        self.assertEqual(2, len(list(psql.runsql(self.db, "select * from table1"))))
+
+    def test_fast_restore__fails_halfway(self):
+        "nothing is left behind by a dump that fails halfway through a fast restore"
+        tempdir, rmtempdir = utils.tempdir()
+        self.addCleanup(rmtempdir)
+        path = join(tempdir, psql.backup_name(self.db))
+        with open(path, "wb") as fh:
+            fh.write(
+                gzip.compress(
+                    b"CREATE TABLE table1 (field1 integer);\n"
+                    b"INSERT INTO table1 VALUES (1);\n"
+                    b"INSERT INTO no_such_table VALUES (1);\n"
+                    b"INSERT INTO table1 VALUES (2);\n"
+                )
+            )
+        psql.create(self.db)
+        self.assertFalse(psql.load(self.db, path, fast=True))
+        self.assertEqual(psql.table_count(self.db), 0)
+
+    def test_restore_using_swap(self):
+        "a database can be restored into a shadow database that is swapped with the live one"
+        psql.create(self.db)
+        fixture = join(self.fixture_dir, "psql_ubr_testdb.psql.gz")
+        psql.load(self.db, fixture)
+        psql.runsql(self.db, "delete from table1")
+
+        opts = dict(self.default_opts, restore_mode="swap")
+        expected = {"output": [(self.db, True)]}
+        self.assertEqual(
+            expected, psql.restore([self.db], backup_dir=self.fixture_dir, opts=opts)
+        )
+        self.assertEqual(2, len(list(psql.runsql(self.db, "select * from table1"))))
+        self.assertFalse(psql.dbexists(psql.shadow_name(self.db)))
+
+    def test_restore_stream__truncated(self):
+        "a stream that can't be read to the end leaves the live database as it was"
+        psql.create(self.db)
+        fixture = join(self.fixture_dir, "psql_ubr_testdb.psql.gz")
+        psql.load(self.db, fixture)
+        with open(fixture, "rb") as fh:
+            stream = io.BytesIO(fh.read()[:-10])
+        self.assertEqual(
+            psql.restore_stream(self.db, stream, self.default_opts), (self.db, False)
+        )
+        self.assertEqual(2, len(list(psql.runsql(self.db, "select * from table1"))))
+        self.assertFalse(psql.dbexists(psql.shadow_name(self.db)))
+
+    def test_load_tables(self):
+        "selected tables are restored with their primary keys, indexes and sequences"
+        psql.create(self.db)
+        psql.runsql_many(
+            self.db,
+            [
+                "CREATE TABLE articles (id serial PRIMARY KEY, title text)",
+                "CREATE INDEX articles_title_idx ON articles (title)",
+                "CREATE TABLE authors (id serial PRIMARY KEY, name text)",
+                "INSERT INTO articles (title) VALUES ('foo'), ('bar')",
+                "INSERT INTO authors (name) VALUES ('baz')",
+            ],
+        )
+        tempdir, rmtempdir = utils.tempdir()
+        self.addCleanup(rmtempdir)
+        dump_path = join(tempdir, psql.backup_name(self.db))
+        with mock.patch("ubr.conf.POSTGRESQL_DUMP_FORMAT", "custom"):
+            self.assertTrue(psql.dump(self.db, dump_path))
+        psql.runsql_many(self.db, ["DROP TABLE articles", "DELETE FROM authors"])
+
+        self.assertTrue(psql.load_tables(self.db, dump_path, [("public", "articles")]))
+        indexes = psql.runsql(
+            self.db, "SELECT indexname FROM pg_indexes WHERE tablename = 'articles'"
+        )
+        self.assertEqual(
+            sorted(row["indexname"] for row in indexes),
+            ["articles_pkey", "articles_title_idx"],
+        )
+        psql.runsql(self.db, "INSERT INTO articles (title) VALUES ('baz')")
+        rows = psql.runsql(self.db, "SELECT id FROM articles ORDER BY id")
+        self.assertEqual([row["id"] for row in rows], [1, 2, 3])
+        # tables that weren't selected are left alone
+        self.assertEqual(psql.runsql(self.db, "SELECT * FROM authors"), [])
+
+    def test_load_tables__referenced(self):
+        "a table referenced by the foreign key of a table that wasn't selected can be restored"
+        psql.create(self.db)
+        psql.runsql_many(
+            self.db,
+            [
+                "CREATE TABLE authors (id serial PRIMARY KEY, name text)",
+                "CREATE TABLE articles (id serial PRIMARY KEY, author_id integer REFERENCES authors (id))",
+                "INSERT INTO authors (name) VALUES ('foo')",
+                "INSERT INTO articles (author_id) VALUES (1)",
+            ],
+        )
+        tempdir, rmtempdir = utils.tempdir()
+        self.addCleanup(rmtempdir)
+        dump_path = join(tempdir, psql.backup_name(self.db))
+        with mock.patch("ubr.conf.POSTGRESQL_DUMP_FORMAT", "custom"):
+            self.assertTrue(psql.dump(self.db, dump_path))
+        psql.runsql(self.db, "UPDATE authors SET name = 'bar'")
+
+        self.assertTrue(psql.load_tables(self.db, dump_path, [("public", "authors")]))
+        rows = psql.runsql(self.db, "SELECT name FROM authors")
+        self.assertEqual([row["name"] for row in rows], ["foo"])
+        constraints = psql.runsql(
+            self.db,
+            "SELECT conname FROM pg_constraint WHERE conrelid = 'articles'::regclass AND contype = 'f'",
+        )
+        self.assertEqual(
+            [row["conname"] for row in constraints], ["articles_author_id_fkey"]
+        )
+
     def test_load_can_drop_the_existing_db(self):
         "restoring a database drops any existing one"
         psql.create(self.db)
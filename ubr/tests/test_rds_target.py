@@ -1,6 +1,8 @@
+import botocore.exceptions
+from datetime import datetime, timedelta, timezone
 from ubr import rds_target, utils
 from moto import mock_aws
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
 
 @mock_aws
@@ -77,3 +79,160 @@ def test_backup__no_db_instance():
     with patch("ubr.rds_target.LOG.error") as mock:
         rds_target.backup(target_list, output_dir, opts)
         mock.assert_called_with("RDS instance %r not found, skipping", instance_id)
+
+
+@mock_aws
+def test_backup__many_instances():
+    "snapshots of all instances are started up front and waited on together"
+    instance_list = ["project-dbname1", "project-dbname2", "project-dbname3"]
+    conn = rds_target.rds_conn()
+    for instance_id in instance_list:
+        conn.create_db_instance(
+            DBInstanceIdentifier=instance_id, DBInstanceClass="foo", Engine="postgres"
+        )
+
+    with patch(
+        "ubr.rds_target.describe_snapshots", wraps=rds_target.describe_snapshots
+    ) as mock:
+        results = rds_target.backup(instance_list + ["project-missing"], None, None)
+    assert results["output"] == [(instance_id, True) for instance_id in instance_list]
+    # a single poll saw every snapshot
+    assert mock.call_count == 1
+
+
+def test_wait_for_snapshots__timeout():
+    "snapshots that take too long are given up on without waiting on the others"
+    response_list = [
+        {"DBSnapshot": {"DBSnapshotIdentifier": "ubr-slow"}},
+        {"DBSnapshot": {"DBSnapshotIdentifier": "ubr-fast"}},
+    ]
+    status_list = [
+        {"ubr-slow": "creating", "ubr-fast": "creating"},
+        {"ubr-slow": "creating", "ubr-fast": "available"},
+        {"ubr-slow": "creating"},
+        {"ubr-slow": "creating"},
+    ]
+    clock = [0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    with patch("ubr.rds_target.describe_snapshots", side_effect=status_list):
+        with patch("ubr.rds_target.time") as mock_time:
+            mock_time.time.side_effect = lambda: clock[0]
+            mock_time.sleep.side_effect = sleep
+            results = rds_target.wait_for_snapshots(
+                response_list, max_wait_time_minutes=1, conn=object()
+            )
+    assert results == {"ubr-slow": False, "ubr-fast": True}
+    # polling backs off, giving up on the slow snapshot after a minute
+    assert [c.args[0] for c in mock_time.sleep.call_args_list] == [10, 20, 40]
+
+
+def test_wait_for_snapshots__not_listed_yet():
+    "a snapshot that isn't listed yet is waited on until it's available or times out"
+    response_list = [
+        {"DBSnapshot": {"DBSnapshotIdentifier": "ubr-new"}},
+        {"DBSnapshot": {"DBSnapshotIdentifier": "ubr-lost"}},
+    ]
+    status_list = [{}, {"ubr-new": "creating"}, {"ubr-new": "available"}, {}]
+    clock = [0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    with patch("ubr.rds_target.describe_snapshots", side_effect=status_list):
+        with patch("ubr.rds_target.time") as mock_time:
+            mock_time.time.side_effect = lambda: clock[0]
+            mock_time.sleep.side_effect = sleep
+            results = rds_target.wait_for_snapshots(
+                response_list, max_wait_time_minutes=1, conn=object()
+            )
+    assert results == {"ubr-new": True, "ubr-lost": False}
+
+
+def test_expired():
+    "all but the most recent snapshots of each instance older than the threshold are expired"
+    now = datetime(2022, 5, 1, tzinfo=timezone.utc)
+
+    def snapshot(instance_id, days_ago, status="available"):
+        return {
+            "DBSnapshotIdentifier": "ubr-%s-%s" % (instance_id, days_ago),
+            "DBInstanceIdentifier": instance_id,
+            "SnapshotCreateTime": now - timedelta(days=days_ago),
+            "Status": status,
+        }
+
+    snapshot_list = [
+        snapshot("db1", 1),
+        snapshot("db1", 5),
+        snapshot("db1", 20),
+        snapshot("db1", 40),
+        snapshot("db1", 50, "creating"),
+        snapshot("db2", 60),
+    ]
+    results = rds_target.expired(snapshot_list, keep=1, keep_days=10, now=now)
+    assert [s["DBSnapshotIdentifier"] for s in results] == [
+        "ubr-db1-40",
+        "ubr-db1-20",
+    ]
+
+
+@mock_aws
+def test_prune():
+    "expired ubr snapshots are deleted, other snapshots are left alone"
+    instance_id = "project-dbname"
+    conn = rds_target.rds_conn()
+    conn.create_db_instance(
+        DBInstanceIdentifier=instance_id, DBInstanceClass="foo", Engine="postgres"
+    )
+    for name in ["ubr-test-1", "ubr-test-2", "ubr-test-3"]:
+        rds_target.rds_snapshot(instance_id, name, conn)
+    conn.create_db_snapshot(
+        DBSnapshotIdentifier="not-ubr", DBInstanceIdentifier=instance_id
+    )
+
+    def remaining():
+        return sorted(
+            s["DBSnapshotIdentifier"]
+            for s in conn.describe_db_snapshots(SnapshotType="manual")["DBSnapshots"]
+        )
+
+    opts = {"keep": 1, "keep_days": 0, "dry_run": True}
+    results = rds_target.prune([instance_id], opts)
+    assert len(results["output"]) == 2
+    assert len(remaining()) == 4
+
+    results = rds_target.prune([instance_id], dict(opts, dry_run=False))
+    assert [deleted for _, deleted in results["output"]] == [True, True]
+    assert len(remaining()) == 2
+    assert "not-ubr" in remaining()
+
+
+@mock_aws
+def test_prune__no_instances():
+    "nothing is pruned when no instances are given"
+    instance_id = "project-dbname"
+    conn = rds_target.rds_conn()
+    conn.create_db_instance(
+        DBInstanceIdentifier=instance_id, DBInstanceClass="foo", Engine="postgres"
+    )
+    for name in ["ubr-test-1", "ubr-test-2"]:
+        rds_target.rds_snapshot(instance_id, name, conn)
+
+    opts = {"keep": 0, "keep_days": 0, "dry_run": False}
+    assert rds_target.prune([], opts) == {"output": []}
+    snapshot_list = conn.describe_db_snapshots(SnapshotType="manual")["DBSnapshots"]
+    assert len(snapshot_list) == 2
+
+
+def test_delete_snapshot__throttled():
+    "deletions that are throttled are retried"
+    conn = MagicMock()
+    throttled = botocore.exceptions.ClientError(
+        {"Error": {"Code": "Throttling"}}, "DeleteDBSnapshot"
+    )
+    conn.delete_db_snapshot.side_effect = [throttled, throttled, {}]
+    with patch("ubr.rds_target.time.sleep") as mock_sleep:
+        assert rds_target.delete_snapshot(conn, "ubr-test")
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [1, 2]
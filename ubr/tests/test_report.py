@@ -0,0 +1,33 @@
+from ubr import report
+
+
+def test_latest_by_family():
+    "a full archive with a more recent increment is represented by the increment"
+    backup_list = report.parse_prefix_list(
+        [
+            "lax/202401/20240101_prod--lax_230000-archive-1a2b3c4d.tar.gz",
+            "lax/202401/20240102_prod--lax_230000-archive-1a2b3c4d.incr-0001.tar.gz",
+            "lax/202401/20240103_prod--lax_230000-archive-1a2b3c4d.incr-0002.tar.gz",
+            "lax/202401/20240103_prod--lax_230000-laxprod-psql.gz",
+        ]
+    )
+    expected = [
+        "archive-1a2b3c4d.incr-0002.tar.gz",
+        "laxprod-psql.gz",
+    ]
+    actual = [backup["filename"] for backup in report.latest_by_family(backup_list)]
+    assert actual == expected
+
+
+def test_backup_family():
+    "increments and the archives of a set belong to the same family as a full archive"
+    assert report.backup_family("archive-1a2b3c4d.tar.gz") == "archive-1a2b3c4d.tar.gz"
+    assert (
+        report.backup_family("archive-1a2b3c4d.incr-0001.tar.gz")
+        == "archive-1a2b3c4d.tar.gz"
+    )
+    assert (
+        report.backup_family("archive-1a2b3c4d.part03.tar.gz")
+        == "archive-1a2b3c4d.tar.gz"
+    )
+    assert report.backup_family("files/opt/app/uploads/file.pdf") == "files"
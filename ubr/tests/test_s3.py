@@ -1,6 +1,7 @@
-import os, time, uuid
+import hashlib, io, json, os, threading, time, uuid
+from unittest import mock
 from os.path import join
-from ubr import main, mysql_target, s3, tgz_target, utils, conf
+from ubr import main, mysql_target, s3, tgz_target, utils, conf, report
 from datetime import datetime
 from .base import BaseCase
 from moto import mock_aws
@@ -121,6 +122,170 @@ class One(BaseCase):
         for fname, remote_path in res:
             self.assertTrue(remote_path.endswith(fname))
 
+    def test_restore_archive_members(self):
+        "files are restored from an archive in s3 using it's index"
+        backup_dir, rm_backup_dir = utils.tempdir()
+        root, rm_root = utils.tempdir()
+        self.addCleanup(rm_backup_dir)
+        self.addCleanup(rm_root)
+
+        path_list = [join(self.fixture_dir, "*.png"), join(self.fixture_dir, "*.txt")]
+        result = tgz_target.backup(path_list, backup_dir, conf.DEFAULT_CLI_OPTS)
+        self.assertEqual(len(result["output"]), 2)  # archive and index
+        key_list = s3.upload_backup(
+            self.s3_backup_bucket,
+            {"tar-gzipped": result},
+            self.project_name,
+            self.hostname,
+            remove=False,
+        )
+
+        fixture = join(self.fixture_dir, "hello.txt")
+        restored = s3.restore_archive_members(
+            self.s3_backup_bucket, key_list[0], ["*/hello.txt"], root
+        )
+        self.assertEqual(restored, [root + fixture])
+        self.assertEqual(
+            utils.generate_file_md5(fixture), utils.generate_file_md5(root + fixture)
+        )
+
+    def test_restore_chain_members(self):
+        "the latest copy of each file in a chain of incremental archives is restored"
+        state_dir, rm_state_dir = utils.tempdir()
+        src_dir, rm_src_dir = utils.tempdir()
+        backup_dir, rm_backup_dir = utils.tempdir()
+        root, rm_root = utils.tempdir()
+        for rm in [rm_state_dir, rm_src_dir, rm_backup_dir, rm_root]:
+            self.addCleanup(rm)
+        opts = dict(conf.DEFAULT_CLI_OPTS, incremental=True, full_every=10)
+        path_list = [join(src_dir, "*")]
+
+        def write(name, content):
+            with open(join(src_dir, name), "w") as fh:
+                fh.write(content)
+
+        def backup():
+            result = tgz_target.backup(path_list, backup_dir, opts)
+            main.commit_snapshots({"tar-gzipped": result})
+            key_list = s3.upload_backup(
+                self.s3_backup_bucket,
+                {"tar-gzipped": result},
+                self.project_name,
+                self.hostname,
+            )
+            return [key for key in key_list if key.endswith(".tar.gz")][0]
+
+        write("a.txt", "a")
+        write("b.txt", "b")
+        write("c.txt", "c")
+        with mock.patch("ubr.conf.STATE_DIR", state_dir):
+            key = backup()
+            write("b.txt", "b2")
+            os.unlink(join(src_dir, "c.txt"))
+            increment_list = [backup()]
+            write("b.txt", "b3")
+            write("d.txt", "d")
+            increment_list.append(backup())
+        self.assertEqual(
+            [os.path.basename(key).split("-", 1)[1] for key in increment_list],
+            [
+                tgz_target.filename_for_paths(path_list) + ".incr-%04d.tar.gz" % seq
+                for seq in [1, 2]
+            ],
+        )
+
+        restored = s3.restore_chain_members(
+            self.s3_backup_bucket, key, increment_list, ["*.txt"], root
+        )
+        expected = [root + join(src_dir, name) for name in ["a.txt", "b.txt", "d.txt"]]
+        self.assertEqual(sorted(restored), expected)
+        self.assertEqual(
+            sorted(os.listdir(root + src_dir)), ["a.txt", "b.txt", "d.txt"]
+        )
+        with open(root + join(src_dir, "b.txt")) as fh:
+            self.assertEqual(fh.read(), "b3")
+
+    def test_latest_increments(self):
+        "just the increments uploaded after the full archive are found, oldest first"
+        filename = "archive-1a2b3c4d"
+        listing = [
+            "201701/20170101_testmachine_100000-archive-1a2b3c4d.incr-0001.tar.gz",
+            "201701/20170101_testmachine_100000-archive-1a2b3c4d.incr-0002.tar.gz",
+            "201701/20170102_testmachine_100000-archive-1a2b3c4d.tar.gz",
+            "201701/20170103_testmachine_100000-archive-1a2b3c4d.incr-0001.tar.gz",
+            "201701/20170103_testmachine_100000-archive-ffffffff.incr-0001.tar.gz",
+        ]
+        listing = [self.project_name + "/" + key for key in listing]
+        with mock.patch("ubr.s3.s3_project_files", return_value=listing):
+            results = s3.latest_increments(
+                self.s3_backup_bucket,
+                self.project_name,
+                self.hostname,
+                filename,
+                listing[2],
+            )
+        self.assertEqual(results, [listing[3]])
+
+    def test_search_indexes(self):
+        "files are found in the indexes of archives uploaded to s3"
+        backup_dir, rm_backup_dir = utils.tempdir()
+        self.addCleanup(rm_backup_dir)
+        path_list = [join(self.fixture_dir, "*.png"), join(self.fixture_dir, "*.txt")]
+        result = tgz_target.backup(path_list, backup_dir, conf.DEFAULT_CLI_OPTS)
+        key_list = s3.upload_backup(
+            self.s3_backup_bucket,
+            {"tar-gzipped": result},
+            self.project_name,
+            self.hostname,
+        )
+
+        fixture = join(self.fixture_dir, "hello.txt")
+        results = report.search_indexes(
+            self.s3_backup_bucket, self.project_name, self.hostname, ["*/hello.txt"]
+        )
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["path"], fixture)
+        self.assertEqual(results[0]["key"], key_list[0])
+        self.assertEqual(results[0]["digest"], utils.generate_file_md5(fixture))
+
+        results = report.search_indexes(
+            self.s3_backup_bucket, self.project_name, self.hostname, ["/does/not/*"]
+        )
+        self.assertEqual(results, [])
+
+    def test_latest_archive_set(self):
+        "the latest set of archives is found, ignoring parts of earlier sets"
+        filename = "archive-1a2b3c4d"
+        listing = [
+            "201701/20170101_testmachine_100000-archive-1a2b3c4d.part01.tar.gz",
+            "201701/20170101_testmachine_100000-archive-1a2b3c4d.part02.tar.gz",
+            "201701/20170101_testmachine_100000-archive-1a2b3c4d.part03.tar.gz",
+            "201701/20170102_testmachine_100000-archive-1a2b3c4d.part01.tar.gz",
+            "201701/20170102_testmachine_100000-archive-1a2b3c4d.part02.tar.gz",
+            "201701/20170102_testmachine_100000-archive-ffffffff.tar.gz",
+        ]
+        listing = [self.project_name + "/" + key for key in listing]
+        with mock.patch("ubr.s3.s3_project_files", return_value=listing):
+            results = s3.latest_archive_set(
+                self.s3_backup_bucket, self.project_name, self.hostname, filename
+            )
+        self.assertEqual(
+            [backupname for backupname, _ in results],
+            [filename + ".part01.tar.gz", filename + ".part02.tar.gz"],
+        )
+        self.assertTrue(all("20170102" in key for _, key in results))
+
+    def test_restore_archive_members__no_index(self):
+        "archives without an index can't be partially restored"
+        key = s3.s3_key(self.project_name, self.hostname, "archive-1a2b3c4d.tar.gz")
+        self.assertRaises(
+            AssertionError,
+            s3.restore_archive_members,
+            self.s3_backup_bucket,
+            key,
+            ["*.txt"],
+        )
+
 
 @mock_aws
 class Upload(BaseCase):
@@ -249,6 +414,108 @@ class Download(BaseCase):
             self.expected_output_dir,
         )
 
+    def test_download__ranges(self):
+        "a file is downloaded in ranges and checked against it's ETag"
+        data = os.urandom(3 * 2**20 + 123)
+        key = self.project_name + "/ranges.bin"
+        s3.s3_conn().put_object(Bucket=self.s3_backup_bucket, Key=key, Body=data)
+        dest = join(self.expected_output_dir, "ranges.bin")
+        s3.download(self.s3_backup_bucket, key, dest, part_size=2**20, threads=2)
+        with open(dest, "rb") as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertFalse(os.path.exists(s3.download_state_path(dest)))
+
+    def test_download__resumed(self):
+        "an interrupted download only downloads the ranges it hadn't finished"
+        data = os.urandom(3 * 2**20 + 123)
+        key = self.project_name + "/resumed.bin"
+        s3.s3_conn().put_object(Bucket=self.s3_backup_bucket, Key=key, Body=data)
+        dest = join(self.expected_output_dir, "resumed.bin")
+
+        # the first two ranges were downloaded before the download was interrupted
+        with open(dest, "wb") as fh:
+            fh.write(data[: 2 * 2**20])
+            fh.write(b"\0" * (len(data) - 2 * 2**20))
+        etag = s3.s3_conn().head_object(Bucket=self.s3_backup_bucket, Key=key)["ETag"]
+        state = {"etag": etag, "size": len(data), "part_size": 2**20, "done": [0, 1]}
+        s3.write_download_state(dest, state)
+
+        manager = s3.transfer.manager()
+        with mock.patch.object(
+            manager, "download_range", wraps=manager.download_range
+        ) as mock_download_range:
+            s3.download(self.s3_backup_bucket, key, dest, part_size=2**20)
+        starts = sorted(call[0][3] for call in mock_download_range.call_args_list)
+        self.assertEqual(starts, [2 * 2**20, 3 * 2**20])
+        with open(dest, "rb") as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertFalse(os.path.exists(s3.download_state_path(dest)))
+
+    def test_download__bad_etag(self):
+        "a downloaded file that doesn't match it's ETag is removed"
+        key = self.project_name + "/bad.bin"
+        s3.s3_conn().put_object(Bucket=self.s3_backup_bucket, Key=key, Body=b"data")
+        dest = join(self.expected_output_dir, "bad.bin")
+        with mock.patch("ubr.s3.verify_download", return_value=False):
+            self.assertRaises(ValueError, s3.download, self.s3_backup_bucket, key, dest)
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(os.path.exists(s3.download_state_path(dest)))
+
+    def test_download__cached(self):
+        "a file that has been downloaded before is taken from the cache, unless it has changed"
+        key = self.project_name + "/cached.bin"
+        s3.s3_conn().put_object(Bucket=self.s3_backup_bucket, Key=key, Body=b"one")
+        cache_dir = join(self.expected_output_dir, "cache")
+        manager = s3.transfer.manager()
+        with (
+            mock.patch("ubr.conf.CACHE_DIR", cache_dir),
+            mock.patch("ubr.conf.CACHE_SIZE", 2**20),
+            mock.patch.object(
+                manager, "download_range", wraps=manager.download_range
+            ) as mock_download_range,
+        ):
+            first = join(self.expected_output_dir, "first.bin")
+            second = join(self.expected_output_dir, "second.bin")
+            s3.download(self.s3_backup_bucket, key, first)
+            s3.download(self.s3_backup_bucket, key, second)
+            self.assertEqual(mock_download_range.call_count, 1)
+            with open(second, "rb") as fh:
+                self.assertEqual(fh.read(), b"one")
+
+            # the object changes, it's downloaded again without changing the cached copy
+            s3.s3_conn().put_object(Bucket=self.s3_backup_bucket, Key=key, Body=b"two")
+            s3.download(self.s3_backup_bucket, key, second)
+            self.assertEqual(mock_download_range.call_count, 2)
+            with open(second, "rb") as fh:
+                self.assertEqual(fh.read(), b"two")
+            with open(first, "rb") as fh:
+                self.assertEqual(fh.read(), b"one")
+
+    def test_upload_backup__cached(self):
+        "uploads can be kept in the cache rather than deleted"
+        src = join(self.expected_output_dir, "archive.tar.gz")
+        with open(src, "wb") as fh:
+            fh.write(b"archive")
+        cache_dir = join(self.expected_output_dir, "cache")
+        with (
+            mock.patch("ubr.conf.CACHE_DIR", cache_dir),
+            mock.patch("ubr.conf.CACHE_SIZE", 2**20),
+            mock.patch("ubr.conf.CACHE_UPLOADS", True),
+        ):
+            (key,) = s3.upload_backup(
+                self.s3_backup_bucket,
+                {"tar-gzipped": {"output": [src]}},
+                self.project_name,
+                self.hostname,
+            )
+            self.assertFalse(os.path.exists(src))
+            dest = join(self.expected_output_dir, "restored.tar.gz")
+            with mock.patch.object(s3.transfer.manager(), "download_range") as mock_dr:
+                s3.download(self.s3_backup_bucket, key, dest)
+            self.assertFalse(mock_dr.called)
+            with open(dest, "rb") as fh:
+                self.assertEqual(fh.read(), b"archive")
+
     def test_find_latest_file(self):
         "a backup can be uploaded to s3 and then detected as the latest and downloaded"
         # create the descriptor
@@ -403,3 +670,170 @@ class Download(BaseCase):
         )
         self.assertTrue(os.path.exists(fixture))
         self.assertTrue(os.path.exists(fixture2))
+
+    def test_download_files_backup(self):
+        "the files of the latest incremental 'files' backup are downloaded and restored"
+        state_dir, rm_state_dir = utils.tempdir()
+        src_dir, rm_src_dir = utils.tempdir()
+        self.addCleanup(rm_state_dir)
+        self.addCleanup(rm_src_dir)
+        opts = dict(self.default_opts, incremental=True)
+        descriptor = {"files": [join(src_dir, "**")]}
+
+        def write(name, content):
+            path = join(src_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as fh:
+                fh.write(content)
+            return path
+
+        def backup(dt):
+            results = main.backup(descriptor, self.expected_output_dir, opts)
+            with mock.patch("ubr.s3.datetime") as mock_datetime:
+                mock_datetime.now.return_value = dt
+                s3.upload_backup(
+                    self.s3_backup_bucket, results, self.project_name, self.hostname
+                )
+
+        a, b, c = write("a.txt", "a"), write("sub/b.txt", "b"), write("c.txt", "c")
+        with mock.patch("ubr.conf.STATE_DIR", state_dir):
+            backup(datetime(2017, 1, 1, 10))
+            write("sub/b.txt", "bb")
+            os.unlink(c)
+            backup(datetime(2017, 1, 2, 10))
+
+        # the unchanged file is found in the first backup, the changed file in the second
+        results = dict(
+            s3.latest_files_backup(
+                self.s3_backup_bucket, self.project_name, self.hostname
+            )
+        )
+        self.assertTrue("20170101" in results[a.lstrip("/")])
+        self.assertTrue("20170102" in results[b.lstrip("/")])
+        self.assertFalse(c.lstrip("/") in results)
+
+        os.unlink(a)
+        os.unlink(b)
+        download_dir = join(self.expected_output_dir, "down")
+        s3.download_files_backup(
+            download_dir, self.s3_backup_bucket, self.project_name, self.hostname
+        )
+        main.restore(descriptor, backup_dir=download_dir, opts=opts)
+        with open(a, "r") as fh:
+            self.assertEqual(fh.read(), "a")
+        with open(b, "r") as fh:
+            self.assertEqual(fh.read(), "bb")
+        self.assertFalse(os.path.exists(c))
+
+    def test_s3_conn__threads(self):
+        "each thread creates it's clients from a session of it's own"
+        sessions = []
+
+        def run():
+            s3.s3_conn()
+            sessions.append(s3._session())
+            s3.s3_conn()
+            sessions.append(s3._session())
+
+        thread_list = [threading.Thread(target=run) for _ in range(2)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+        self.assertEqual(len(sessions), 4)
+        self.assertEqual(len(set(map(id, sessions))), 2)
+
+    def test_latest_files_backup__listing(self):
+        "just the backups of the host are listed, and only as far back as the files in the manifest go"
+        conn = s3.s3_conn()
+        manifest = {"files": {"/a.txt": {}, "/b.txt": {}}}
+        objects = {
+            "201612/20161201_%s_100000-files/a.txt": "old a",
+            "201701/20170101_%s_100000-files/a.txt": "a",
+            "201701/20170101_%s_100000-files/b.txt": "b",
+            "201702/20170201_%s_100000-files/b.txt": "bb",
+            "201702/20170201_%s_100000-files/files.manifest.json": json.dumps(manifest),
+            "201702/20170201_other-host_100000-files/a.txt": "other",
+            "201702/20170201_%s_100000-dummy-db1-mysql.gz": "db",
+        }
+        for key, body in objects.items():
+            key = self.project_name + "/" + key.replace("%s", self.hostname)
+            conn.put_object(Bucket=self.s3_backup_bucket, Key=key, Body=body)
+
+        with mock.patch(
+            "ubr.s3.s3_project_files", wraps=s3.s3_project_files
+        ) as project_files:
+            results = s3.latest_files_backup(
+                self.s3_backup_bucket, self.project_name, self.hostname
+            )
+        self.assertEqual(
+            [os.path.dirname(key).split("/")[-1][:8] for _, key in results],
+            ["20170101", "20170201", "20170201"],
+        )
+        listed = [args[1] for args, _ in project_files.call_args_list]
+        expected = [
+            "%s/201702/20170201_%s_100000-files/",
+            "%s/201701/20170101_%s_100000-files/",
+        ]
+        self.assertEqual(
+            listed, [e % (self.project_name, self.hostname) for e in expected]
+        )
+
+    def test_open_stream(self):
+        "an object is streamed in parts, in order, and checked against it's ETag"
+        data = os.urandom(3 * 2**20 + 123)
+        key = self.project_name + "/stream.bin"
+        s3.s3_conn().put_object(Bucket=self.s3_backup_bucket, Key=key, Body=data)
+        stream = s3.ObjectStream(self.s3_backup_bucket, key, threads=2, part_size=2**20)
+        with io.BufferedReader(stream) as fh:
+            self.assertEqual(fh.read(), data)
+
+        # multipart uploads are checked using the ETag of each part
+        path = join(self.expected_output_dir, "stream.bin")
+        with open(path, "wb") as fh:
+            fh.write(os.urandom(s3.STREAM_PART_SIZE + 123))
+        s3.upload_to_s3(self.s3_backup_bucket, path, key)
+        with s3.open_stream(self.s3_backup_bucket, key) as fh:
+            self.assertEqual(
+                utils.generate_file_md5(path), hashlib.md5(fh.read()).hexdigest()
+            )
+
+    def test_open_stream__bad_etag(self):
+        "a stream that doesn't match it's ETag fails before the last of it is read"
+        data = os.urandom(2**20)
+        key = self.project_name + "/stream.bin"
+        s3.s3_conn().put_object(Bucket=self.s3_backup_bucket, Key=key, Body=data)
+        with s3.open_stream(self.s3_backup_bucket, key) as fh:
+            fh.raw.etag = '"bad"'
+            self.assertRaises(ValueError, fh.read)
+
+    def test_stream_target(self):
+        "a 'tar-gzipped' target is restored as it's streamed from s3"
+        src_dir = join(self.expected_output_dir, "src")
+        os.makedirs(src_dir)
+        path = join(src_dir, "hello.txt")
+        with open(path, "w") as fh:
+            fh.write("hello")
+        descriptor = {"tar-gzipped": [join(src_dir, "*.txt")]}
+        results = main.backup(descriptor, self.expected_output_dir, self.default_opts)
+        s3.upload_backup(
+            self.s3_backup_bucket, results, self.project_name, self.hostname
+        )
+        os.unlink(path)
+
+        opts = dict(self.default_opts, stream=True)
+        download_dir = join(self.expected_output_dir, "down")
+        with mock.patch("ubr.conf.BUCKET", self.s3_backup_bucket):
+            main.stream_target(
+                self.hostname,
+                self.project_name,
+                "tar-gzipped",
+                descriptor["tar-gzipped"],
+                download_dir,
+                [],
+                opts,
+            )
+        with open(path, "r") as fh:
+            self.assertEqual(fh.read(), "hello")
+        # nothing was downloaded
+        self.assertFalse(os.path.exists(download_dir))
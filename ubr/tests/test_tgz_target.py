@@ -1,6 +1,7 @@
-import os
+import os, json
 import glob
-from ubr import main, tgz_target, conf
+from unittest import mock
+from ubr import main, tgz_target, conf, archive, utils
 from .base import BaseCase
 
 
@@ -10,7 +11,7 @@ class TestTarredGzippedBackup(BaseCase):
         self.expected_output_dir = "/tmp/foo"
 
     def tearDown(self):
-        os.system("rm /tmp/foo/archive.*.tar.gz")
+        os.system("rm /tmp/foo/archive-*")
 
     def test_simple_tgz(self):
         fixture = os.path.join(self.fixture_dir, "img1.png")
@@ -23,7 +24,10 @@ class TestTarredGzippedBackup(BaseCase):
         filename = tgz_target.filename_for_paths(paths)
         expected_output = {
             "tar-gzipped": {
-                "output": [os.path.join(self.expected_output_dir, filename + ".tar.gz")]
+                "output": [
+                    os.path.join(self.expected_output_dir, filename + ".tar.gz"),
+                    os.path.join(self.expected_output_dir, filename + ".idx.gz"),
+                ]
             }
         }
         self.assertEqual(output, expected_output)
@@ -38,6 +42,13 @@ class TestTarredGzippedBackup(BaseCase):
         results = main.backup(
             descriptor, output_dir=self.expected_output_dir, opts=self.default_opts
         )
+        # the archive and it's index
+        self.assertEqual(2, len(results["tar-gzipped"]["output"]))
+
+        opts = dict(self.default_opts, index=False)
+        results = main.backup(
+            descriptor, output_dir=self.expected_output_dir, opts=opts
+        )
         self.assertEqual(1, len(results["tar-gzipped"]["output"]))
 
     def test_bad_backup_target_doesnt_prevent_subsequent(self):
@@ -84,3 +95,184 @@ class TestTarredGzippedRestore(BaseCase):
             descriptor, backup_dir=self.expected_output_dir, opts=self.default_opts
         )
         self.assertEqual(results, expected_results)
+
+
+class TestIncrementalBackup(BaseCase):
+    def setUp(self):
+        self.state_dir, self.rm_state_dir = utils.tempdir()
+        self.src_dir, self.rm_src_dir = utils.tempdir()
+        self.output_dir, self.rm_output_dir = utils.tempdir()
+        self.patcher = mock.patch("ubr.conf.STATE_DIR", self.state_dir)
+        self.patcher.start()
+        self.opts = dict(conf.DEFAULT_CLI_OPTS, incremental=True, full_every=3)
+        self.paths = [os.path.join(self.src_dir, "*")]
+        for name in ["a.txt", "b.txt"]:
+            self.write(name, name)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.rm_state_dir()
+        self.rm_src_dir()
+        self.rm_output_dir()
+
+    def write(self, name, content):
+        with open(os.path.join(self.src_dir, name), "w") as fh:
+            fh.write(content)
+
+    def backup(self):
+        descriptor = {"tar-gzipped": self.paths}
+        return main.backup(descriptor, self.output_dir, self.opts)["tar-gzipped"]
+
+    def members(self, path):
+        return sorted(map(os.path.basename, archive.list_members(path)))
+
+    def test_incremental_backup(self):
+        "only changed files are archived after the first full backup and a full backup is taken every N runs"
+        filename = tgz_target.filename_for_paths(self.paths)
+
+        full = self.backup()["output"][0]
+        self.assertEqual(os.path.basename(full), filename + ".tar.gz")
+        self.assertEqual(self.members(full), ["a.txt", "b.txt"])
+
+        self.write("c.txt", "c")
+        os.unlink(os.path.join(self.src_dir, "a.txt"))
+        incr = self.backup()["output"][0]
+        self.assertEqual(os.path.basename(incr), filename + ".incr-0001.tar.gz")
+        self.assertEqual(self.members(incr), ["c.txt"])
+        headers = archive.read_headers(incr)
+        self.assertEqual(headers["ubr.seq"], "1")
+        self.assertEqual(
+            json.loads(headers["ubr.deleted"]), [os.path.join(self.src_dir, "a.txt")]
+        )
+
+        incr2 = self.backup()["output"][0]
+        self.assertEqual(self.members(incr2), [])
+
+        # third run since the full backup, a new chain is started
+        full2 = self.backup()["output"][0]
+        self.assertEqual(full2, full)
+        self.assertEqual(self.members(full2), ["b.txt", "c.txt"])
+        self.assertFalse(os.path.exists(incr))
+
+    def test_incremental_backup__upload_fails(self):
+        "the changes in a backup that fails to upload are backed up again next time"
+        with open(os.path.join(self.output_dir, "project-backup.yaml"), "w") as fh:
+            json.dump({"tar-gzipped": self.paths}, fh)
+        filename = tgz_target.filename_for_paths(self.paths)
+
+        def backup_to_s3(**kwargs):
+            with (
+                mock.patch("ubr.conf.DESCRIPTOR_DIR", self.output_dir),
+                mock.patch("ubr.conf.WORKING_DIR", self.output_dir),
+                mock.patch("ubr.s3.upload_backup", **kwargs) as upload_backup,
+            ):
+                try:
+                    main.backup_to_s3("localhost", [], self.opts)
+                except OSError:
+                    pass
+                return upload_backup.call_args[0][1]["tar-gzipped"]["output"][0]
+
+        full = backup_to_s3(side_effect=OSError("failed"))
+        self.assertEqual(os.path.basename(full), filename + ".tar.gz")
+        full = backup_to_s3(return_value=[])
+        self.assertEqual(os.path.basename(full), filename + ".tar.gz")
+        # uploaded, the next backup is an increment
+        self.write("c.txt", "c")
+        incr = backup_to_s3(return_value=[])
+        self.assertEqual(os.path.basename(incr), filename + ".incr-0001.tar.gz")
+        self.assertEqual(self.members(incr), ["c.txt"])
+
+    def test_incremental_restore(self):
+        "a full backup and it's increments are restored in order"
+        self.backup()
+        self.write("b.txt", "b2")
+        self.write("c.txt", "c")
+        self.backup()
+        os.unlink(os.path.join(self.src_dir, "c.txt"))
+        self.write("d.txt", "d")
+        self.backup()
+
+        # lose everything
+        for name in os.listdir(self.src_dir):
+            os.unlink(os.path.join(self.src_dir, name))
+
+        results = main.restore({"tar-gzipped": self.paths}, self.output_dir, self.opts)
+        expected = sorted(
+            (os.path.join(self.src_dir, name), True)
+            for name in ["a.txt", "b.txt", "d.txt"]
+        )
+        self.assertEqual(sorted(results["tar-gzipped"]["output"]), expected)
+        self.assertEqual(sorted(os.listdir(self.src_dir)), ["a.txt", "b.txt", "d.txt"])
+        with open(os.path.join(self.src_dir, "b.txt")) as fh:
+            self.assertEqual(fh.read(), "b2")
+
+
+class TestShardedBackup(BaseCase):
+    def setUp(self):
+        self.src_dir, self.rm_src_dir = utils.tempdir()
+        self.output_dir, self.rm_output_dir = utils.tempdir()
+        self.opts = dict(conf.DEFAULT_CLI_OPTS, shards=3)
+        self.paths = [os.path.join(self.src_dir, "*")]
+        self.sizes = {"a.txt": 500, "b.txt": 400, "c.txt": 300, "d.txt": 200}
+        for name, size in self.sizes.items():
+            with open(os.path.join(self.src_dir, name), "w") as fh:
+                fh.write("x" * size)
+
+    def tearDown(self):
+        self.rm_src_dir()
+        self.rm_output_dir()
+
+    def test_balance(self):
+        "files are split into shards of roughly equal size, keeping their order"
+        path_list = sorted(glob.glob(self.paths[0]))
+        shard_list = tgz_target.balance(iter(path_list), 3)
+        names = [list(map(os.path.basename, shard)) for shard in shard_list]
+        self.assertEqual(names, [["a.txt"], ["b.txt"], ["c.txt", "d.txt"]])
+
+        # never more shards than files
+        self.assertEqual(len(tgz_target.balance(iter(path_list[:2]), 3)), 2)
+
+    def test_sharded_backup_and_restore(self):
+        "a sharded backup is written as a set of archives that are restored together"
+        filename = tgz_target.filename_for_paths(self.paths)
+        output = main.backup({"tar-gzipped": self.paths}, self.output_dir, self.opts)
+        output_list = output["tar-gzipped"]["output"]
+        expected = [
+            os.path.join(self.output_dir, filename + ".part0%s%s" % (i, ext))
+            for i in [1, 2, 3]
+            for ext in [".tar.gz", ".idx.gz"]
+        ]
+        self.assertEqual(output_list, expected)
+        headers = archive.read_headers(expected[4])
+        self.assertEqual((headers["ubr.part"], headers["ubr.parts"]), ("3", "3"))
+
+        for name in self.sizes:
+            os.unlink(os.path.join(self.src_dir, name))
+        results = main.restore({"tar-gzipped": self.paths}, self.output_dir, self.opts)
+        self.assertEqual(
+            sorted(results["tar-gzipped"]["output"]),
+            [(os.path.join(self.src_dir, name), True) for name in sorted(self.sizes)],
+        )
+
+    def test_incomplete_set(self):
+        "a set of archives missing a part can't be restored"
+        main.backup({"tar-gzipped": self.paths}, self.output_dir, self.opts)
+        filename = tgz_target.filename_for_paths(self.paths)
+        os.unlink(os.path.join(self.output_dir, filename + ".part02.tar.gz"))
+        self.assertRaises(
+            AssertionError,
+            tgz_target.restore,
+            self.paths,
+            self.output_dir,
+            self.opts,
+        )
+
+    def test_unsharded_backup_replaces_set(self):
+        "a set of archives is removed by a later unsharded backup"
+        main.backup({"tar-gzipped": self.paths}, self.output_dir, self.opts)
+        opts = dict(self.opts, shards=1)
+        output = main.backup({"tar-gzipped": self.paths}, self.output_dir, opts)
+        self.assertEqual(
+            sorted(os.listdir(self.output_dir)),
+            sorted(map(os.path.basename, output["tar-gzipped"]["output"])),
+        )
@@ -0,0 +1,83 @@
+import threading, time
+from unittest import mock
+import botocore.exceptions
+import pytest
+from ubr import transfer
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError({"Error": {"Code": code}}, "GetObject")
+
+
+def test_backoff():
+    "the wait before a retry is random but grows with each attempt, up to a limit"
+    for attempt in range(10):
+        wait = transfer.backoff(attempt)
+        assert 0 <= wait <= min(transfer.MAX_BACKOFF, transfer.BACKOFF * 2**attempt)
+
+
+def test_transfer__retried():
+    "transfers that fail are retried"
+    manager = transfer.TransferManager(connections=2, bandwidth=0)
+    fn = mock.Mock(side_effect=[client_error("SlowDown"), OSError("reset"), "ok"])
+    with mock.patch("ubr.transfer.time.sleep") as mock_sleep:
+        assert manager._transfer("test", fn) == "ok"
+    assert fn.call_count == 3
+    assert mock_sleep.call_count == 2
+
+
+def test_transfer__permanent_error():
+    "transfers that can't succeed aren't retried"
+    manager = transfer.TransferManager(connections=2, bandwidth=0)
+    fn = mock.Mock(side_effect=client_error("404"))
+    with pytest.raises(botocore.exceptions.ClientError):
+        manager._transfer("test", fn)
+    assert fn.call_count == 1
+
+
+def test_transfer__connections():
+    "no more transfers than there are connections run at once, no matter which thread starts them"
+    manager = transfer.TransferManager(connections=2, bandwidth=0)
+    lock = threading.Lock()
+    state = {"running": 0, "most": 0}
+
+    def work():
+        with lock:
+            state["running"] += 1
+            state["most"] = max(state["most"], state["running"])
+        time.sleep(0.02)
+        with lock:
+            state["running"] -= 1
+
+    threads = [
+        threading.Thread(target=manager._transfer, args=("test", work))
+        for _ in range(3)
+    ]
+    [t.start() for t in threads]
+    manager.map(lambda _: manager._transfer("test", work), range(5))
+    [t.join() for t in threads]
+    assert state["most"] == 2
+
+
+def test_throttle():
+    "transfers wait once more bytes than the bandwidth allows have been transferred"
+    throttle = transfer.Throttle(100)
+    with mock.patch("ubr.transfer.time.sleep") as mock_sleep:
+        throttle.consume(50)
+        assert not mock_sleep.called
+        throttle.consume(150)
+    (wait,), _ = mock_sleep.call_args
+    assert 0.9 < wait <= 1.0
+
+
+def test_progress():
+    "progress is reported for each transfer"
+    progress = mock.Mock()
+    manager = transfer.TransferManager(connections=1, bandwidth=0, progress=progress)
+    conn = mock.Mock()
+    body = mock.Mock()
+    body.read.return_value = b"12345"
+    conn.get_object.return_value = {"Body": body}
+    assert manager.read_range(conn, "bucket", "key", 0, 5) == b"12345"
+    progress.assert_called_with("key", 5)
+    conn.get_object.assert_called_with(Bucket="bucket", Key="key", Range="bytes=0-4")
@@ -1,13 +1,12 @@
-import os, tarfile
-from ubr import utils, file_target, conf
+import os, itertools, glob, json, gzip, tarfile, zlib, heapq, time
+from concurrent.futures import ThreadPoolExecutor
+from ubr import utils, file_target, archive, snapshot
 from .conf import logging
 import hashlib
 from ubr.utils import ensure
 
 LOG = logging.getLogger(__name__)
 
-TMP_SUBDIR = ".tgz-tmp"  # this smells
-
 
 def filename_for_paths(path_list):
     "given a list of filenames, return a predictable string that can be used as a filename"
@@ -20,46 +19,202 @@ def filename_for_paths(path_list):
 #
 
 
-def integral(archive):
-    "return True if gunzip determines the integrity to be ok"
-    return 0 == utils.system("gunzip --test %s" % archive)
-
-
-def unpack(archive):
+def unpack(archive_path, patterns=None):
+    """extracts the archive at `archive_path`, or just the files matching `patterns` if given.
+    a filtered extraction reads only the parts of the archive it needs if the archive has an index.
+    """
     msg = "cannot unpack given archive %r - file does not exist!"
-    ensure(os.path.exists(archive), msg % archive)
+    ensure(os.path.exists(archive_path), msg % archive_path)
 
     msg = "will not unpack given archive %r - it doesn't look like an archive"
-    ensure(archive.endswith(".gz"), msg % archive)
+    ensure(archive_path.endswith(".gz"), msg % archive_path)
+
+    # the archive is checked, listed and extracted in a single pass.
+    # a corrupt archive will have been partially extracted by the time it's detected.
+    index_path = archive.index_path(archive_path)
+    try:
+        if patterns and os.path.exists(index_path):
+            file_listing = archive.extract_members(
+                archive.read_index(index_path),
+                archive.file_range_reader(archive_path),
+                patterns,
+            )
+        else:
+            file_listing = archive.extract(archive_path, patterns=patterns)
+    except (EOFError, zlib.error, tarfile.TarError, gzip.BadGzipFile) as err:
+        msg = "problem extracting archive %r - it appears to be corrupt: %s"
+        raise AssertionError(msg % (archive_path, err))
+
+    return [(f, True) for f in file_listing]
+
+
+def unpack_stream(stream, name):
+    "extracts the archive read from `stream` as it's read, see `s3.open_stream`"
+    try:
+        file_listing = archive.extract(stream)
+    except (EOFError, zlib.error, tarfile.TarError, gzip.BadGzipFile) as err:
+        msg = "problem extracting archive %r - it appears to be corrupt: %s"
+        raise AssertionError(msg % (name, err))
+    return [(f, True) for f in file_listing]
+
+
+#
+# incremental backups
+# a full archive is followed by a series of incremental archives of just the files that changed.
+# each archive in the series records it's place in a pax global header:
+# - 'ubr.chain', the identifier shared by the full archive and it's increments
+# - 'ubr.seq', the place of the archive in the chain, the full archive being 0
+# - 'ubr.deleted', a JSON list of files deleted since the previous archive in the chain
+#
+
+
+def increment_filename(filename, seq):
+    "archive-19928a48, 3 => archive-19928a48.incr-0003"
+    return "%s.incr-%04d" % (filename, seq)
+
+
+def snapshot_name(filename, destination):
+    "the name of the snapshot index for the archive `filename` written to `destination`"
+    return "%s-%s" % (filename, hashlib.sha1(destination.encode()).hexdigest()[:8])
 
-    msg = "will not unpack given archive %r - gunzip doesn't seem to like it"
-    ensure(integral(archive), msg % archive)
 
-    file_listing = tarfile.open(archive, "r:gz").getnames()
-    ensure(
-        0 == utils.system("tar xvzf %s -C /" % archive), "problem extracting archive"
+def _write_archive(path_iter, output_path, opts, headers=None, threads=archive.THREADS):
+    """writes the archive and, unless the 'index' option is unset, it's index alongside it.
+    returns a pair of `(output, index)`"""
+    headers = dict(headers or {}, **{"ubr.created": "%.6f" % time.time()})
+    index = archive.write_archive(
+        path_iter, output_path, threads=threads, headers=headers
     )
+    output = [output_path]
+    if opts.get("index", True):
+        output.append(archive.write_index(index, archive.index_path(output_path)))
+    return output, index
+
+
+def _incremental_backup(path_iter, destination, filename, opts):
+    name = snapshot_name(filename, destination)
+    previous = snapshot.read(name)
+    full_every = max(opts.get("full_every") or 1, 1)
+    full = not previous or previous["seq"] + 1 >= full_every
+
+    previous_files = {} if full else previous["files"]
+    current_files, changed_paths, deleted_paths = snapshot.diff(
+        previous_files, path_iter
+    )
+
+    if full:
+        chain, seq = utils.unique_id()[:8], 0
+        output_path = os.path.join(destination, filename + ".tar.gz")
+        # increments from the previous chain no longer apply to anything
+        _remove_stale(destination, filename, [".idx.gz", ".incr-*", ".part*"])
+    else:
+        chain, seq = previous["chain"], previous["seq"] + 1
+        output_path = os.path.join(
+            destination, increment_filename(filename, seq) + ".tar.gz"
+        )
+
+    LOG.info(
+        "%s backup %s of chain %s: %s changed files, %s deleted files",
+        "full" if full else "incremental",
+        seq,
+        chain,
+        len(changed_paths),
+        len(deleted_paths),
+    )
+    headers = {
+        "ubr.chain": chain,
+        "ubr.seq": str(seq),
+        "ubr.deleted": json.dumps(deleted_paths),
+    }
+    output, index = _write_archive(changed_paths, output_path, opts, headers)
+    for f in index["members"]:
+        current_files[f["path"]]["digest"] = f["digest"]
+
+    # the new state is recorded once the archive has been kept, see `snapshot.commit`
+    snapshot.write(
+        name, {"chain": chain, "seq": seq, "files": current_files}, pending=True
+    )
+    return {"output": output, "snapshot": name}
+
+
+#
+# sharded backups
+# the files are split into N archives of roughly equal size that are written concurrently.
+# each archive in the set records it's place in a pax global header:
+# - 'ubr.set', the identifier shared by all archives in the set
+# - 'ubr.part', the place of the archive in the set, starting at 1
+# - 'ubr.parts', the number of archives in the set
+#
+
 
-    # not great. check modtime as well?
-    return [(f, os.path.isfile(f)) for f in filter(os.path.isfile, file_listing)]
+def part_filename(filename, part):
+    "archive-19928a48, 3 => archive-19928a48.part03"
+    return "%s.part%02d" % (filename, part)
+
+
+def balance(path_iter, n):
+    """splits the files in `path_iter` into at most `n` lists of roughly equal total size.
+    files keep their original order within each list."""
+    sized = []
+    for i, path in enumerate(path_iter):
+        try:
+            sized.append((os.path.getsize(path), i, path))
+        except FileNotFoundError:
+            continue
+    n = max(min(n, len(sized)), 1)
+    # largest files first, each into the smallest shard so far
+    heap = [(0, shard) for shard in range(n)]
+    shard_list = [[] for _ in range(n)]
+    for size, i, path in sorted(sized, reverse=True):
+        total, shard = heapq.heappop(heap)
+        shard_list[shard].append((i, path))
+        heapq.heappush(heap, (total + size, shard))
+    return [[path for _, path in sorted(shard)] for shard in shard_list if shard]
+
+
+def _remove_stale(destination, filename, pattern_list):
+    for pattern in pattern_list:
+        for stale_path in glob.glob(os.path.join(destination, filename + pattern)):
+            os.unlink(stale_path)
+
+
+def _sharded_backup(path_iter, destination, filename, opts):
+    shard_list = balance(path_iter, opts["shards"])
+    set_id = utils.unique_id()[:8]
+    threads = max(archive.THREADS // len(shard_list), 1)
+    LOG.info("backing up files in %s archives, set %s", len(shard_list), set_id)
+
+    # the archives of previous backups no longer apply to anything
+    _remove_stale(destination, filename, [".tar.gz", ".idx.gz", ".part*", ".incr-*"])
+
+    def write(part, path_list):
+        output_path = os.path.join(
+            destination, part_filename(filename, part) + ".tar.gz"
+        )
+        headers = {
+            "ubr.set": set_id,
+            "ubr.part": str(part),
+            "ubr.parts": str(len(shard_list)),
+        }
+        output, _ = _write_archive(path_list, output_path, opts, headers, threads)
+        return output
+
+    with ThreadPoolExecutor(max_workers=len(shard_list)) as executor:
+        output_list = executor.map(write, itertools.count(1), shard_list)
+        return {"output": list(itertools.chain.from_iterable(output_list))}
 
 
 def backup(path_list, destination, opts):
-    """does a regular file_backup and then tars and gzips the results.
-    the name of the resulting file is 'archive.tar.gz'"""
+    """tars and gzips the files matched by the given `path_list`.
+    the name of the resulting file is 'archive-<hash>.tar.gz'"""
     LOG.info("backing up files %r" % (path_list,))
 
     destination = os.path.abspath(destination)
 
-    # obfuscate the given destination so it doesn't overwrite anything
-    original_destination = destination
-    destination = os.path.join(destination, TMP_SUBDIR)  # /tmp/foo/.tgz-tmp
-
-    # this will expand any globs (/home/foo/*.jpg), remove any unreadable files, etc
-    expanded_path_list = list(
-        map(os.path.abspath, file_target.wrangle_files(path_list))
-    )
-    if not expanded_path_list:
+    # this will lazily expand any globs (/home/foo/*.jpg), skip any unreadable files, etc
+    path_iter = map(os.path.abspath, file_target.iter_files(path_list))
+    first_path = next(path_iter, None)
+    if not first_path:
         LOG.warning("no files to backup for %r" % path_list)
         return {"output": []}
 
@@ -70,30 +225,138 @@ def backup(path_list, destination, opts):
     LOG.debug("filename: %s", filename)
 
     # ll: 2016-01-01-23-59-59/archive-19928a48.tar.gz
-    output_path = "%s/%s.tar.gz" % (original_destination, filename)
+    output_path = "%s/%s.tar.gz" % (destination, filename)
     LOG.debug("output path: %s", output_path)
 
-    # ok - why the manifest file? turns out there are only so many characters a shell allows,
-    # dictated by the kernal. in directories with lots of files, this length is exceeded
-    # quickly and returns a mysterious 32517 (or 127 mod 8) return code, which is documented
-    # as 'command not found', which *is not* the case at all.
-    manifest_path = os.path.join(conf.WORKING_DIR, "ubr.manifest")
-    open(manifest_path, "w").write("\n".join(expanded_path_list))
-
-    # now when we create the archive file, we tell it to pull the paths from the manifest
-    cmd = (
-        "cd %(destination)s && tar cvzf %(output_path)s --files-from %(manifest_path)s --absolute-names"
-        % locals()
+    path_iter = itertools.chain([first_path], path_iter)
+    if opts.get("incremental"):
+        if (opts.get("shards") or 1) > 1:
+            LOG.warning("incremental backups are not sharded, ignoring 'shards'")
+        return _incremental_backup(path_iter, destination, filename, opts)
+
+    if (opts.get("shards") or 1) > 1:
+        return _sharded_backup(path_iter, destination, filename, opts)
+
+    _remove_stale(destination, filename, [".idx.gz", ".part*"])
+
+    # files are streamed into the archive as they are found.
+    # there is no list of files to pass to a `tar` command and nothing to print for each file.
+    output, _ = _write_archive(path_iter, output_path, opts)
+
+    return {"output": output}
+
+
+def _restore_chain(archive_path, increment_list, patterns=None):
+    """unpacks the full archive at `archive_path` followed by each of it's increments in order.
+    files restored by an earlier archive in the chain that were later deleted are removed again.
+    """
+    headers = archive.read_headers(archive_path)
+    chain = headers.get("ubr.chain")
+
+    chain_increments = {}
+    for path in increment_list:
+        increment_headers = archive.read_headers(path)
+        if increment_headers.get("ubr.chain") == chain:
+            chain_increments[int(increment_headers["ubr.seq"])] = (
+                path,
+                increment_headers,
+            )
+        else:
+            LOG.debug("skipping increment %r from another chain", path)
+
+    restored = dict(unpack(archive_path, patterns))
+    seq = 1
+    while seq in chain_increments:
+        path, increment_headers = chain_increments.pop(seq)
+        LOG.info("restoring files in increment %r", os.path.basename(path))
+        restored.update(unpack(path, patterns))
+        for deleted_path in json.loads(increment_headers.get("ubr.deleted", "[]")):
+            if deleted_path in restored:
+                # only files this restore put in place are removed
+                os.unlink(deleted_path)
+                del restored[deleted_path]
+        seq += 1
+
+    if chain_increments:
+        LOG.error(
+            "increment %s of chain %s is missing, increments %s were not restored",
+            seq,
+            chain,
+            sorted(chain_increments),
+        )
+    return list(restored.items())
+
+
+def _shard_set(part_list):
+    """returns the archives in `part_list` that belong to the same set as the first part, in order.
+    parts from other sets are ignored and an incomplete set is an error."""
+    headers_list = sorted(
+        (int(headers["ubr.part"]), path, headers)
+        for path in part_list
+        for headers in [archive.read_headers(path)]
+        if "ubr.part" in headers
     )
-    ensure(utils.system(cmd) == 0, "failed to create zip")
+    ensure(headers_list, "no archives found in set: %r" % part_list)
+    _, _, first = headers_list[0]
+    shard_set = [
+        (path, headers)
+        for _, path, headers in headers_list
+        if headers["ubr.set"] == first["ubr.set"]
+    ]
+    for _, path, headers in headers_list:
+        if headers["ubr.set"] != first["ubr.set"]:
+            LOG.warning("skipping archive %r from another set", path)
+    parts = [int(headers["ubr.part"]) for _, headers in shard_set]
+    expected = list(range(1, int(first["ubr.parts"]) + 1))
+    msg = "set %s is incomplete, found parts %s of %s"
+    ensure(parts == expected, msg % (first["ubr.set"], parts, len(expected)))
+    return shard_set
 
-    return {"output": [output_path]}
+
+def created(headers):
+    "returns the time an archive was created from it's `headers`, archives without one are the oldest"
+    return float(headers.get("ubr.created", 0))
+
+
+def _restore_shards(shard_set, patterns=None):
+    "unpacks each archive in the `shard_set` concurrently"
+    LOG.info("restoring files in %s archives", len(shard_set))
+    with ThreadPoolExecutor(max_workers=len(shard_set)) as executor:
+        output_list = executor.map(
+            lambda path: unpack(path, patterns), [path for path, _ in shard_set]
+        )
+        return list(itertools.chain.from_iterable(output_list))
 
 
 def restore(path_list, backup_dir, opts):
-    """assumes a file called 'archive.tar.gz' is in the given directory and that all
-    the paths to the files within that tar.gz file are"""
-    filename = filename_for_paths(path_list) + ".tar.gz"
-    archive = os.path.join(backup_dir, filename)
-    LOG.info("restoring files in archive %r" % filename)
-    return {"output": unpack(archive)}
+    """assumes a file called 'archive-<hash>.tar.gz' is in the given directory and that all
+    the paths to the files within that tar.gz file are absolute.
+    a set of 'archive-<hash>.partNN.tar.gz' files is restored instead if there is one.
+    any increments of the archive in the same directory are restored afterwards.
+    if the 'restore_only' option is set, only the files matching those patterns are restored.
+    """
+    patterns = opts.get("restore_only")
+    filename = filename_for_paths(path_list)
+    archive_path = os.path.join(backup_dir, filename + ".tar.gz")
+
+    part_list = glob.glob(os.path.join(backup_dir, filename + ".part*.tar.gz"))
+    if part_list:
+        shard_set = _shard_set(part_list)
+        # a set of archives and a single archive may both have been downloaded, the latest wins
+        if not os.path.exists(archive_path) or created(shard_set[0][1]) >= created(
+            archive.read_headers(archive_path)
+        ):
+            return {"output": _restore_shards(shard_set, patterns)}
+    LOG.info("restoring files in archive %r" % (filename + ".tar.gz"))
+    increment_list = glob.glob(os.path.join(backup_dir, filename + ".incr-*.tar.gz"))
+    if increment_list:
+        return {"output": _restore_chain(archive_path, increment_list, patterns)}
+    return {"output": unpack(archive_path, patterns)}
+
+
+def restore_stream(path_list, stream, opts):
+    """restores the full archive of `path_list` read from `stream` as it's read.
+    increments and sets of archives can't be streamed, see `restore`."""
+    name = filename_for_paths(path_list) + ".tar.gz"
+    LOG.info("restoring files in archive %r as it's streamed" % name)
+    return {"output": unpack_stream(stream, name)}
@@ -0,0 +1,168 @@
+import os, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
+from ubr import conf
+from ubr.utils import ensure
+from ubr.conf import logging
+
+LOG = logging.getLogger(__name__)
+
+#
+# s3 transfers
+# every upload, download and ranged read goes through a single transfer manager that shares
+# a budget of connections and bandwidth between them:
+# - no more than `conf.S3_CONNECTIONS` requests transfer data at once
+# - no more than `conf.S3_BANDWIDTH` bytes per second are transferred, if set
+# transfers are queued on a pool of workers the size of the connection budget.
+# a transfer that fails is retried with a jittered, exponential backoff.
+# each request (a part of a multipart upload, for example) is also retried by the s3 client itself.
+#
+
+RETRIES = 4
+BACKOFF = 1  # seconds
+MAX_BACKOFF = 30  # seconds
+CHUNK_SIZE = 2**20  # 1MiB, how much of a download is written at once
+
+# errors that are not going to go away by trying again
+PERMANENT_ERRORS = ["403", "404", "AccessDenied", "NoSuchKey", "NoSuchBucket"]
+
+
+def backoff(attempt):
+    "returns a random number of seconds to wait before the given retry `attempt`"
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2**attempt))
+
+
+def permanent(exc):
+    if isinstance(exc, botocore.exceptions.ClientError):
+        return str(exc.response.get("Error", {}).get("Code")) in PERMANENT_ERRORS
+    return isinstance(exc, (FileNotFoundError, PermissionError, IsADirectoryError))
+
+
+class Throttle:
+    "limits the number of bytes transferred per second across all threads, a token bucket"
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.tokens = bytes_per_second
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, num_bytes):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= num_bytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class TransferManager:
+    """runs uploads, downloads and reads within a shared budget of connections and bandwidth.
+    `progress`, if given, is called with the key and the number of bytes transferred as each transfer progresses.
+    """
+
+    def __init__(self, connections=None, bandwidth=None, progress=None):
+        self.connections = connections or conf.S3_CONNECTIONS
+        self.slots = threading.BoundedSemaphore(self.connections)
+        self.throttle = Throttle(conf.S3_BANDWIDTH if bandwidth is None else bandwidth)
+        self.progress = progress
+        self.executor = ThreadPoolExecutor(max_workers=self.connections)
+        # each transfer uses a single connection, the budget is shared between transfers
+        self.config = TransferConfig(use_threads=False)
+
+    def _callback(self, key):
+        def callback(num_bytes):
+            self.throttle.consume(num_bytes)
+            if self.progress:
+                self.progress(key, num_bytes)
+
+        return callback
+
+    def _transfer(self, description, fn, *args, **kwargs):
+        "calls `fn` within a connection slot, retrying it if it fails"
+        for attempt in range(RETRIES + 1):
+            try:
+                with self.slots:
+                    return fn(*args, **kwargs)
+            except Exception as exc:
+                if permanent(exc) or attempt == RETRIES:
+                    raise
+                wait = backoff(attempt)
+                LOG.warning("%s failed, retrying in %.1fs: %s", description, wait, exc)
+                time.sleep(wait)
+
+    def upload(self, conn, src, bucket, key):
+        "uploads the file `src` to `key`"
+        start = time.time()
+        self._transfer(
+            "upload of %r" % src,
+            conn.upload_file,
+            src,
+            bucket,
+            key,
+            Config=self.config,
+            Callback=self._callback(key),
+        )
+        return time.time() - start
+
+    def download_range(self, conn, bucket, key, start, end, fd):
+        "downloads the bytes between `start` and `end` of `key` into the same place in the open file `fd`"
+
+        def _download():
+            byte_range = "bytes=%s-%s" % (start, end - 1)
+            body = conn.get_object(Bucket=bucket, Key=key, Range=byte_range)["Body"]
+            offset = start
+            callback = self._callback(key)
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                view = memoryview(chunk)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    view = view[written:]
+                    offset += written
+                callback(len(chunk))
+            ensure(
+                offset == end,
+                "expected %s bytes of %r, got %s" % (end - start, key, offset - start),
+                IOError,
+            )
+
+        self._transfer("download of %r (bytes %s-%s)" % (key, start, end), _download)
+
+    def read_range(self, conn, bucket, key, start, end):
+        "returns the bytes between `start` and `end` of `key`"
+
+        def _read():
+            byte_range = "bytes=%s-%s" % (start, end - 1)
+            body = conn.get_object(Bucket=bucket, Key=key, Range=byte_range)["Body"]
+            return body.read()
+
+        data = self._transfer("read of %r" % key, _read)
+        self._callback(key)(len(data))
+        return data
+
+    def submit(self, fn, *args):
+        "queues `fn` to run on the manager's pool of workers"
+        return self.executor.submit(fn, *args)
+
+    def map(self, fn, iterable):
+        "calls `fn` with each item in `iterable` on the manager's pool of workers, returning the results in order"
+        future_list = [self.executor.submit(fn, item) for item in iterable]
+        return [future.result() for future in future_list]
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def manager():
+    "returns the transfer manager shared by every transfer in this process"
+    global _manager
+    with _manager_lock:
+        if not _manager:
+            _manager = TransferManager()
+        return _manager
@@ -1,7 +1,7 @@
 import shutil
 import tempfile
 from contextlib import contextmanager
-import os, subprocess
+import os
 import errno
 from itertools import takewhile
 from collections.abc import Iterable
@@ -78,19 +78,6 @@ def ensure(assertion, msg, ExceptionClass=AssertionError):
         raise ExceptionClass(msg)
 
 
-def system(cmd):
-    args = ["/bin/bash", "-c", cmd]
-    process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    stdout = stdout and stdout.decode()
-    stderr = stderr and stderr.decode()
-    if stdout:
-        LOG.info(stdout)
-    if stderr:
-        LOG.warning(stderr)
-    return process.returncode
-
-
 def mkdir_p(path):
     try:
         os.makedirs(path)